@@ -1,9 +1,15 @@
 # must be build with scons
 from .messaging_pyx import Context, Poller, SubSocket, PubSocket  # pylint: disable=no-name-in-module, import-error
 from .messaging_pyx import MultiplePublishersError, MessagingError  # pylint: disable=no-name-in-module, import-error
+from .messaging_pyx import MessageBatch  # pylint: disable=no-name-in-module, import-error
 
 assert MultiplePublishersError
 assert MessagingError
+assert MessageBatch
+
+from array import array
+from collections.abc import Mapping
+import struct
 
 from cereal import log
 from cereal.services import service_list
@@ -58,6 +64,10 @@ def drain_sock_raw(sock, wait_for_one=False):
 
   return ret
 
+def drain_sock_batch(sock, wait_for_one=False):
+  """Receive all message currently available on the queue into a single MessageBatch"""
+  return sock.receive_many(wait_for_one)
+
 def drain_sock(sock, wait_for_one=False):
   """Receive all message currently available on the queue"""
   ret = []
@@ -206,6 +216,213 @@ class SubMaster():
     return self.all_alive(service_list=service_list) and self.all_valid(service_list=service_list)
 
 
+def _event_header_layout():
+  """Offsets of logMonoTime (bytes) and valid (bits) in the Event data section"""
+  slots = {f.name: f.slot for f in log.Event.schema.node.struct.fields}
+  return slots['logMonoTime'].offset * 8, slots['valid'].offset, slots['valid'].defaultValue.bool
+
+_LOG_MONO_TIME_OFFSET, _VALID_BIT, _VALID_DEFAULT = _event_header_layout()
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_STRUCT_POINTER = struct.Struct('<iHH')
+
+def peek_event_header(dat):
+  """Read logMonoTime and valid from a serialized Event without decoding it.
+  Returns None if the root struct is not directly reachable from the first segment"""
+  if len(dat) < 16:
+    return None
+
+  n_segments = _U32.unpack_from(dat, 0)[0] + 1
+  seg_start = (4 + 4 * n_segments + 7) & ~7
+  if seg_start + 8 > len(dat):
+    return None
+
+  ptr, data_words, _ = _STRUCT_POINTER.unpack_from(dat, seg_start)
+  if ptr & 3 != 0:  # far pointer, let capnp deal with it
+    return None
+
+  data_start = seg_start + 8 + (ptr >> 2) * 8
+  data_size = data_words * 8
+  if data_start < seg_start + 8 or data_start + data_size > len(dat):
+    return None
+
+  # fields outside of the data section have their default value
+  log_mono_time = 0
+  if _LOG_MONO_TIME_OFFSET + 8 <= data_size:
+    log_mono_time = _U64.unpack_from(dat, data_start + _LOG_MONO_TIME_OFFSET)[0]
+
+  valid_byte, valid_bit = divmod(_VALID_BIT, 8)
+  valid = False
+  if valid_byte < data_size:
+    valid = bool((dat[data_start + valid_byte] >> valid_bit) & 1)
+  return log_mono_time, valid != _VALID_DEFAULT
+
+
+class _ServiceView(Mapping):
+  """Read-only dict-like view of a per-service array"""
+  def __init__(self, idx, arr, cast=None):
+    self._idx = idx
+    self._arr = arr
+    self._cast = cast
+
+  def __getitem__(self, s):
+    v = self._arr[self._idx[s]]
+    return v if self._cast is None else self._cast(v)
+
+  def __iter__(self):
+    return iter(self._idx)
+
+  def __len__(self):
+    return len(self._idx)
+
+
+class _AliveView(_ServiceView):
+  """Alive is only evaluated for the services that are looked up"""
+  def __init__(self, sm):
+    super(_AliveView, self).__init__(sm._idx, sm._rcv_time)
+    self._sm = sm
+
+  def __getitem__(self, s):
+    i = self._idx[s]
+    return (self._sm._cur_time - self._arr[i]) < self._sm._alive_window[i]
+
+
+class LazySubMaster():
+  """Drop-in replacement for SubMaster that keeps the raw message buffers and only
+  decodes a service the first time it is read after an update. logMonoTime and valid
+  are read straight from the serialized header, and the per-service state lives in
+  flat arrays so a frame only touches the services that were actually received."""
+  def __init__(self, services, ignore_alive=None, addr="127.0.0.1"):
+    self.poller = Poller()
+    self.frame = -1
+    self.services = list(services)
+    self._idx = {s: i for i, s in enumerate(self.services)}
+    self._sock_service = {}
+    self.sock = {}
+    self.freq = {}
+    self.data = {}
+
+    n = len(self.services)
+    self._cur_time = 0.
+    self._updated = bytearray(n)
+    self._updated_idx = []
+    self._rcv_time = array('d', [0.] * n)
+    self._rcv_frame = array('q', [0] * n)
+    self._log_mono_time = array('Q', [0] * n)
+    self._valid = bytearray(n)
+    self._raw = [None] * n
+    # alive if delay is within 10x the expected frequency, if freq is 0 it's always alive
+    self._alive_window = array('d', [0.] * n)
+
+    self.updated = _ServiceView(self._idx, self._updated, bool)
+    self.rcv_time = _ServiceView(self._idx, self._rcv_time)
+    self.rcv_frame = _ServiceView(self._idx, self._rcv_frame)
+    self.logMonoTime = _ServiceView(self._idx, self._log_mono_time)
+    self.valid = _ServiceView(self._idx, self._valid, bool)
+    self.alive = _AliveView(self)
+
+    if ignore_alive is not None:
+      self.ignore_alive = ignore_alive
+    else:
+      self.ignore_alive = []
+    self._alive_check_idx = [self._idx[s] for s in self.services if s not in self.ignore_alive]
+
+    for i, s in enumerate(self.services):
+      if addr is not None:
+        self.sock[s] = sub_sock(s, poller=self.poller, addr=addr, conflate=True)
+        self._sock_service[self.sock[s]] = s
+      self.freq[s] = service_list[s].frequency
+      # arbitrary small number to avoid float comparison
+      self._alive_window[i] = 10. / self.freq[s] if self.freq[s] > 1e-5 else float('inf')
+
+      data = new_message()
+      if s in ['can', 'sensorEvents', 'liveTracks', 'sendCan',
+               'ethernetData', 'cellInfo', 'wifiScan',
+               'trafficEvents', 'orbObservation', 'carEvents']:
+        data.init(s, 0)
+      else:
+        data.init(s)
+      self.data[s] = getattr(data, s)
+      self._valid[i] = data.valid
+
+  def __getitem__(self, s):
+    i = self._idx[s]
+    raw = self._raw[i]
+    if raw is not None:
+      self._raw[i] = None
+      self.data[s] = getattr(log.Event.from_bytes(raw), s)
+    return self.data[s]
+
+  def update(self, timeout=1000):
+    msgs = []
+    for sock in self.poller.poll(timeout):
+      dat = sock.receive(non_blocking=True)
+      if dat is not None:
+        msgs.append((self._sock_service[sock], dat))
+    self.update_raw(sec_since_boot(), msgs)
+
+  def _new_frame(self, cur_time):
+    self.frame += 1
+    self._cur_time = cur_time
+    for i in self._updated_idx:
+      self._updated[i] = False
+    self._updated_idx = []
+
+  def _mark_received(self, i, cur_time):
+    self._updated[i] = True
+    self._updated_idx.append(i)
+    self._rcv_time[i] = cur_time
+    self._rcv_frame[i] = self.frame
+
+  def update_raw(self, cur_time, msgs):
+    """Update from (service, serialized Event) pairs"""
+    self._new_frame(cur_time)
+    for s, dat in msgs:
+      i = self._idx[s]
+      self._mark_received(i, cur_time)
+
+      header = peek_event_header(dat)
+      if header is None:
+        msg = log.Event.from_bytes(dat)
+        self.data[s] = getattr(msg, s)
+        self._raw[i] = None
+        header = msg.logMonoTime, msg.valid
+      else:
+        self._raw[i] = dat
+      self._log_mono_time[i], self._valid[i] = header
+
+  def update_msgs(self, cur_time, msgs):
+    """Update from already decoded Events, same as SubMaster.update_msgs"""
+    self._new_frame(cur_time)
+    for msg in msgs:
+      if msg is None:
+        continue
+
+      s = msg.which()
+      i = self._idx[s]
+      self._mark_received(i, cur_time)
+      self.data[s] = getattr(msg, s)
+      self._raw[i] = None
+      self._log_mono_time[i] = msg.logMonoTime
+      self._valid[i] = msg.valid
+
+  def all_alive(self, service_list=None):
+    if service_list is None:  # check all
+      idxs = self._alive_check_idx
+    else:
+      idxs = [self._idx[s] for s in service_list if s not in self.ignore_alive]
+    cur_time, rcv_time, window = self._cur_time, self._rcv_time, self._alive_window
+    return all((cur_time - rcv_time[i]) < window[i] for i in idxs)
+
+  def all_valid(self, service_list=None):
+    if service_list is None:  # check all
+      return all(self._valid)
+    return all(self._valid[self._idx[s]] for s in service_list)
+
+  def all_alive_and_valid(self, service_list=None):
+    return self.all_alive(service_list=service_list) and self.all_valid(service_list=service_list)
+
+
 class PubMaster():
   def __init__(self, services):
     self.sock = {}
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Compares SubMaster and LazySubMaster on a simulated 100 Hz controlsd-like loop.
+# No sockets are involved, messages are fed through update_msgs/update_raw.
+import time
+
+from cereal import log
+import cereal.messaging as messaging
+from cereal.services import service_list
+
+SERVICES = ['thermal', 'health', 'liveCalibration', 'driverMonitoring', 'plan', 'pathPlan',
+            'model', 'gpsLocation', 'carState', 'radarState']
+READ = ['thermal', 'pathPlan', 'plan', 'liveCalibration']  # read every frame, like controlsd
+LOOP_FREQ = 100.
+SECONDS = 60
+
+
+def make_frames():
+  raw = {}
+  for s in SERVICES:
+    dat = messaging.new_message()
+    dat.init(s)
+    raw[s] = dat.to_bytes()
+
+  frames = []
+  for frame in range(int(SECONDS * LOOP_FREQ)):
+    frames.append([s for s in SERVICES if frame % max(1, int(LOOP_FREQ / service_list[s].frequency)) == 0])
+  return raw, frames
+
+
+def run(sm, raw, frames, lazy):
+  t = time.perf_counter()
+  for frame, services in enumerate(frames):
+    cur_time = frame / LOOP_FREQ
+    if lazy:
+      sm.update_raw(cur_time, [(s, raw[s]) for s in services])
+    else:
+      sm.update_msgs(cur_time, [log.Event.from_bytes(raw[s]) for s in services])
+
+    for s in READ:
+      sm[s]
+    if sm.updated['model']:
+      sm['model']
+    sm.all_alive_and_valid()
+  return (time.perf_counter() - t) / len(frames)
+
+
+if __name__ == "__main__":
+  raw, frames = make_frames()
+  ignore_alive = ['gpsLocation']
+  eager = run(messaging.SubMaster(SERVICES, ignore_alive=ignore_alive, addr=None), raw, frames, False)
+  lazy = run(messaging.LazySubMaster(SERVICES, ignore_alive=ignore_alive, addr=None), raw, frames, True)
+
+  print("%d services, %d frames at %d Hz" % (len(SERVICES), len(frames), LOOP_FREQ))
+  print("SubMaster:     %6.1f us/frame" % (eager * 1e6))
+  print("LazySubMaster: %6.1f us/frame (%.2fx)" % (lazy * 1e6, eager / lazy))
@@ -3,8 +3,13 @@
 
 import sys
 from libcpp.string cimport string
+from libcpp.vector cimport vector
 from libcpp cimport bool
 from libc cimport errno
+from libc.string cimport memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython cimport array
+import array
 
 
 from messaging cimport Context as cppContext
@@ -22,6 +27,41 @@ class MultiplePublishersError(MessagingError):
   pass
 
 
+cdef array.array OFFSETS_TEMPLATE = array.array('Q', [])
+
+
+cdef class MessageBatch:
+  """Messages stored back to back in a single buffer,
+  message i is data[offsets[i]:offsets[i+1]]"""
+  cdef public bytes data
+  cdef public array.array offsets
+
+  def __init__(self, bytes data=b"", array.array offsets=None):
+    self.data = data
+    self.offsets = offsets if offsets is not None else array.array('Q', [0])
+
+  @staticmethod
+  def from_messages(msgs):
+    offsets = array.array('Q', [0])
+    for m in msgs:
+      offsets.append(offsets[-1] + len(m))
+    return MessageBatch(b"".join(msgs), offsets)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, int i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError
+    return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.data[self.offsets[i]:self.offsets[i + 1]]
+
+
 cdef class Context:
   cdef cppContext * context
 
@@ -119,6 +159,43 @@ cdef class SubSocket:
 
       return m
 
+  def receive_many(self, bool wait_for_one=False):
+    """Receive all messages currently available on the queue into one MessageBatch"""
+    cdef vector[cppMessage*] msgs
+    cdef cppMessage * msg
+    cdef size_t total = 0
+    cdef size_t pos = 0
+    cdef size_t sz
+    cdef size_t i
+    cdef bytes dat
+    cdef char * buf
+    cdef array.array offsets
+
+    while True:
+      msg = self.socket.receive(not (wait_for_one and msgs.empty()))
+      if msg == NULL:
+        break
+      msgs.push_back(msg)
+      total += msg.getSize()
+
+    if msgs.empty() and wait_for_one and errno.errno == errno.EINTR:
+      print("SIGINT received, exiting")
+      sys.exit(1)
+
+    dat = PyBytes_FromStringAndSize(NULL, total)
+    buf = PyBytes_AS_STRING(dat)
+    offsets = array.clone(OFFSETS_TEMPLATE, msgs.size() + 1, zero=False)
+
+    for i in range(msgs.size()):
+      offsets.data.as_ulonglongs[i] = pos
+      sz = msgs[i].getSize()
+      memcpy(buf + pos, msgs[i].getData(), sz)
+      pos += sz
+      del msgs[i]
+    offsets.data.as_ulonglongs[msgs.size()] = pos
+
+    return MessageBatch(dat, offsets)
+
 
 cdef class PubSocket:
   cdef cppPubSocket * socket
@@ -0,0 +1,44 @@
+import random
+import unittest
+
+from cereal import log
+import cereal.messaging as messaging
+
+SERVICES = ['thermal', 'health', 'model', 'plan', 'gpsLocation']
+
+
+def random_msg(s):
+  dat = messaging.new_message()
+  dat.init(s)
+  dat.logMonoTime = random.getrandbits(64)
+  dat.valid = random.random() > 0.2
+  return dat.to_bytes()
+
+
+class TestSubMaster(unittest.TestCase):
+  def test_peek_event_header(self):
+    for _ in range(100):
+      dat = log.Event.from_bytes(random_msg(random.choice(SERVICES)))
+      self.assertEqual(messaging.peek_event_header(dat.as_builder().to_bytes()), (dat.logMonoTime, dat.valid))
+
+  def test_lazy_matches_eager(self):
+    sm = messaging.SubMaster(SERVICES, ignore_alive=['gpsLocation'], addr=None)
+    lazy_sm = messaging.LazySubMaster(SERVICES, ignore_alive=['gpsLocation'], addr=None)
+
+    for frame in range(500):
+      cur_time = frame * 0.01
+      raw = [(s, random_msg(s)) for s in SERVICES if random.random() < 0.3]
+      sm.update_msgs(cur_time, [log.Event.from_bytes(dat) for _, dat in raw])
+      lazy_sm.update_raw(cur_time, raw)
+
+      self.assertEqual(sm.frame, lazy_sm.frame)
+      for attr in ['updated', 'alive', 'valid', 'logMonoTime', 'rcv_time', 'rcv_frame']:
+        self.assertEqual(dict(getattr(sm, attr)), dict(getattr(lazy_sm, attr)), attr)
+      self.assertEqual(sm.all_alive_and_valid(), lazy_sm.all_alive_and_valid())
+      self.assertEqual(sm.all_alive_and_valid(['model', 'plan']), lazy_sm.all_alive_and_valid(['model', 'plan']))
+      for s in SERVICES:
+        self.assertEqual(sm[s].to_dict(), lazy_sm[s].to_dict())
+
+
+if __name__ == "__main__":
+  unittest.main()
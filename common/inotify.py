@@ -0,0 +1,99 @@
+"""Minimal inotify bindings using ctypes.
+
+available() returns False on platforms without inotify, callers are expected to fall back
+to polling in that case.
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct("iIII")
+
+try:
+  _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  _inotify_init1 = _libc.inotify_init1
+  _inotify_add_watch = _libc.inotify_add_watch
+  _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+  _inotify_rm_watch = _libc.inotify_rm_watch
+except (OSError, AttributeError, TypeError):
+  _libc = None
+
+
+def available():
+  return _libc is not None
+
+
+class Watcher():
+  def __init__(self):
+    if _libc is None:
+      raise OSError(errno.ENOSYS, "inotify not available")
+
+    self._fd = _inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self._fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    self._paths = {}
+
+  def fileno(self):
+    return self._fd
+
+  def add_watch(self, path, mask):
+    wd = _inotify_add_watch(self._fd, os.fsencode(path), mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    self._paths[wd] = path
+    return wd
+
+  def rm_watch(self, wd):
+    self._paths.pop(wd, None)
+    _inotify_rm_watch(self._fd, wd)
+
+  def read(self, timeout=None):
+    """Wait up to timeout seconds for events. Returns a list of (watched path, mask, name)"""
+    r, _, _ = select.select([self._fd], [], [], timeout)
+    if not r:
+      return []
+
+    try:
+      buf = os.read(self._fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    events = []
+    pos = 0
+    while pos + _EVENT.size <= len(buf):
+      wd, mask, _, name_len = _EVENT.unpack_from(buf, pos)
+      pos += _EVENT.size
+      name = buf[pos:pos + name_len].rstrip(b"\0").decode("utf8", "replace")
+      pos += name_len
+      events.append((self._paths.get(wd), mask, name))
+      if mask & IN_IGNORED:
+        # watch removed by the kernel, e.g. the directory was deleted
+        self._paths.pop(wd, None)
+    return events
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
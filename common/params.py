@@ -2,9 +2,9 @@
 """ROS has a parameter server, we have files.
 
 The parameter store is a persistent key value store, implemented as a directory with a writer lock.
-On Android, we store params under params_dir = /data/params. The writer lock is a file
-"<params_dir>/.lock" taken using flock(), and data is stored in a directory symlinked to by
-"<params_dir>/d".
+On Android, we store params under params_dir = /data/params, $PARAMS_PATH overrides it. The writer
+lock is a file "<params_dir>/.lock" taken using flock(), and data is stored in a directory
+symlinked to by "<params_dir>/d".
 
 Each key, value pair is stored as a file with named <key> with contents <value>, located in
   <params_dir>/d/<key>
@@ -19,16 +19,28 @@ before deleting the old <params_dir>/<d> directory.
 
 Writers that only modify a single key can simply take the lock, then swap the corresponding value
 file in place without messing with <params_dir>/d.
+
+Every writer also increments the 64 bit counter in "<params_dir>/.generation" after its changes are
+in place, while still holding the lock. Processes keep a cache of the values they read, which is
+dropped whenever the counter changes. The counter is mmap'd, so a cached read is just a memory
+access. Blocking reads wait for the counter to change using inotify instead of polling.
 """
 import time
 import os
 import errno
 import sys
+import mmap
+import atexit
+import traceback
 import shutil
 import fcntl
+import struct
 import tempfile
 import threading
 from enum import Enum
+from collections import OrderedDict
+
+from common import inotify
 
 
 def mkdirs_exists_ok(path):
@@ -101,6 +113,18 @@ keys = {
 }
 
 
+GENERATION_FILE = ".generation"
+DEFAULT_PARAMS_PATH = "/data/params"
+_GENERATION = struct.Struct("<Q")
+# bound on the granularity of file timestamps
+_MTIME_RESOLUTION_NS = 100 * 1000 * 1000
+
+
+def default_params_path():
+  # same override as selfdrive/common/params.cc
+  return os.environ.get("PARAMS_PATH", DEFAULT_PARAMS_PATH)
+
+
 def fsync_dir(path):
   fd = os.open(path, os.O_RDONLY)
   try:
@@ -109,6 +133,26 @@ def fsync_dir(path):
     os.close(fd)
 
 
+def bump_generation(params_path):
+  """Callers should hold the lock."""
+  fd = os.open(os.path.join(params_path, GENERATION_FILE), os.O_RDWR | os.O_CREAT, 0o666)
+  try:
+    dat = os.pread(fd, _GENERATION.size, 0)
+    gen = _GENERATION.unpack(dat)[0] if len(dat) == _GENERATION.size else 0
+    os.pwrite(fd, _GENERATION.pack((gen + 1) % (1 << 64)), 0)
+  finally:
+    os.close(fd)
+
+
+def _try_link(src, dst):
+  # os.link is missing on NEOS
+  try:
+    os.link(src, dst)
+    return True
+  except (AttributeError, OSError):
+    return False
+
+
 class FileLock():
   def __init__(self, path, create):
     self._path = path
@@ -196,12 +240,22 @@ class DBWriter(DBAccessor):
     super(DBWriter, self).__init__(path)
     self._lock = None
     self._prev_umask = None
+    self._dirty = set()
+    self._deleted = set()
 
   def put(self, key, value):
-    self._vals[key] = value
+    self._check_entered()
+    if self._vals.get(key) != value:
+      self._vals[key] = value
+      self._dirty.add(key)
+      self._deleted.discard(key)
 
   def delete(self, key):
-    self._vals.pop(key, None)
+    self._check_entered()
+    if key in self._vals:
+      del self._vals[key]
+      self._dirty.discard(key)
+      self._deleted.add(key)
 
   def __enter__(self):
     mkdirs_exists_ok(self._path)
@@ -224,6 +278,10 @@ class DBWriter(DBAccessor):
     self._check_entered()
 
     try:
+      # Nothing changed, no need to rewrite anything.
+      if not self._dirty and not self._deleted and os.path.isdir(self._data_path()):
+        return
+
       # data_path refers to the externally used path to the params. It is a symlink.
       # old_data_path is the path currently pointed to by data_path.
       # tempdir_path is a path where the new params will go, which the new data path will point to.
@@ -237,20 +295,12 @@ class DBWriter(DBAccessor):
       #   new_data_path -> tempdir_path
       # Then atomically overwrite data_path with new_data_path
       #   data_path -> tempdir_path
+      # Only the changed keys are written, unchanged ones are hardlinked from old_data_path.
       old_data_path = None
       new_data_path = None
       tempdir_path = tempfile.mkdtemp(prefix=".tmp", dir=self._path)
 
       try:
-        # Write back all keys.
-        os.chmod(tempdir_path, 0o777)
-        for k, v in self._vals.items():
-          with open(os.path.join(tempdir_path, k), "wb") as f:
-            f.write(v)
-            f.flush()
-            os.fsync(f.fileno())
-        fsync_dir(tempdir_path)
-
         data_path = self._data_path()
         try:
           old_data_path = os.path.join(self._path, os.readlink(data_path))
@@ -259,10 +309,24 @@ class DBWriter(DBAccessor):
           #                 copies to be left behind, but we still want to overwrite.
           pass
 
+        # Write back all keys.
+        os.chmod(tempdir_path, 0o777)
+        for k, v in self._vals.items():
+          path = os.path.join(tempdir_path, k)
+          if k not in self._dirty and old_data_path is not None and _try_link(os.path.join(old_data_path, k), path):
+            continue
+
+          with open(path, "wb") as f:
+            f.write(v)
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_dir(tempdir_path)
+
         new_data_path = "{}.link".format(tempdir_path)
         os.symlink(os.path.basename(tempdir_path), new_data_path)
         os.rename(new_data_path, data_path)
         fsync_dir(self._path)
+        bump_generation(self._path)
       finally:
         # If the rename worked, we can delete the old data. Otherwise delete the new one.
         success = new_data_path is not None and os.path.exists(data_path) and (
@@ -312,19 +376,131 @@ def write_db(params_path, key, value):
     path = "%s/d/%s" % (params_path, key)
     os.rename(tmp_path, path)
     fsync_dir(os.path.dirname(path))
+    bump_generation(params_path)
   finally:
     os.umask(prev_umask)
     lock.release()
 
+class ParamsCache():
+  """Values read by this process, valid as long as the generation counter and the data dir
+  don't change. Not every writer bumps the generation, but every writer renames a file into
+  the data dir or swaps the d symlink, which changes its mtime or inode."""
+  def __init__(self, params_path):
+    self._path = params_path
+    self._lock = threading.Lock()
+    self._vals = {}
+    self._gen = None
+    self._mm = None
+    self._ino = None
+
+  def reopen(self):
+    """Map the generation file, again if the params dir was recreated since."""
+    path = os.path.join(self._path, GENERATION_FILE)
+    prev_umask = os.umask(0)
+    try:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    except OSError:
+      # Can't share a counter, don't cache anything
+      fd = None
+    finally:
+      os.umask(prev_umask)
+
+    with self._lock:
+      if fd is None:
+        self._mm, self._ino = None, None
+        return
+
+      try:
+        ino = os.fstat(fd).st_ino
+        if self._mm is not None and ino == self._ino:
+          return
+
+        if os.fstat(fd).st_size < _GENERATION.size:
+          os.ftruncate(fd, _GENERATION.size)
+        self._mm = mmap.mmap(fd, _GENERATION.size, access=mmap.ACCESS_READ)
+        self._ino = ino
+        self._vals = {}
+        self._gen = None
+      finally:
+        os.close(fd)
+
+  def generation(self):
+    if self._mm is None:
+      return None
+    return _GENERATION.unpack_from(self._mm, 0)[0]
+
+  def version(self):
+    """The generation with the inode and mtime of the data dir, None if unknown"""
+    gen = self.generation()
+    if gen is None:
+      return None
+    try:
+      st = os.stat(os.path.join(self._path, "d"))
+    except OSError:
+      return None
+    return gen, st.st_ino, st.st_mtime_ns
+
+  def get(self, key):
+    gen = self.version()
+    if gen is None:
+      return read_db(self._path, key)
+
+    with self._lock:
+      if gen != self._gen:
+        self._vals = {}
+        self._gen = gen
+      elif key in self._vals:
+        return self._vals[key]
+
+    # A writer might change the version while we read, only keep the value if it didn't.
+    # mtimes come from a coarse clock, a write right after this one could keep the same
+    # mtime, so the data dir must be older than that before values are kept
+    val = read_db(self._path, key)
+    with self._lock:
+      if gen == self._gen and time.time() * 1e9 - gen[2] > _MTIME_RESOLUTION_NS:
+        self._vals[key] = val
+    return val
+
+  def wait_for_change(self, gen, timeout):
+    """Block until the version differs from gen, or timeout seconds have passed."""
+    if gen is None or not inotify.available():
+      time.sleep(min(timeout, 0.05))
+      return
+
+    deadline = time.monotonic() + timeout
+    with inotify.Watcher() as watcher:
+      watcher.add_watch(self._path, inotify.IN_MODIFY | inotify.IN_MOVED_TO | inotify.IN_CREATE)
+      while self.version() == gen:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        watcher.read(remaining)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _get_cache(params_path):
+  params_path = os.path.realpath(params_path)
+  with _caches_lock:
+    if params_path not in _caches:
+      _caches[params_path] = ParamsCache(params_path)
+    cache = _caches[params_path]
+  cache.reopen()
+  return cache
+
+
 class Params():
-  def __init__(self, db='/data/params'):
-    self.db = db
+  def __init__(self, db=None):
+    self.db = db if db is not None else default_params_path()
 
     # create the database if it doesn't exist...
     if not os.path.exists(self.db+"/d"):
       with self.transaction(write=True):
         pass
 
+    self._cache = _get_cache(self.db)
+
   def transaction(self, write=False):
     if write:
       return DBWriter(self.db)
@@ -351,12 +527,14 @@ class Params():
     if key not in keys:
       raise UnknownKeyName(key)
 
-    while 1:
+    ret = self._cache.get(key)
+    while block and ret is None:
+      # read the file itself, a writer might have swapped d between our version checks
+      # and wait for the next write, at most a second
+      gen = self._cache.version()
       ret = read_db(self.db, key)
-      if not block or ret is not None:
-        break
-      # is polling really the best we can do?
-      time.sleep(0.05)
+      if ret is None:
+        self._cache.wait_for_change(gen, 1.)
 
     if ret is not None and encoding is not None:
       ret = ret.decode(encoding)
@@ -378,14 +556,100 @@ class Params():
     write_db(self.db, key, dat)
 
 
-def put_nonblocking(key, val):
-  def f(key, val):
-    params = Params()
-    params.put(key, val)
+class ParamsWriter():
+  """Writes params in a single background thread.
+
+  Writes to a key that is still queued replace the queued value, so only the
+  latest value gets written and fsynced. put() blocks when max_pending different
+  keys are waiting to be written.
+  """
+  def __init__(self, db=None, max_pending=len(keys)):
+    self.db = db if db is not None else default_params_path()
+    self.max_pending = max_pending
+    self._pid = None
+    self._init()
+
+  def _init(self):
+    # threads don't survive a fork, the child starts with an empty queue
+    self._pid = os.getpid()
+    self._cv = threading.Condition()
+    self._pending = OrderedDict()
+    self._writing = False
+    self._thread = None
+
+  def put(self, key, dat):
+    if key not in keys:
+      raise UnknownKeyName(key)
+
+    if self._pid != os.getpid():
+      self._init()
+
+    with self._cv:
+      self._cv.wait_for(lambda: key in self._pending or len(self._pending) < self.max_pending)
+      self._pending[key] = dat
+      self._cv.notify_all()
+
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._writer_thread, name="params_writer", daemon=True)
+        self._thread.start()
+
+  def flush(self, timeout=None):
+    """Wait until everything queued so far is written. Returns False on timeout."""
+    if self._pid != os.getpid():
+      return True
+
+    with self._cv:
+      return self._cv.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+  def _writer_thread(self):
+    params = Params(self.db)
+    while True:
+      with self._cv:
+        self._cv.wait_for(lambda: self._pending)
+        key, dat = self._pending.popitem(last=False)
+        self._writing = True
+        self._cv.notify_all()
+
+      try:
+        params.put(key, dat)
+      except Exception:
+        traceback.print_exc()
+      finally:
+        with self._cv:
+          self._writing = False
+          self._cv.notify_all()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _get_writer(db):
+  if db is None:
+    db = default_params_path()
+
+  with _writers_lock:
+    if db not in _writers:
+      _writers[db] = ParamsWriter(db)
+    return _writers[db]
+
+def put_nonblocking(key, val, db=None):
+  """Queue a write to the background writer thread of this process."""
+  _get_writer(db).put(key, val)
+
+def flush_nonblocking(timeout=None):
+  """Wait until all writes queued by put_nonblocking are on disk. Returns False on timeout."""
+  with _writers_lock:
+    writers = list(_writers.values())
+
+  deadline = None if timeout is None else time.monotonic() + timeout
+  for writer in writers:
+    remaining = None if deadline is None else max(0., deadline - time.monotonic())
+    if not writer.flush(remaining):
+      return False
+  return True
 
-  t = threading.Thread(target=f, args=(key, val))
-  t.start()
-  return t
+# don't drop queued writes when the process exits normally
+atexit.register(flush_nonblocking, 5.)
 
 
 if __name__ == "__main__":
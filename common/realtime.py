@@ -1,5 +1,6 @@
 """Utilities for reading real time clocks and keeping soft real time constraints."""
 import os
+import math
 import time
 import platform
 import subprocess
@@ -36,15 +37,125 @@ def set_realtime_priority(level):
   return subprocess.call(['chrt', '-f', '-p', str(level), str(tid)])
 
 
+def report_first_loop():
+  """Logs the time from the manager starting this process to the end of its first loop.
+  The launcher puts the start time in LAUNCH_TIME, only the first call logs."""
+  launch_time = os.environ.pop("LAUNCH_TIME", None)
+  if launch_time is not None:
+    from selfdrive.swaglog import cloudlog
+    cloudlog.event("first_loop", proc=multiprocessing.current_process().name,
+                   time_to_first_loop=sec_since_boot() - float(launch_time))
+
+
+class LatencyHistogram():
+  """Histogram of durations in fixed memory, with log buckets like HdrHistogram. Durations are
+  kept in microseconds with SIGNIFICANT_BITS bits of precision, a percentile is off by less
+  than 1/64 of its value. Longer than MAX_US goes in the last bucket."""
+  SIGNIFICANT_BITS = 7
+  MAX_US = 1 << 27  # ~134s
+
+  def __init__(self):
+    self._sub_buckets = 1 << self.SIGNIFICANT_BITS
+    self._half = self._sub_buckets // 2
+    self.counts = [0] * (self._bucket(self.MAX_US - 1) + 1)
+    self.count = 0
+    self.max = 0.
+
+  def _bucket(self, us):
+    # exact below _sub_buckets, then _half buckets per power of two
+    if us < self._sub_buckets:
+      return us
+    shift = us.bit_length() - self.SIGNIFICANT_BITS
+    return self._sub_buckets + (shift - 1) * self._half + (us >> shift) - self._half
+
+  def _bucket_max(self, i):
+    # highest value that falls in bucket i
+    if i < self._sub_buckets:
+      return i
+    shift, sub = divmod(i - self._sub_buckets, self._half)
+    return ((sub + self._half + 1) << (shift + 1)) - 1
+
+  def record(self, t):
+    """Adds a duration in seconds, negative ones count as 0"""
+    us = min(max(int(t * 1e6), 0), self.MAX_US - 1)
+    self.counts[self._bucket(us)] += 1
+    self.count += 1
+    self.max = max(self.max, t)
+
+  def percentile(self, p):
+    """Duration in seconds that p percent of the recorded ones don't exceed"""
+    if self.count == 0:
+      return 0.
+    rank = max(1, math.ceil(p / 100. * self.count))
+    seen = 0
+    for i, c in enumerate(self.counts):
+      seen += c
+      if seen >= rank:
+        # the last bucket also holds everything past MAX_US
+        return self.max if i == len(self.counts) - 1 else min(self._bucket_max(i) * 1e-6, self.max)
+    return self.max
+
+
+class LoopStats():
+  """Loop time and lag histograms of a process loop. A loop misses when it lags, or when it
+  takes longer than budget if the lag isn't known. The percentiles since the start are logged
+  with cloudlog every log_interval seconds."""
+  PERCENTILES = [50., 90., 99., 99.9]
+
+  def __init__(self, budget, log_interval=60.):
+    self.budget = budget
+    self.loop_time = LatencyHistogram()
+    self.lag = LatencyHistogram()
+    self.misses = 0
+
+    self._process_name = multiprocessing.current_process().name
+    self._log_interval = log_interval
+    # seeded by the first update, on the clock of its cur_time
+    self._next_log_time = None
+
+  def update(self, loop_time, lag=None, cur_time=None):
+    self.loop_time.record(loop_time)
+    if lag is None:
+      self.misses += loop_time > self.budget
+    else:
+      self.lag.record(lag)
+      self.misses += lag > 0
+
+    if self._log_interval is not None:
+      cur_time = sec_since_boot() if cur_time is None else cur_time
+      if self._next_log_time is None:
+        self._next_log_time = cur_time + self._log_interval
+      elif cur_time >= self._next_log_time:
+        self._next_log_time = cur_time + self._log_interval
+        self.log()
+
+  def stats(self):
+    """Percentiles and max of the loop time and the lag in ms, as loop_p99_9_ms etc."""
+    ret = {'frames': self.loop_time.count, 'misses': self.misses}
+    for name, hist in [('loop', self.loop_time), ('lag', self.lag)]:
+      for p in self.PERCENTILES:
+        ret['%s_p%s_ms' % (name, ('%g' % p).replace('.', '_'))] = hist.percentile(p) * 1000.
+      ret['%s_max_ms' % name] = hist.max * 1000.
+    return ret
+
+  def log(self):
+    from selfdrive.swaglog import cloudlog
+    cloudlog.event("loop_stats", proc=self._process_name, **self.stats())
+
+
 class Ratekeeper():
-  def __init__(self, rate, print_delay_threshold=0.):
-    """Rate in Hz for ratekeeping. print_delay_threshold must be nonnegative."""
+  def __init__(self, rate, print_delay_threshold=0., stats_log_interval=60., clock=None):
+    """Rate in Hz for ratekeeping. print_delay_threshold must be nonnegative.
+    clock returns the current time in seconds, sec_since_boot by default."""
+    self._clock = sec_since_boot if clock is None else clock
     self._interval = 1. / rate
-    self._next_frame_time = sec_since_boot() + self._interval
+    self._next_frame_time = self._clock() + self._interval
     self._print_delay_threshold = print_delay_threshold
     self._frame = 0
     self._remaining = 0
     self._process_name = multiprocessing.current_process().name
+    self._loop_start = self._clock()
+    self.stats = LoopStats(self._interval, stats_log_interval)
 
   @property
   def frame(self):
@@ -59,16 +170,25 @@ class Ratekeeper():
     lagged = self.monitor_time()
     if self._remaining > 0:
       time.sleep(self._remaining)
+    self._loop_start = self._clock()
     return lagged
 
   # this only monitor the cumulative lag, but does not enforce a rate
-  def monitor_time(self):
+  # loop_start is when the work of this frame started, by default the end of the last frame
+  def monitor_time(self, loop_start=None):
     lagged = False
-    remaining = self._next_frame_time - sec_since_boot()
+    cur_time = self._clock()
+    remaining = self._next_frame_time - cur_time
     self._next_frame_time += self._interval
     if self._print_delay_threshold is not None and remaining < -self._print_delay_threshold:
       print("%s lagging by %.2f ms" % (self._process_name, -remaining * 1000))
       lagged = True
     self._frame += 1
     self._remaining = remaining
+
+    # the lag of a frame is how much it overran the interval. remaining is the drift since the
+    # start, in loops paced by their input that is the drift of the input clock
+    loop_time = cur_time - (self._loop_start if loop_start is None else loop_start)
+    self.stats.update(loop_time, max(0., loop_time - self._interval), cur_time)
+    self._loop_start = cur_time
     return lagged
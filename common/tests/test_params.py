@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+import tempfile
+import shutil
+import unittest
+
+from common.params import Params, ParamsWriter, UnknownKeyName, put_nonblocking, flush_nonblocking
+
+
+class TestParams(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.params = Params(self.tmpdir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_params_put_and_get(self):
+    self.params.put("DongleId", "cb38263377b873ee")
+    assert self.params.get("DongleId") == b"cb38263377b873ee"
+
+  def test_params_non_ascii(self):
+    st = b"\xe1\x90\xff"
+    self.params.put("CarParams", st)
+    assert self.params.get("CarParams") == st
+
+  def test_params_get_cleared_manager_start(self):
+    self.params.put("CarParams", "test")
+    self.params.put("DongleId", "cb38263377b873ee")
+    assert self.params.get("CarParams") == b"test"
+    self.params.manager_start()
+    assert self.params.get("CarParams") is None
+    assert self.params.get("DongleId") is not None
+
+  def test_params_two_things(self):
+    self.params.put("DongleId", "bob")
+    self.params.put("AthenadPid", "123")
+    assert self.params.get("DongleId") == b"bob"
+    assert self.params.get("AthenadPid") == b"123"
+
+  def test_params_get_block(self):
+    def _delayed_writer():
+      time.sleep(0.1)
+      Params(self.tmpdir).put("CarParams", "test")
+    threading.Thread(target=_delayed_writer).start()
+    t = time.monotonic()
+    assert self.params.get("CarParams", block=True) == b"test"
+    assert time.monotonic() - t < 0.5
+
+  def test_params_unknown_key_fails(self):
+    with self.assertRaises(UnknownKeyName):
+      self.params.get("swag")
+
+  def test_params_cache_sees_other_writers(self):
+    other = Params(self.tmpdir)
+    self.params.put("DongleId", "a")
+    assert other.get("DongleId") == b"a"
+    other.put("DongleId", "b")
+    assert self.params.get("DongleId") == b"b"
+    other.delete("DongleId")
+    assert self.params.get("DongleId") is None
+
+  def test_params_cache_sees_writers_without_generation(self):
+    # the offroad apk renames values into d without bumping the generation
+    self.params.put("HasAcceptedTerms", "0")
+    time.sleep(0.2)
+    assert self.params.get("HasAcceptedTerms") == b"0"
+    assert "HasAcceptedTerms" in self.params._cache._vals
+
+    tmp_path = os.path.join(self.tmpdir, ".tmp_param_test")
+    with open(tmp_path, "wb") as f:
+      f.write(b"1")
+    os.rename(tmp_path, os.path.join(self.tmpdir, "d", "HasAcceptedTerms"))
+    assert self.params.get("HasAcceptedTerms") == b"1"
+
+  def test_transaction_only_writes_dirty_keys(self):
+    self.params.put("DongleId", "a")
+    self.params.put("AthenadPid", "1")
+    data_path = os.path.join(self.tmpdir, "d")
+    ino = os.stat(os.path.join(data_path, "DongleId")).st_ino
+
+    with self.params.transaction(write=True) as txn:
+      txn.put("AthenadPid", b"2")
+
+    assert os.stat(os.path.join(data_path, "DongleId")).st_ino == ino
+    assert self.params.get("AthenadPid") == b"2"
+    assert self.params.get("DongleId") == b"a"
+
+  def test_params_recreated_dir(self):
+    self.params.put("DongleId", "a")
+    assert self.params.get("DongleId") == b"a"
+    shutil.rmtree(self.tmpdir)
+    assert Params(self.tmpdir).get("DongleId") is None
+
+  def test_put_nonblocking(self):
+    put_nonblocking("DongleId", "a", db=self.tmpdir)
+    assert flush_nonblocking(timeout=5)
+    assert self.params.get("DongleId") == b"a"
+
+  def test_writer_coalesces(self):
+    writer = ParamsWriter(self.tmpdir)
+    writes = []
+    put = Params.put
+    def slow_put(params, key, dat):
+      writes.append((key, dat))
+      time.sleep(0.01)
+      put(params, key, dat)
+
+    Params.put = slow_put
+    try:
+      for i in range(100):
+        writer.put("AthenadPid", str(i))
+      assert writer.flush(timeout=5)
+    finally:
+      Params.put = put
+
+    assert len(writes) < 100
+    assert writes[-1] == ("AthenadPid", "99")
+    assert self.params.get("AthenadPid") == b"99"
+
+  def test_writer_unknown_key_fails(self):
+    with self.assertRaises(UnknownKeyName):
+      ParamsWriter(self.tmpdir).put("swag", "1")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+
+from common.realtime import LatencyHistogram, LoopStats, Ratekeeper
+
+
+class TestLatencyHistogram(unittest.TestCase):
+  def test_percentiles(self):
+    np.random.seed(0)
+    durations = np.random.lognormal(np.log(5e-3), 1., 100000)
+    hist = LatencyHistogram()
+    for t in durations:
+      hist.record(t)
+
+    self.assertEqual(hist.count, len(durations))
+    self.assertEqual(hist.max, durations.max())
+    durations.sort()
+    for p in [0., 50., 90., 99., 99.9, 100.]:
+      # nearest rank
+      expected = durations[max(1, int(np.ceil(p / 100. * len(durations)))) - 1]
+      # a bucket is at most 1/64 of its values wide, plus the truncation to us
+      self.assertAlmostEqual(hist.percentile(p), expected, delta=expected / 64. + 1e-6)
+
+  def test_range(self):
+    hist = LatencyHistogram()
+    self.assertEqual(hist.percentile(99.), 0.)
+    hist.record(-1.)
+    hist.record(1e-6)
+    hist.record(1e3)
+    self.assertEqual(sum(hist.counts), 3)
+    self.assertEqual(hist.percentile(0.), 0.)
+    self.assertEqual(hist.percentile(50.), 1e-6)
+    self.assertEqual(hist.percentile(100.), 1e3)
+
+
+class TestLoopStats(unittest.TestCase):
+  def test_misses(self):
+    stats = LoopStats(0.01, log_interval=None)
+    for t in [0.005, 0.02, 0.009, 0.011]:
+      stats.update(t)
+    self.assertEqual(stats.misses, 2)
+
+    # with the lag known, only lagging loops miss
+    stats = LoopStats(0.01, log_interval=None)
+    for t, lag in [(0.02, -0.01), (0.005, 0.002), (0.005, -0.005)]:
+      stats.update(t, lag)
+    self.assertEqual(stats.misses, 1)
+
+    s = stats.stats()
+    self.assertEqual(s['frames'], 3)
+    self.assertAlmostEqual(s['lag_max_ms'], 2.)
+    self.assertAlmostEqual(s['loop_p99_9_ms'], 20., delta=20. / 64.)
+
+
+class TestRatekeeper(unittest.TestCase):
+  def test_clock(self):
+    t = [100.]
+    rk = Ratekeeper(100, print_delay_threshold=None, stats_log_interval=None, clock=lambda: t[0])
+    for _ in range(10):
+      t[0] += 0.01
+      rk.monitor_time()
+    self.assertEqual(rk.frame, 10)
+    self.assertAlmostEqual(rk.remaining, 0.)
+
+    # a frame 30ms late lags by 30ms, however long it took on the wall clock
+    t[0] += 0.04
+    rk.monitor_time()
+    self.assertAlmostEqual(rk.remaining, -0.03)
+    self.assertAlmostEqual(rk.stats.stats()['lag_max_ms'], 30., delta=30. / 64.)
+
+  def test_drift(self):
+    # paced by an input that started 1s late, every frame takes 2ms of the 10ms
+    t = [100.]
+    rk = Ratekeeper(100, print_delay_threshold=None, stats_log_interval=None, clock=lambda: t[0])
+    t[0] += 1.
+    for _ in range(100):
+      loop_start = t[0]
+      t[0] += 0.002
+      rk.monitor_time(loop_start)
+      t[0] += 0.008
+    self.assertLess(rk.remaining, -0.9)
+    self.assertEqual(rk.stats.misses, 0)
+    self.assertEqual(rk.stats.stats()['lag_max_ms'], 0.)
+
+  def test_log_interval_on_clock(self):
+    t = [0.]
+    rk = Ratekeeper(100, print_delay_threshold=None, stats_log_interval=1., clock=lambda: t[0])
+    logs = []
+    rk.stats.log = lambda: logs.append(t[0])
+    for _ in range(250):
+      t[0] += 0.01
+      rk.monitor_time()
+    self.assertEqual(len(logs), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -55,6 +55,7 @@ public:
   void UpdateCans(uint64_t sec, const capnp::List<cereal::CanData>::Reader& cans);
   void UpdateValid(uint64_t sec);
   void update_string(std::string data, bool sendcan);
+  void update_buffer(const char *data, size_t len, bool sendcan);
   std::vector<SignalValue> query_latest();
 };
 
@@ -75,6 +75,7 @@ cdef extern from "common.h":
     bool can_valid
     CANParser(int, string, vector[MessageParseOptions], vector[SignalParseOptions])
     void update_string(string, bool)
+    void update_buffer(const char *, size_t, bool)
     vector[SignalValue] query_latest()
 
   cdef cppclass CANPacker:
@@ -2,9 +2,14 @@ import re
 import os
 import struct
 import sys
+import hashlib
 import numbers
+import pickle
+import tempfile
 from collections import namedtuple, defaultdict
 
+import numpy as np
+
 def int_or_float(s):
   # return number, trying to maintain int format
   if s.isdigit():
@@ -16,13 +21,97 @@ DBCSignal = namedtuple(
   "DBCSignal", ["name", "start_bit", "size", "is_little_endian", "is_signed",
                 "factor", "offset", "tmin", "tmax", "units"])
 
+# Parsed dbcs are pickled here, keyed by path. An entry is valid while the dbc has the
+# same mtime and size, or the same contents hash if those changed.
+DBC_CACHE_DIR = os.environ.get("DBC_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "dbc_cache"))
+DBC_CACHE_VERSION = 1
+
+
+def _cache_fn(fn, cache_dir):
+  path_hash = hashlib.sha1(os.path.realpath(fn).encode("utf8")).hexdigest()[:16]
+  name, _ = os.path.splitext(os.path.basename(fn))
+  return os.path.join(cache_dir, "%s_%s.pkl" % (name, path_hash))
+
+
+def _file_hash(fn):
+  with open(fn, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_cache(fn, cache_dir=DBC_CACHE_DIR):
+  """Returns the cached (msgs, def_vals) of the dbc or None if there is no valid entry"""
+  try:
+    st = os.stat(fn)
+    with open(_cache_fn(fn, cache_dir), "rb") as f:
+      version, mtime, size, file_hash, msgs, def_vals = pickle.load(f)
+  except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+    return None
+
+  if version != DBC_CACHE_VERSION:
+    return None
+  if (mtime, size) != (st.st_mtime_ns, st.st_size):
+    # touched or checked out again, still good if the contents are the same
+    if file_hash != _file_hash(fn):
+      return None
+    save_cache(fn, msgs, def_vals, cache_dir, file_hash)
+  return msgs, def_vals
+
+
+def save_cache(fn, msgs, def_vals, cache_dir=DBC_CACHE_DIR, file_hash=None):
+  try:
+    st = os.stat(fn)
+    if file_hash is None:
+      file_hash = _file_hash(fn)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write and rename, processes building in parallel might read it at the same time
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+      pickle.dump((DBC_CACHE_VERSION, st.st_mtime_ns, st.st_size, file_hash, msgs, def_vals), f,
+                  protocol=pickle.HIGHEST_PROTOCOL)
+    # NamedTemporaryFile is only readable by its owner
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, _cache_fn(fn, cache_dir))
+  except OSError:
+    # caching is best effort, e.g. read only filesystem
+    pass
+
+
+def build_cache(dbc_dir, cache_dir=DBC_CACHE_DIR):
+  """Parses every dbc in dbc_dir that isn't cached yet, returns the number of dbcs parsed"""
+  cnt = 0
+  for x in sorted(os.listdir(dbc_dir)):
+    fn = os.path.join(dbc_dir, x)
+    if x.endswith(".dbc") and load_cache(fn, cache_dir) is None:
+      dbc(fn, cache_dir=cache_dir)
+      cnt += 1
+  return cnt
+
 
 class dbc():
-  def __init__(self, fn):
+  def __init__(self, fn, cache_dir=DBC_CACHE_DIR):
+    """Parses the dbc in fn. Unless cache_dir is None, the result is loaded from or saved
+    to the cache there."""
     self.name, _ = os.path.splitext(os.path.basename(fn))
+    self._warned_addresses = set()
+
+    # lookup to bit reverse each byte
+    self.bits_index = [(i & ~0b111) + ((-i-1) & 0b111) for i in range(64)]
+
+    cached = load_cache(fn, cache_dir) if cache_dir is not None else None
+    if cached is not None:
+      self.msgs, self.def_vals = cached
+    else:
+      self._parse(fn)
+      if cache_dir is not None:
+        save_cache(fn, self.msgs, self.def_vals, cache_dir)
+
+    self.msg_name_to_address = {}
+    for address, m in self.msgs.items():
+      name = m[0][0]
+      self.msg_name_to_address[name] = address
+
+  def _parse(self, fn):
     with open(fn, encoding="ascii") as f:
       self.txt = f.readlines()
-    self._warned_addresses = set()
 
     # regexps from https://github.com/ebroecker/canmatrix/blob/master/canmatrix/importdbc.py
     bo_regexp = re.compile(r"^BO\_ (\w+) (\w+) *: (\w+) (\w+)")
@@ -40,9 +129,6 @@ class dbc():
     # A dictionary which maps message ids to a list of tuples (signal name, definition value pairs)
     self.def_vals = defaultdict(list)
 
-    # lookup to bit reverse each byte
-    self.bits_index = [(i & ~0b111) + ((-i-1) & 0b111) for i in range(64)]
-
     for l in self.txt:
       l = l.strip()
 
@@ -110,11 +196,6 @@ class dbc():
     for msg in self.msgs.values():
       msg[1].sort(key=lambda x: x.start_bit)
 
-    self.msg_name_to_address = {}
-    for address, m in self.msgs.items():
-      name = m[0][0]
-      self.msg_name_to_address[name] = address
-
   def lookup_msg_id(self, msg_id):
     if not isinstance(msg_id, numbers.Number):
       msg_id = self.msg_name_to_address[msg_id]
@@ -194,6 +275,7 @@ class dbc():
       out = {}
     else:
       out = [None]*len(arr)
+      arr_idx = {sig: i for i, sig in reversed(list(enumerate(arr)))}
 
     msg = self.msgs.get(x[0])
     if msg is None:
@@ -210,7 +292,7 @@ class dbc():
     le, be = None, None
 
     for s in msg[1]:
-      if arr is not None and s[0] not in arr:
+      if arr is not None and s[0] not in arr_idx:
         continue
 
       start_bit = s[1]
@@ -247,29 +329,154 @@ class dbc():
       if arr is None:
         out[s[0]] = tmp
       else:
-        out[arr.index(s[0])] = tmp
+        out[arr_idx[s[0]]] = tmp
     return name, out
 
+  def _shift(self, s):
+    # shift of the signal in the 64 bit little or big endian integer of the message
+    if s.is_little_endian:
+      return s.start_bit
+    b1 = (s.start_bit // 8) * 8 + (-s.start_bit - 1) % 8
+    return 64 - (b1 + s.size)
+
+  def encode_batch(self, msg_id, dd):
+    """Encode many CAN messages with the same id, same result as encode for every row.
+
+       Inputs:
+        msg_id: The message ID.
+        dd: A dictionary mapping signal name to an array of signal data, all of the same length.
+
+       Returns:
+        A uint8 array of shape (len, size), one message per row.
+    """
+    msg_id = self.lookup_msg_id(msg_id)
+
+    msg_def = self.msgs[msg_id]
+    size = msg_def[0][1]
+
+    n = None
+    be = le = None
+    for s in msg_def[1]:
+      ival = dd.get(s.name)
+      if ival is None:
+        continue
+
+      ival = np.asarray(ival)
+      if n is None:
+        n = len(ival)
+        be = np.zeros(n, dtype=np.uint64)
+        le = np.zeros(n, dtype=np.uint64)
+
+      ival = np.round((ival / s.factor) - s.offset).astype(np.int64).view(np.uint64)
+      mask = (1 << s.size) - 1
+      shift = self._shift(s)
+      dat = (ival & np.uint64(mask)) << np.uint64(shift)
+
+      # the little endian signals are kept byte swapped until the end
+      if s.is_little_endian:
+        be &= np.uint64(~self.reverse_bytes(mask << shift) & 0xffffffffffffffff)
+        le &= np.uint64(~(mask << shift) & 0xffffffffffffffff)
+        le |= dat
+      else:
+        be &= np.uint64(~(mask << shift) & 0xffffffffffffffff)
+        le &= np.uint64(~self.reverse_bytes(mask << shift) & 0xffffffffffffffff)
+        be |= dat
+
+    if n is None:
+      n = len(next(iter(dd.values()))) if len(dd) else 0
+      return np.zeros((n, size), dtype=np.uint8)
+
+    result = be.astype('>u8').view(np.uint8).reshape(n, 8)
+    result |= le.astype('<u8').view(np.uint8).reshape(n, 8)
+    return result[:, :size]
+
+  def decode_batch(self, addresses, data, arr=None):
+    """Decode many CAN messages at once, same values as decode for every message.
+
+       Inputs:
+        addresses: An array of CAN addresses.
+        data: The CAN data, a uint8 array of shape (len(addresses), <= 8) or a
+              list of bytes.
+        arr: Optional list of signals which should be decoded and returned.
+
+       Returns:
+        A dict mapping the name of every known message in addresses to a tuple
+        (idx, signals), where idx are the indices of that message in addresses
+        and signals maps signal name to an array of decoded values. Messages
+        with unknown addresses are skipped.
+    """
+    addresses = np.asarray(addresses)
+    if isinstance(data, np.ndarray):
+      data = np.ascontiguousarray(data, dtype=np.uint8)
+      if data.ndim == 1:
+        data = data.reshape(len(addresses), -1)
+      if data.shape[1] < 8:
+        data = np.hstack([data, np.zeros((len(data), 8 - data.shape[1]), dtype=np.uint8)])
+    else:
+      data = np.frombuffer(b"".join(bytes(d).ljust(8, b'\x00')[:8] for d in data), dtype=np.uint8)
+      data = data.reshape(len(addresses), 8)
+    data = data[:, :8]
+
+    le_all = np.ascontiguousarray(data).view('<u8')[:, 0].astype(np.uint64)
+    be_all = np.ascontiguousarray(data).view('>u8')[:, 0].astype(np.uint64)
+
+    wanted = None if arr is None else set(arr)
+
+    out = {}
+    unique, inverse = np.unique(addresses, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1])
+    for address, idx in zip(unique.tolist(), splits):
+      msg = self.msgs.get(address)
+      if msg is None:
+        self._warned_addresses.add(address)
+        continue
+
+      le, be = None, None
+      signals = {}
+      for s in msg[1]:
+        if wanted is not None and s.name not in wanted:
+          continue
+
+        shift_amount = self._shift(s)
+        if shift_amount < 0:
+          continue
+
+        if s.is_little_endian:
+          if le is None:
+            le = le_all[idx]
+          tmp = le
+        else:
+          if be is None:
+            be = be_all[idx]
+          tmp = be
+
+        tmp = (tmp >> np.uint64(shift_amount)) & np.uint64((1 << s.size) - 1)
+        if s.is_signed:
+          tmp = tmp.astype(np.int64)
+          if s.size < 64:
+            tmp -= (tmp >> (s.size - 1)) << s.size
+        elif s.size < 64:
+          tmp = tmp.astype(np.int64)
+
+        signals[s.name] = tmp * s.factor + s.offset
+      out[msg[0][0]] = (idx, signals)
+    return out
+
   def get_signals(self, msg):
     msg = self.lookup_msg_id(msg)
     return [sgs.name for sgs in self.msgs[msg][1]]
 
 
 if __name__ == "__main__":
-   from opendbc import DBC_PATH
-
-   dbc_test = dbc(os.path.join(DBC_PATH, 'toyota_prius_2017_pt_generated.dbc'))
-   msg = ('STEER_ANGLE_SENSOR', {'STEER_ANGLE': -6.0, 'STEER_RATE': 4, 'STEER_FRACTION': -0.2})
-   encoded = dbc_test.encode(*msg)
-   decoded = dbc_test.decode((0x25, 0, encoded))
-   assert decoded == msg
-
-   dbc_test = dbc(os.path.join(DBC_PATH, 'hyundai_santa_fe_2019_ccan.dbc'))
-   decoded = dbc_test.decode((0x2b0, 0, "\xfa\xfe\x00\x07\x12"))
-   assert abs(decoded[1]['SAS_Angle'] - (-26.2)) < 0.001
+  import argparse
+  from opendbc import DBC_PATH
+  # pickle DBCSignal from the module, not from __main__
+  import opendbc.can.dbc as dbc_module
 
-   msg = ('SAS11', {'SAS_Stat': 7.0, 'MsgCount': 0.0, 'SAS_Angle': -26.200000000000003, 'SAS_Speed': 0.0, 'CheckSum': 0.0})
-   encoded = dbc_test.encode(*msg)
-   decoded = dbc_test.decode((0x2b0, 0, encoded))
+  parser = argparse.ArgumentParser(description="Build the parsed dbc cache")
+  parser.add_argument("dbc_dir", nargs="?", default=DBC_PATH)
+  parser.add_argument("--cache-dir", default=dbc_module.DBC_CACHE_DIR)
+  args = parser.parse_args()
 
-   assert decoded == msg
+  print("parsed %d dbcs into %s" % (dbc_module.build_cache(args.dbc_dir, args.cache_dir), args.cache_dir))
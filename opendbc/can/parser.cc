@@ -200,9 +200,13 @@ void CANParser::UpdateValid(uint64_t sec) {
 }
 
 void CANParser::update_string(std::string data, bool sendcan) {
+  update_buffer(data.data(), data.length(), sendcan);
+}
+
+void CANParser::update_buffer(const char *data, size_t len, bool sendcan) {
   // format for board, make copy due to alignment issues, will be freed on out of scope
-  auto amsg = kj::heapArray<capnp::word>((data.length() / sizeof(capnp::word)) + 1);
-  memcpy(amsg.begin(), data.data(), data.length());
+  auto amsg = kj::heapArray<capnp::word>((len / sizeof(capnp::word)) + 1);
+  memcpy(amsg.begin(), data, len);
 
   // extract the messages
   capnp::FlatArrayMessageReader cmsg(amsg);
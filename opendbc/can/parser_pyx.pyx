@@ -130,7 +130,24 @@ cdef class CANParser:
     self.can.update_string(dat, sendcan)
     return self.update_vl()
 
+  def update_batch(self, bytes dat, offsets, bool sendcan=False):
+    """Parse messages stored back to back in dat, message i is dat[offsets[i]:offsets[i+1]]"""
+    cdef const char *buf = dat
+    cdef const unsigned long long[:] offs = offsets
+    cdef Py_ssize_t i
+    updated_vals = set()
+
+    for i in range(len(offs) - 1):
+      self.can.update_buffer(buf + offs[i], offs[i + 1] - offs[i], sendcan)
+      updated_vals.update(self.update_vl())
+
+    return updated_vals
+
   def update_strings(self, strings, sendcan=False):
+    # a cereal MessageBatch can be parsed without splitting it into strings
+    if hasattr(strings, 'offsets'):
+      return self.update_batch(strings.data, strings.offsets, sendcan)
+
     updated_vals = set()
 
     for s in strings:
@@ -0,0 +1,9 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# the dbc cache of the tests stays out of the source tree
+_cache_dir = tempfile.mkdtemp(prefix="dbc_cache_")
+atexit.register(shutil.rmtree, _cache_dir, ignore_errors=True)
+os.environ.setdefault("DBC_CACHE_DIR", _cache_dir)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from opendbc import DBC_PATH
+from opendbc.can.dbc import dbc, load_cache, build_cache
+
+DBCS = ['toyota_prius_2017_pt_generated', 'hyundai_kia_generic', 'honda_civic_touring_2016_can_generated']
+
+
+class TestDBC(unittest.TestCase):
+  def test_round_trip(self):
+    dbc_test = dbc(os.path.join(DBC_PATH, 'toyota_prius_2017_pt_generated.dbc'))
+    msg = ('STEER_ANGLE_SENSOR', {'STEER_ANGLE': -6.0, 'STEER_RATE': 4, 'STEER_FRACTION': -0.2})
+    encoded = dbc_test.encode(*msg)
+    decoded = dbc_test.decode((0x25, 0, encoded))
+    self.assertEqual(decoded, msg)
+
+    dbc_test = dbc(os.path.join(DBC_PATH, 'hyundai_kia_generic.dbc'))
+    decoded = dbc_test.decode((0x2b0, 0, b"\xfa\xfe\x00\x07\x12"))
+    self.assertAlmostEqual(decoded[1]['SAS_Angle'], -26.2)
+
+    msg = ('SAS11', {'SAS_Stat': 7.0, 'MsgCount': 0.0, 'SAS_Angle': -26.200000000000003, 'SAS_Speed': 0.0, 'CheckSum': 0.0})
+    encoded = dbc_test.encode(*msg)
+    decoded = dbc_test.decode((0x2b0, 0, encoded))
+    self.assertEqual(decoded, msg)
+
+  def test_decode_batch(self):
+    np.random.seed(0)
+    for fn in DBCS:
+      dbc_test = dbc(os.path.join(DBC_PATH, fn + '.dbc'))
+      known = list(dbc_test.msgs.keys())
+      addresses = np.random.choice(known + [0x7ff], 500)
+      data = np.random.randint(0, 256, size=(len(addresses), 8), dtype=np.uint8)
+
+      decoded = dbc_test.decode_batch(addresses, data)
+      self.assertEqual(len(decoded), len(set(addresses.tolist()) - {0x7ff}))
+      for name, (idx, signals) in decoded.items():
+        for j, i in enumerate(idx):
+          scalar_name, scalar = dbc_test.decode((addresses[i], 0, data[i].tobytes()))
+          self.assertEqual(scalar_name, name)
+          self.assertEqual(set(scalar), set(signals))
+          for sig, val in scalar.items():
+            self.assertEqual(signals[sig][j], val, (fn, name, sig))
+
+  def test_decode_batch_signals(self):
+    dbc_test = dbc(os.path.join(DBC_PATH, 'hyundai_kia_generic.dbc'))
+    decoded = dbc_test.decode_batch([0x2b0, 0x2b0], [b"\xfa\xfe\x00\x07\x12", b"\x00"], arr=['SAS_Angle'])
+    idx, signals = decoded['SAS11']
+    self.assertEqual(list(idx), [0, 1])
+    self.assertEqual(list(signals), ['SAS_Angle'])
+    np.testing.assert_allclose(signals['SAS_Angle'], [-26.2, 0.])
+
+  def test_encode_batch(self):
+    np.random.seed(0)
+    for fn in DBCS:
+      dbc_test = dbc(os.path.join(DBC_PATH, fn + '.dbc'))
+      for address, ((name, size), sigs) in dbc_test.msgs.items():
+        n = 20
+        dd = {}
+        for s in sigs:
+          lo = -(1 << (s.size - 1)) if s.is_signed else 0
+          raw = np.random.randint(lo, lo + (1 << min(s.size, 62)), size=n, dtype=np.int64)
+          dd[s.name] = raw * s.factor + s.offset * s.factor
+
+        encoded = dbc_test.encode_batch(name, dd)
+        self.assertEqual(encoded.shape, (n, size))
+        for i in range(n):
+          scalar = dbc_test.encode(address, {k: v[i] for k, v in dd.items()})
+          self.assertEqual(encoded[i].tobytes(), scalar, (fn, name))
+
+  def test_cache(self):
+    cache_dir = tempfile.mkdtemp()
+    dbc_dir = tempfile.mkdtemp()
+    try:
+      fn = os.path.join(dbc_dir, 'test.dbc')
+      shutil.copy(os.path.join(DBC_PATH, 'honda_civic_touring_2016_can_generated.dbc'), fn)
+      self.assertEqual(build_cache(dbc_dir, cache_dir), 1)
+      self.assertEqual(build_cache(dbc_dir, cache_dir), 0)
+      # readable by the other users, like the dbc itself
+      for x in os.listdir(cache_dir):
+        self.assertEqual(os.stat(os.path.join(cache_dir, x)).st_mode & 0o777, 0o644)
+
+      parsed = dbc(fn, cache_dir=None)
+      cached = dbc(fn, cache_dir=cache_dir)
+      self.assertEqual(parsed.msgs, cached.msgs)
+      self.assertEqual(parsed.def_vals, cached.def_vals)
+
+      # same contents with a new mtime is still valid
+      os.utime(fn, ns=(0, 0))
+      self.assertIsNotNone(load_cache(fn, cache_dir))
+
+      with open(fn, 'a') as f:
+        f.write('BO_ 2000 NEW_MSG: 8 XXX\n')
+      self.assertIsNone(load_cache(fn, cache_dir))
+      self.assertIn(2000, dbc(fn, cache_dir=cache_dir).msgs)
+      self.assertIn(2000, load_cache(fn, cache_dir)[0])
+    finally:
+      shutil.rmtree(cache_dir)
+      shutil.rmtree(dbc_dir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -100,6 +100,31 @@ class TestCanParserPacker(unittest.TestCase):
 
         idx += 1
 
+  def test_batch(self):
+    dbc_file = "honda_civic_touring_2016_can_generated"
+
+    signals = [
+      ("STEER_TORQUE", "STEERING_CONTROL", 0),
+      ("STEER_TORQUE_REQUEST", "STEERING_CONTROL", 0),
+    ]
+
+    parser = CANParser(dbc_file, list(signals), [], 0)
+    batch_parser = CANParser(dbc_file, list(signals), [], 0)
+    packer = CANPacker(dbc_file)
+
+    strings = []
+    for idx, steer in enumerate(range(-256, 255)):
+      msgs = packer.make_can_msg("STEERING_CONTROL", 0, {"STEER_TORQUE": steer, "STEER_TORQUE_REQUEST": 1}, idx)
+      strings.append(can_list_to_can_capnp([msgs]))
+
+    batch = messaging.MessageBatch.from_messages(strings)
+    self.assertEqual(list(batch), strings)
+
+    self.assertEqual(parser.update_strings(strings), batch_parser.update_strings(batch))
+    self.assertEqual(parser.vl, batch_parser.vl)
+    self.assertEqual(parser.ts, batch_parser.ts)
+    self.assertEqual(parser.can_valid, batch_parser.can_valid)
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -49,6 +49,8 @@ void safety_rx_hook(CAN_FIFOMailBox_TypeDef *to_send);
 int safety_tx_hook(CAN_FIFOMailBox_TypeDef *to_push);
 int safety_fwd_hook(int bus_num, CAN_FIFOMailBox_TypeDef *to_fwd);
 int set_safety_hooks(uint16_t  mode, int16_t param);
+void safety_replay(int n, const uint32_t *ts, const uint8_t *is_tx, const CAN_FIFOMailBox_TypeDef *msgs,
+                   uint8_t *sent, uint8_t *controls);
 
 void init_tests_toyota(void);
 int get_toyota_torque_meas_min(void);
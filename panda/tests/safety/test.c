@@ -353,6 +353,25 @@ void init_tests_honda(void){
   honda_fwd_brake = false;
 }
 
+// replays n messages through the hooks, the timer is set to ts[i] before message i.
+// tx messages go through the tx hook, sent[i] and controls[i] get its result and
+// controls_allowed after it, rx messages go through the rx hook.
+void safety_replay(int n, const uint32_t *ts, const uint8_t *is_tx, const CAN_FIFOMailBox_TypeDef *msgs,
+                   uint8_t *sent, uint8_t *controls){
+  for (int i = 0; i < n; i++) {
+    CAN_FIFOMailBox_TypeDef msg = msgs[i];
+    timer.CNT = ts[i];
+    if (is_tx[i]) {
+      sent[i] = safety_tx_hook(&msg) != 0;
+      controls[i] = controls_allowed;
+    } else {
+      safety_rx_hook(&msg);
+      sent[i] = 0;
+      controls[i] = 0;
+    }
+  }
+}
+
 void set_gmlan_digital_output(int to_set){
 }
 
@@ -72,19 +72,23 @@ def package_can_msg(msg):
 
   return ret
 
-def init_segment(safety, lr, mode):
-  sendcan = (msg for msg in lr if msg.which() == 'sendcan')
-  steering_msgs = (can for msg in sendcan for can in msg.sendcan if is_steering_msg(mode, can.address))
+def mailbox_to_can_msg(mailbox):
+  ret = libpandasafety_py.ffi.new('CAN_FIFOMailBox_TypeDef *')
+  ret[0].RIR, ret[0].RDTR, ret[0].RDLR, ret[0].RDHR = (int(x) for x in mailbox)
+  return ret
 
-  msg = next(steering_msgs, None)
-  if msg is None:
+def init_segment(safety, route, mode):
+  # route is decoded by replay_drive.decode_route
+  steering_idx = (i for i in range(len(route['is_tx'])) if route['is_tx'][i] and is_steering_msg(mode, route['address'][i]))
+
+  i = next(steering_idx, None)
+  if i is None:
     # no steering msgs
     return
 
-  to_send = package_can_msg(msg)
+  to_send = mailbox_to_can_msg(route['mailbox'][i])
   torque = get_steer_torque(mode, to_send)
   if torque != 0:
     safety.set_controls_allowed(1)
     set_desired_torque_last(safety, mode, torque)
     assert safety.safety_tx_hook(to_send), "failed to initialize panda safety for segment"
-
@@ -2,57 +2,142 @@
 
 import os
 import sys
+import time
+import numpy as np
 from panda.tests.safety import libpandasafety_py
-from panda.tests.safety_replay.helpers import package_can_msg, init_segment
+from panda.tests.safety_replay.helpers import init_segment
 from tools.lib.logreader import LogReader  # pylint: disable=import-error
 
-# replay a drive to check for safety violations
-def replay_drive(lr, safety_mode, param):
+# messages handed to the safety library per call
+REPLAY_BATCH_SIZE = 1 << 16
+
+ROUTE_FIELDS = ['t', 'ts', 'is_tx', 'address', 'bus', 'mailbox']
+
+def decode_route(lr):
+  """Decodes the can and sendcan messages of a log into arrays, one entry per CAN frame:
+  t: logMonoTime in ns, ts: safety timer, is_tx: sendcan, address, bus and mailbox: the
+  frame as CAN_FIFOMailBox_TypeDef (RIR, RDTR, RDLR, RDHR). Frames we sent are dropped
+  from can like the panda does."""
+  t, is_tx, address, bus, dat = [], [], [], [], []
+  for msg in lr:
+    which = msg.which()
+    if which == 'sendcan':
+      frames, tx = msg.sendcan, True
+    elif which == 'can':
+      frames, tx = msg.can, False
+    else:
+      continue
+    for canmsg in frames:
+      # ignore msgs we sent
+      if not tx and canmsg.src >= 128:
+        continue
+      t.append(msg.logMonoTime)
+      is_tx.append(tx)
+      address.append(canmsg.address)
+      bus.append(canmsg.src)
+      dat.append(canmsg.dat)
+
+  route = {
+    't': np.array(t, dtype=np.uint64),
+    'is_tx': np.array(is_tx, dtype=np.uint8),
+    'address': np.array(address, dtype=np.uint32),
+    'bus': np.array(bus, dtype=np.uint32),
+  }
+  route['ts'] = ((route['t'] // 1000) % 0xFFFFFFFF).astype(np.uint32)
+
+  length = np.array([min(len(d), 8) for d in dat], dtype=np.uint32)
+  payload = np.frombuffer(b''.join(d[:8].ljust(8, b'\x00') for d in dat), dtype='<u4').reshape(-1, 2)
+  mailbox = np.zeros((len(dat), 4), dtype=np.uint32)
+  addr = route['address']
+  mailbox[:, 0] = np.where(addr >= 0x800, (addr << 3) | 5, (addr << 21) | 1)
+  mailbox[:, 1] = length | ((route['bus'] & 0xF) << 4)
+  mailbox[:, 2:] = payload
+  route['mailbox'] = mailbox
+  return route
+
+def save_route(fn, route):
+  # write and rename, another worker might load it at the same time
+  tmp_fn = fn + ".tmp.npz"
+  np.savez(tmp_fn, **route)
+  os.replace(tmp_fn, fn)
+
+def load_route(fn):
+  with np.load(fn) as f:
+    return {k: f[k] for k in ROUTE_FIELDS}
+
+def replay_batch(route, safety_mode, param, segment=False):
+  """Replays a decoded route through the safety hooks, returns a report with the
+  tx counts, the blocked addresses, the time of the first message blocked with
+  controls allowed and the hook throughput"""
   safety = libpandasafety_py.libpandasafety
+  ffi = libpandasafety_py.ffi
 
   err = safety.set_safety_hooks(safety_mode, param)
   assert err == 0, "invalid safety mode: %d" % safety_mode
 
-  if "SEGMENT" in os.environ:
-    init_segment(safety, lr, mode)
+  if segment:
+    init_segment(safety, route, safety_mode)
 
-  tx_tot, tx_blocked, tx_controls, tx_controls_blocked = 0, 0, 0, 0
-  blocked_addrs = set()
-  start_t = None
+  n = len(route['ts'])
+  ts = np.ascontiguousarray(route['ts'], dtype=np.uint32)
+  is_tx = np.ascontiguousarray(route['is_tx'], dtype=np.uint8)
+  mailbox = np.ascontiguousarray(route['mailbox'], dtype=np.uint32)
+  sent = np.zeros(n, dtype=np.uint8)
+  controls = np.zeros(n, dtype=np.uint8)
 
-  for msg in lr:
-    if start_t is None:
-      start_t = msg.logMonoTime
-    safety.set_timer(((msg.logMonoTime // 1000))  % 0xFFFFFFFF)
-
-    if msg.which() == 'sendcan':
-     for canmsg in msg.sendcan:
-        to_send = package_can_msg(canmsg)
-        sent = safety.safety_tx_hook(to_send)
-        if not sent:
-          tx_blocked += 1
-          tx_controls_blocked += safety.get_controls_allowed()
-          blocked_addrs.add(canmsg.address)
-
-          if "DEBUG" in os.environ:
-            print("blocked bus %d msg %d at %f" % (canmsg.src, canmsg.address, (msg.logMonoTime - start_t)/(1e9)))
-        tx_controls += safety.get_controls_allowed()
-        tx_tot += 1
-    elif msg.which() == 'can':
-      for canmsg in msg.can:
-        # ignore msgs we sent
-        if canmsg.src >= 128:
-          continue
-        to_push = package_can_msg(canmsg)
-        safety.safety_rx_hook(to_push)
-
-  print("total openpilot msgs:", tx_tot)
-  print("total msgs with controls allowed:", tx_controls)
-  print("blocked msgs:", tx_blocked)
-  print("blocked with controls allowed:", tx_controls_blocked)
-  print("blocked addrs:", blocked_addrs)
-
-  return tx_controls_blocked == 0
+  start = time.monotonic()
+  for i in range(0, n, REPLAY_BATCH_SIZE):
+    cnt = min(REPLAY_BATCH_SIZE, n - i)
+    safety.safety_replay(cnt,
+                         ffi.cast("uint32_t *", ts[i:].ctypes.data),
+                         ffi.cast("uint8_t *", is_tx[i:].ctypes.data),
+                         ffi.cast("CAN_FIFOMailBox_TypeDef *", mailbox[i:].ctypes.data),
+                         ffi.cast("uint8_t *", sent[i:].ctypes.data),
+                         ffi.cast("uint8_t *", controls[i:].ctypes.data))
+  hook_time = time.monotonic() - start
+
+  tx = is_tx.astype(bool)
+  blocked = tx & (sent == 0)
+  violations = blocked & (controls != 0)
+  if "DEBUG" in os.environ:
+    for i in np.flatnonzero(blocked):
+      print("blocked bus %d msg %d at %f" % (route['bus'][i], route['address'][i], (route['t'][i] - route['t'][0]) / 1e9))
+
+  first_violation = None
+  if violations.any():
+    first_violation = float(route['t'][np.argmax(violations)] - route['t'][0]) / 1e9
+
+  return {
+    "safety_mode": safety_mode,
+    "param": param,
+    "msgs": n,
+    "tx_total": int(tx.sum()),
+    "tx_controls": int(controls[tx].sum()),
+    "tx_blocked": int(blocked.sum()),
+    "tx_controls_blocked": int(violations.sum()),
+    "blocked_addrs": sorted(set(route['address'][blocked].tolist())),
+    "first_violation_t": first_violation,
+    "hook_time": hook_time,
+    "msgs_per_sec": n / hook_time if hook_time > 0 else None,
+  }
+
+def print_report(report):
+  print("total openpilot msgs:", report["tx_total"])
+  print("total msgs with controls allowed:", report["tx_controls"])
+  print("blocked msgs:", report["tx_blocked"])
+  print("blocked with controls allowed:", report["tx_controls_blocked"])
+  print("blocked addrs:", set(report["blocked_addrs"]))
+  print("first blocked with controls allowed at:", report["first_violation_t"])
+  print("hook throughput: %.0f msgs/s" % (report["msgs_per_sec"] or 0))
+
+# replay a drive to check for safety violations
+def replay_drive(lr, safety_mode, param):
+  route = decode_route(lr)
+  report = replay_batch(route, safety_mode, param, segment="SEGMENT" in os.environ)
+
+  print_report(report)
+
+  return report["tx_controls_blocked"] == 0
 
 if __name__ == "__main__":
   mode = int(sys.argv[2])
@@ -62,4 +147,3 @@ if __name__ == "__main__":
   print("replaying drive %s with safety mode %d and param %d" % (sys.argv[1], mode, param))
 
   replay_drive(lr, mode, param)
-
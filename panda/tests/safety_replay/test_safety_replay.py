@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 import os
+import json
+import argparse
 import requests
+from multiprocessing import Pool
 
 from panda import Panda
-from replay_drive import replay_drive
+from replay_drive import decode_route, save_route, load_route, replay_batch, print_report
 from tools.lib.logreader import LogReader  # pylint: disable=import-error
 
 BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
@@ -21,21 +24,50 @@ logs = [
   ("b0c9d2329ad1606b|2019-11-17--17-06-13.bz2", Panda.SAFETY_VOLKSWAGEN, 0), # VOLKSWAGEN.GOLF
 ]
 
+def decoded_fn(route):
+  return route + ".npz"
+
+def decode(route):
+  # decoding the log is the slow part, it's done once per route and kept next to it
+  fn = decoded_fn(route)
+  if not os.path.isfile(fn) or os.path.getmtime(fn) < os.path.getmtime(route):
+    save_route(fn, decode_route(LogReader(route)))
+  return route
+
+def replay(args):
+  # every replay runs in a fresh process, the safety library state is global
+  route, mode, param = args
+  report = replay_batch(load_route(decoded_fn(route)), mode, param)
+  report["route"] = route
+  return report
+
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="replay routes through the panda safety hooks")
+  parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count())
+  parser.add_argument("--report", help="write the reports as json to this file")
+  args = parser.parse_args()
+
   for route, _, _ in logs:
     if not os.path.isfile(route):
       with open(route, "wb") as f:
         f.write(requests.get(BASE_URL + route).content)
 
-  failed = []
-  for route, mode, param in logs:
-    lr = LogReader(route)
+  with Pool(args.jobs) as pool:
+    pool.map(decode, sorted(set(route for route, _, _ in logs)))
+  with Pool(args.jobs, maxtasksperchild=1) as pool:
+    reports = pool.map(replay, [(route, mode, int(param)) for route, mode, param in logs])
 
-    print("\nreplaying %s with safety mode %d and param %s" % (route, mode, param))
-    if not replay_drive(lr, mode, int(param)):
-      failed.append(route)
+  failed = []
+  for report in reports:
+    print("\nreplayed %s with safety mode %d and param %s" % (report["route"], report["safety_mode"], report["param"]))
+    print_report(report)
+    if report["tx_controls_blocked"] != 0:
+      failed.append(report["route"])
 
-    for f in failed:
-      print("\n**** failed on %s ****" % f)
-    assert len(failed) == 0, "\nfailed on %d logs" % len(failed)
+  if args.report:
+    with open(args.report, "w") as f:
+      json.dump(reports, f, indent=2)
 
+  for f in failed:
+    print("\n**** failed on %s ****" % f)
+  assert len(failed) == 0, "\nfailed on %d logs" % len(failed)
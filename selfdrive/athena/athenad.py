@@ -1,4 +1,5 @@
 #!/usr/bin/env python3.7
+import asyncio
 import json
 import os
 import hashlib
@@ -10,8 +11,8 @@ import time
 import threading
 import base64
 import requests
-import queue
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import create_connection, WebSocketTimeoutException, ABNF
@@ -20,87 +21,370 @@ from selfdrive.loggerd.config import ROOT
 import cereal.messaging as messaging
 from common import android
 from common.api import Api
-from common.params import Params
+from common.params import Params, default_params_path
 from cereal.services import service_list
 from selfdrive.swaglog import cloudlog
 
 ATHENA_HOST = os.getenv('ATHENA_HOST', 'wss://athena.comma.ai')
-HANDLER_THREADS = os.getenv('HANDLER_THREADS', 4)
+HANDLER_THREADS = int(os.getenv('HANDLER_THREADS', 4))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
 LOCAL_PORT_WHITELIST = set([8022])
+UPLOAD_QUEUE_FN = os.getenv('UPLOAD_QUEUE_FN', os.path.join(os.path.dirname(default_params_path()), "athena", "upload_queue.jsonl"))
+MAX_UPLOAD_RETRIES = 5
+UPLOAD_RETRY_DELAY = 10.
+
+# quick methods that don't block run on the event loop, everything else in the handler pool.
+# uploadFileToUrl and cancelUpload fsync the upload queue journal, so they aren't inline
+INLINE_METHODS = set(["echo", "listUploadQueue"])
 
 dispatcher["echo"] = lambda s: s
-payload_queue = queue.Queue()
-response_queue = queue.Queue()
-upload_queue = queue.Queue()
-cancelled_uploads = set()
-UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id'])
+UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count'], defaults=[0])
+
+handler_executor = ThreadPoolExecutor(HANDLER_THREADS)
+upload_executor = ThreadPoolExecutor(UPLOAD_WORKERS)
+
+def retry_delay(retry_count):
+  return min(UPLOAD_RETRY_DELAY * 2 ** (retry_count - 1), 3600.)
+
+class UploadQueue():
+  """Pending uploads in order and the ones in progress with their byte counts. Thread safe,
+  put() wakes up the event loop attached with attach().
+
+  With journal_fn every change is appended to a journal of json lines, put with the whole
+  item, done with the id and retry with the new retry count and time. The journal is read
+  back on start, uploads that were in progress are pending again. It's rewritten with only
+  the live items once most of its lines are stale."""
+  def __init__(self, journal_fn=None):
+    self.lock = threading.Lock()
+    self.pending = OrderedDict()
+    # id -> [item, bytes sent, size]
+    self.active = OrderedDict()
+    # (path, url) -> id of the pending and active items
+    self.keys = {}
+    # id -> wall time in seconds the failed upload is tried again
+    self.retry_at = {}
+    self.loop = None
+    self.event = None
+
+    self.journal_fn = journal_fn
+    self.journal = None
+    self.journal_lines = 0
+    if journal_fn is not None:
+      self._load()
+      self._compact()
+
+  def __len__(self):
+    with self.lock:
+      return len(self.pending)
+
+  def _load(self):
+    try:
+      with open(self.journal_fn) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # torn write from a power loss
+            continue
+          if "put" in entry:
+            item = UploadItem(**entry["put"])
+            self.pending[item.id] = item
+            self.keys[(item.path, item.url)] = item.id
+          elif entry.get("done") in self.pending:
+            item = self.pending.pop(entry["done"])
+            self.keys.pop((item.path, item.url), None)
+            self.retry_at.pop(item.id, None)
+          elif entry.get("retry") in self.pending:
+            upload_id = entry["retry"]
+            self.pending[upload_id] = self.pending[upload_id]._replace(retry_count=entry["retry_count"])
+            self.retry_at[upload_id] = entry["retry_at"]
+    except FileNotFoundError:
+      pass
+    except Exception:
+      cloudlog.exception("athena.upload_queue.load_failed")
+
+  def _compact(self):
+    """Rewrites the journal with the live items only, called with the lock held"""
+    if self.journal is not None:
+      self.journal.close()
+    os.makedirs(os.path.dirname(os.path.abspath(self.journal_fn)), exist_ok=True)
+    tmp_fn = self.journal_fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+      self.journal_lines = 0
+      # interrupted uploads go first
+      for item in [a[0] for a in self.active.values()] + list(self.pending.values()):
+        f.write(json.dumps({"put": item._asdict()}) + "\n")
+        self.journal_lines += 1
+        if item.id in self.retry_at:
+          f.write(json.dumps({"retry": item.id, "retry_count": item.retry_count, "retry_at": self.retry_at[item.id]}) + "\n")
+          self.journal_lines += 1
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_fn, self.journal_fn)
+    self.journal = open(self.journal_fn, "a")
+
+  def _append(self, entry):
+    """Appends an entry to the journal, called with the lock held"""
+    if self.journal is None:
+      return
+    try:
+      self.journal.write(json.dumps(entry) + "\n")
+      self.journal.flush()
+      os.fsync(self.journal.fileno())
+      self.journal_lines += 1
+      live = len(self.pending) + len(self.active)
+      if self.journal_lines > 2 * live + 100:
+        self._compact()
+    except OSError:
+      cloudlog.exception("athena.upload_queue.journal_failed")
+
+  def attach(self, loop):
+    self.loop = loop
+    self.event = asyncio.Event()
+
+  def detach(self):
+    self.loop = None
+    self.event = None
+
+  def _wake(self):
+    loop, event = self.loop, self.event
+    if loop is not None:
+      try:
+        loop.call_soon_threadsafe(event.set)
+      except RuntimeError:
+        # loop closed meanwhile
+        pass
+
+  def put(self, item):
+    """Queues item and returns it. An upload of the same path to the same url that is still
+    queued or in progress is returned instead."""
+    with self.lock:
+      upload_id = self.keys.get((item.path, item.url))
+      if upload_id is not None:
+        return self.pending[upload_id] if upload_id in self.pending else self.active[upload_id][0]
+      self.pending[item.id] = item
+      self.keys[(item.path, item.url)] = item.id
+      self._append({"put": item._asdict()})
+    self._wake()
+    return item
+
+  def _remove(self, item):
+    self.keys.pop((item.path, item.url), None)
+    self.retry_at.pop(item.id, None)
+    self._append({"done": item.id})
+
+  def cancel(self, upload_id):
+    with self.lock:
+      item = self.pending.pop(upload_id, None)
+      if item is None:
+        return False
+      self._remove(item)
+      return True
+
+  def get_nowait(self):
+    """Moves the first pending item that isn't waiting for a retry to the active ones and
+    returns it, None if there isn't any"""
+    with self.lock:
+      now = time.time()
+      for upload_id, item in self.pending.items():
+        if self.retry_at.get(upload_id, 0) <= now:
+          del self.pending[upload_id]
+          self.retry_at.pop(upload_id, None)
+          self.active[upload_id] = [item, 0, 0]
+          return item
+      return None
+
+  def next_retry_in(self):
+    """Seconds until the next pending item can be retried, None if nothing waits for a retry"""
+    with self.lock:
+      if not self.retry_at:
+        return None
+      return max(min(self.retry_at.values()) - time.time(), 0.)
+
+  async def get(self):
+    while True:
+      # cleared first, a put from another thread in between sets it again
+      self.event.clear()
+      item = self.get_nowait()
+      if item is not None:
+        return item
+      try:
+        await asyncio.wait_for(self.event.wait(), self.next_retry_in())
+      except asyncio.TimeoutError:
+        pass
+
+  def progress(self, upload_id, sent, size):
+    with self.lock:
+      if upload_id in self.active:
+        self.active[upload_id][1:] = [sent, size]
+
+  def done(self, upload_id):
+    with self.lock:
+      active = self.active.pop(upload_id, None)
+      if active is not None:
+        self._remove(active[0])
+
+  def failed(self, upload_id):
+    """Queues a failed upload again with a backoff, gives up after MAX_UPLOAD_RETRIES"""
+    with self.lock:
+      active = self.active.pop(upload_id, None)
+      if active is None:
+        return
+      item = active[0]._replace(retry_count=active[0].retry_count + 1)
+      if item.retry_count > MAX_UPLOAD_RETRIES:
+        cloudlog.event("athena.upload_queue.gave_up", path=item.path, retries=item.retry_count)
+        self._remove(item)
+        return
+      self.pending[upload_id] = item
+      self.retry_at[upload_id] = time.time() + retry_delay(item.retry_count)
+      self._append({"retry": upload_id, "retry_count": item.retry_count, "retry_at": self.retry_at[upload_id]})
+    self._wake()
+
+  def list(self):
+    with self.lock:
+      ret = []
+      for item, sent, size in self.active.values():
+        ret.append({**item._asdict(), "current": True, "bytes_sent": sent, "size": size,
+                    "progress": sent / size if size else 0.})
+      for item in self.pending.values():
+        ret.append({**item._asdict(), "current": False, "bytes_sent": 0, "size": None, "progress": 0.})
+      return ret
+
+  def close(self):
+    with self.lock:
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
+
+upload_queue = UploadQueue()
 
 def handle_long_poll(ws):
   end_event = threading.Event()
-
-  threads = [
-    threading.Thread(target=ws_recv, args=(ws, end_event)),
-    threading.Thread(target=ws_send, args=(ws, end_event)),
-    threading.Thread(target=upload_handler, args=(end_event,))
-  ] + [
-    threading.Thread(target=jsonrpc_handler, args=(end_event,))
-    for x in range(HANDLER_THREADS)
-  ]
-
-  for thread in threads:
-    thread.start()
   try:
-    while not end_event.is_set():
-      time.sleep(0.1)
-  except (KeyboardInterrupt, SystemExit):
-    end_event.set()
-    raise
+    asyncio.run(_handle_long_poll(ws, end_event))
   finally:
-    for i, thread in enumerate(threads):
-      thread.join()
+    end_event.set()
 
-def jsonrpc_handler(end_event):
+async def _handle_long_poll(ws, end_event):
   dispatcher["startLocalProxy"] = partial(startLocalProxy, end_event)
-  while not end_event.is_set():
-    try:
-      data = payload_queue.get(timeout=1)
+  upload_queue.attach(asyncio.get_event_loop())
+
+  # websocket calls block, one thread for each direction
+  recv_executor, send_executor = ThreadPoolExecutor(1), ThreadPoolExecutor(1)
+  responses = asyncio.Queue()
+  tasks = [asyncio.ensure_future(ws_recv(ws, recv_executor, responses)),
+           asyncio.ensure_future(ws_send(ws, send_executor, responses))]
+  tasks += [asyncio.ensure_future(upload_worker()) for _ in range(UPLOAD_WORKERS)]
+  try:
+    # the websocket tasks only return once the connection is gone
+    await asyncio.wait(tasks[:2], return_when=asyncio.FIRST_COMPLETED)
+  finally:
+    upload_queue.detach()
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    recv_executor.shutdown(wait=False)
+    send_executor.shutdown(wait=False)
+
+def is_inline(data):
+  try:
+    return json.loads(data).get("method") in INLINE_METHODS
+  except (ValueError, AttributeError):
+    return False
+
+async def jsonrpc_handler(data):
+  """Returns the serialized response to the request in data"""
+  try:
+    if is_inline(data):
       response = JSONRPCResponseManager.handle(data, dispatcher)
-      response_queue.put_nowait(response)
-    except queue.Empty:
-      pass
-    except Exception as e:
-      cloudlog.exception("athena jsonrpc handler failed")
-      response_queue.put_nowait(json.dumps({"error": str(e)}))
+    else:
+      loop = asyncio.get_event_loop()
+      response = await loop.run_in_executor(handler_executor, JSONRPCResponseManager.handle, data, dispatcher)
+    return response.json
+  except Exception as e:
+    cloudlog.exception("athena jsonrpc handler failed")
+    return json.dumps({"error": str(e)})
 
-def upload_handler(end_event):
-  while not end_event.is_set():
+def upload_handler(item):
+  # in the upload thread, a disconnect doesn't stop the upload
+  try:
+    resp = _do_upload(item, partial(upload_queue.progress, item.id))
+  except FileNotFoundError:
+    # deleted meanwhile, no point in trying again
+    upload_queue.done(item.id)
+    raise
+  except Exception:
+    upload_queue.failed(item.id)
+    raise
+
+  if resp.status_code in (200, 201):
+    upload_queue.done(item.id)
+  else:
+    cloudlog.event("athena.upload_handler.failed", path=item.path, status_code=resp.status_code)
+    upload_queue.failed(item.id)
+  return resp
+
+async def upload_worker():
+  loop = asyncio.get_event_loop()
+  while True:
+    item = await upload_queue.get()
     try:
-      item = upload_queue.get(timeout=1)
-      if item.id in cancelled_uploads:
-        cancelled_uploads.remove(item.id)
-        continue
-      _do_upload(item)
-    except queue.Empty:
-      pass
+      await loop.run_in_executor(upload_executor, upload_handler, item)
+    except asyncio.CancelledError:
+      raise
     except Exception:
       cloudlog.exception("athena.upload_handler.exception")
 
-def _do_upload(upload_item):
+class UploadFile():
+  """File wrapper for requests that reports the bytes read so far"""
+  def __init__(self, f, size, callback):
+    self.f = f
+    self.size = size
+    self.callback = callback
+    self.sent = 0
+
+  def __len__(self):
+    return self.size
+
+  def read(self, n=-1):
+    dat = self.f.read(n)
+    self.sent += len(dat)
+    self.callback(self.sent, self.size)
+    return dat
+
+def _do_upload(upload_item, callback=None):
   with open(upload_item.path, "rb") as f:
     size = os.fstat(f.fileno()).st_size
+    data = f if callback is None else UploadFile(f, size, callback)
     return requests.put(upload_item.url,
-                        data=f,
+                        data=data,
                         headers={**upload_item.headers, 'Content-Length': str(size)},
                         timeout=10)
 
+# subscriber sockets are kept, creating one for every request is slow
+sub_socks = {}
+sub_socks_lock = threading.Lock()
+
+def recv_latest(service, timeout):
+  """Returns the first message on service after the call, None on timeout"""
+  with sub_socks_lock:
+    if service not in sub_socks:
+      sub_socks[service] = (threading.Lock(), messaging.sub_sock(service, conflate=True))
+    lock, sock = sub_socks[service]
+
+  with lock:
+    # the cached socket holds the last message since the previous call
+    messaging.drain_sock_raw(sock)
+    sock.setTimeout(timeout)
+    return messaging.recv_one(sock)
+
 # security: user should be able to request any message from their car
 @dispatcher.add_method
 def getMessage(service=None, timeout=1000):
   if service is None or service not in service_list:
     raise Exception("invalid service")
 
-  socket = messaging.sub_sock(service, timeout=timeout)
-  ret = messaging.recv_one(socket)
+  ret = recv_latest(service, timeout)
 
   if ret is None:
     raise TimeoutError
@@ -114,8 +398,7 @@ def listDataDirectory():
 
 @dispatcher.add_method
 def reboot():
-  thermal_sock = messaging.sub_sock("thermal", timeout=1000)
-  ret = messaging.recv_one(thermal_sock)
+  ret = recv_latest("thermal", 1000)
   if ret is None or ret.thermal.started:
     raise Exception("Reboot unavailable")
 
@@ -139,21 +422,20 @@ def uploadFileToUrl(fn, url, headers):
   upload_id = hashlib.sha1(str(item).encode()).hexdigest()
   item = item._replace(id=upload_id)
 
-  upload_queue.put_nowait(item)
+  # the same file to the same url again is the item already queued
+  item = upload_queue.put(item)
 
   return {"enqueued": 1, "item": item._asdict()}
 
 @dispatcher.add_method
 def listUploadQueue():
-  return [item._asdict() for item in list(upload_queue.queue)]
+  return upload_queue.list()
 
 @dispatcher.add_method
 def cancelUpload(upload_id):
-  upload_ids = set(item.id for item in list(upload_queue.queue))
-  if upload_id not in upload_ids:
+  if not upload_queue.cancel(upload_id):
     return 404
 
-  cancelled_uploads.add(upload_id)
   return {"success": 1}
 
 def startLocalProxy(global_end_event, remote_ws_uri, local_port):
@@ -268,32 +550,46 @@ def ws_proxy_send(ws, local_sock, signal_sock, end_event):
       cloudlog.exception("athenad.ws_proxy_send.exception")
       end_event.set()
 
-def ws_recv(ws, end_event):
-  while not end_event.is_set():
-    try:
-      data = ws.recv()
-      payload_queue.put_nowait(data)
-    except WebSocketTimeoutException:
-      pass
-    except Exception:
-      cloudlog.exception("athenad.ws_recv.exception")
-      end_event.set()
+async def handle_payload(data, responses):
+  await responses.put(await jsonrpc_handler(data))
 
-def ws_send(ws, end_event):
-  while not end_event.is_set():
+async def ws_recv(ws, executor, responses):
+  loop = asyncio.get_event_loop()
+  handlers = set()
+  try:
+    while True:
+      try:
+        data = await loop.run_in_executor(executor, ws.recv)
+      except WebSocketTimeoutException:
+        continue
+      except Exception:
+        cloudlog.exception("athenad.ws_recv.exception")
+        return
+
+      handler = asyncio.ensure_future(handle_payload(data, responses))
+      handlers.add(handler)
+      handler.add_done_callback(handlers.discard)
+  finally:
+    for handler in handlers:
+      handler.cancel()
+
+async def ws_send(ws, executor, responses):
+  loop = asyncio.get_event_loop()
+  while True:
+    response = await responses.get()
     try:
-      response = response_queue.get(timeout=1)
-      ws.send(response.json)
-    except queue.Empty:
-      pass
+      await loop.run_in_executor(executor, ws.send, response)
     except Exception:
       cloudlog.exception("athenad.ws_send.exception")
-      end_event.set()
+      return
 
 def backoff(retries):
   return random.randrange(0, min(128, int(2 ** retries)))
 
 def main(gctx=None):
+  global upload_queue
+  upload_queue = UploadQueue(UPLOAD_QUEUE_FN)
+
   params = Params()
   dongle_id = params.get("DongleId").decode('utf-8')
   ws_uri = ATHENA_HOST + "/ws/v2/" + dongle_id
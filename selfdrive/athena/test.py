@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import asyncio
 import json
 import os
 import requests
@@ -90,64 +91,152 @@ class TestAthenadMethods(unittest.TestCase):
       self.assertEqual(resp['enqueued'], 1)
       self.assertDictContainsSubset({"path": fn, "url": "http://localhost:44444/qlog.bz2", "headers": {}}, resp['item'])
       self.assertIsNotNone(resp['item'].get('id'))
-      self.assertEqual(athenad.upload_queue.qsize(), 1)
+      self.assertEqual(len(athenad.upload_queue), 1)
     finally:
-      athenad.upload_queue = queue.Queue()
+      athenad.upload_queue = athenad.UploadQueue()
       os.unlink(fn)
 
   @with_http_server
-  def test_upload_handler(self):
-    fn = os.path.join(athenad.ROOT, 'qlog.bz2')
-    Path(fn).touch()
-    item = athenad.UploadItem(path=fn, url="http://localhost:44444/qlog.bz2", headers={}, created_at=int(time.time()*1000), id='')
+  def test_upload_worker(self):
+    fns = [os.path.join(athenad.ROOT, f) for f in ['qlog.bz2', 'rlog.bz2', 'fcamera.hevc']]
+    items = []
+    for i, fn in enumerate(fns):
+      with open(fn, 'wb') as f:
+        f.write(os.urandom(100000))
+      items.append(athenad.UploadItem(path=fn, url="http://localhost:44444/" + os.path.basename(fn), headers={},
+                                      created_at=int(time.time()*1000), id=str(i)))
 
-    end_event = threading.Event()
-    thread = threading.Thread(target=athenad.upload_handler, args=(end_event,))
-    thread.start()
+    async def run():
+      athenad.upload_queue.attach(asyncio.get_event_loop())
+      workers = [asyncio.ensure_future(athenad.upload_worker()) for _ in range(2)]
+      for item in items:
+        athenad.upload_queue.put(item)
+      try:
+        now = time.time()
+        while time.time() - now < 5:
+          if len(athenad.upload_queue.list()) == 0:
+            break
+          await asyncio.sleep(0.01)
+        self.assertEqual(athenad.upload_queue.list(), [])
+      finally:
+        for w in workers:
+          w.cancel()
+        athenad.upload_queue.detach()
 
-    athenad.upload_queue.put_nowait(item)
     try:
-      now = time.time()
-      while time.time() - now < 5:
-        if athenad.upload_queue.qsize() == 0:
-          break
-      self.assertEqual(athenad.upload_queue.qsize(), 0)
+      asyncio.run(run())
     finally:
-      end_event.set()
-      athenad.upload_queue = queue.Queue()
-      os.unlink(fn)
+      athenad.upload_queue = athenad.UploadQueue()
+      for fn in fns:
+        os.unlink(fn)
 
   def test_cancelUpload(self):
     item = athenad.UploadItem(path="qlog.bz2", url="http://localhost:44444/qlog.bz2", headers={}, created_at=int(time.time()*1000), id='id')
-    athenad.upload_queue.put_nowait(item)
-    dispatcher["cancelUpload"](item.id)
-
-    self.assertIn(item.id, athenad.cancelled_uploads)
-
-    end_event = threading.Event()
-    thread = threading.Thread(target=athenad.upload_handler, args=(end_event,))
-    thread.start()
+    athenad.upload_queue.put(item)
     try:
-      now = time.time()
-      while time.time() - now < 5:
-        if athenad.upload_queue.qsize() == 0 and len(athenad.cancelled_uploads) == 0:
-          break
-      self.assertEqual(athenad.upload_queue.qsize(), 0)
-      self.assertEqual(len(athenad.cancelled_uploads), 0)
+      self.assertEqual(dispatcher["cancelUpload"](item.id), {"success": 1})
+      self.assertEqual(len(athenad.upload_queue), 0)
+      self.assertEqual(dispatcher["cancelUpload"](item.id), 404)
     finally:
-      end_event.set()
-      athenad.upload_queue = queue.Queue()
+      athenad.upload_queue = athenad.UploadQueue()
 
   def test_listUploadQueue(self):
     item = athenad.UploadItem(path="qlog.bz2", url="http://localhost:44444/qlog.bz2", headers={}, created_at=int(time.time()*1000), id='id')
-    athenad.upload_queue.put_nowait(item)
+    item2 = item._replace(path="rlog.bz2", url="http://localhost:44444/rlog.bz2", id='id2')
+    athenad.upload_queue.put(item)
+    athenad.upload_queue.put(item2)
 
     try:
       items = dispatcher["listUploadQueue"]()
-      self.assertEqual(len(items), 1)
-      self.assertDictEqual(items[0], item._asdict())
+      self.assertEqual(len(items), 2)
+      self.assertDictContainsSubset(item._asdict(), items[0])
+      self.assertFalse(items[0]['current'])
+
+      # in progress
+      self.assertEqual(athenad.upload_queue.get_nowait(), item)
+      athenad.upload_queue.progress(item.id, 50, 200)
+      items = dispatcher["listUploadQueue"]()
+      self.assertDictContainsSubset({**item._asdict(), "current": True, "bytes_sent": 50, "size": 200, "progress": 0.25}, items[0])
+      self.assertDictContainsSubset(item2._asdict(), items[1])
+    finally:
+      athenad.upload_queue = athenad.UploadQueue()
+
+  def test_uploadFileToUrl_duplicate(self):
+    fn = os.path.join(athenad.ROOT, 'qlog.bz2')
+    Path(fn).touch()
+
+    try:
+      resp = dispatcher["uploadFileToUrl"]("qlog.bz2", "http://localhost:44444/qlog.bz2", {})
+      resp2 = dispatcher["uploadFileToUrl"]("qlog.bz2", "http://localhost:44444/qlog.bz2", {})
+      self.assertEqual(resp['item']['id'], resp2['item']['id'])
+      self.assertEqual(len(athenad.upload_queue), 1)
+
+      resp3 = dispatcher["uploadFileToUrl"]("qlog.bz2", "http://localhost:44444/other.bz2", {})
+      self.assertNotEqual(resp['item']['id'], resp3['item']['id'])
+      self.assertEqual(len(athenad.upload_queue), 2)
     finally:
-      athenad.upload_queue = queue.Queue()
+      athenad.upload_queue = athenad.UploadQueue()
+      os.unlink(fn)
+
+  def test_upload_queue_journal(self):
+    journal_fn = os.path.join(tempfile.mkdtemp(), "athena", "upload_queue.jsonl")
+    items = [athenad.UploadItem(path=f, url="http://localhost:44444/" + f, headers={"x": "y"}, created_at=i, id=str(i))
+             for i, f in enumerate(['qlog.bz2', 'rlog.bz2', 'fcamera.hevc', 'dcamera.hevc'])]
+
+    q = athenad.UploadQueue(journal_fn)
+    for item in items:
+      q.put(item)
+    q.cancel(items[1].id)
+    self.assertEqual(q.get_nowait(), items[0])
+    q.done(items[0].id)
+    # interrupted uploads are queued again
+    self.assertEqual(q.get_nowait(), items[2])
+    q.close()
+
+    q = athenad.UploadQueue(journal_fn)
+    self.assertEqual([i['id'] for i in q.list()], [items[2].id, items[3].id])
+    self.assertEqual(q.get_nowait(), items[2])
+
+    # stale lines are dropped
+    for i in range(200):
+      q.cancel(q.put(items[0]._replace(id="x%d" % i)).id)
+    self.assertLess(q.journal_lines, 110)
+    q.close()
+
+    # a torn last line is skipped
+    with open(journal_fn, "a") as f:
+      f.write('{"put": {"pa')
+    q = athenad.UploadQueue(journal_fn)
+    self.assertEqual([i['id'] for i in q.list()], [items[2].id, items[3].id])
+    q.close()
+
+  def test_upload_retry(self):
+    journal_fn = os.path.join(tempfile.mkdtemp(), "upload_queue.jsonl")
+    item = athenad.UploadItem(path="qlog.bz2", url="http://localhost:44444/qlog.bz2", headers={}, created_at=0, id='id')
+    q = athenad.UploadQueue(journal_fn)
+    q.put(item)
+
+    with mock.patch('selfdrive.athena.athenad.upload_queue', q), \
+         mock.patch('selfdrive.athena.athenad._do_upload', return_value=mock.Mock(status_code=500)):
+      athenad.upload_handler(q.get_nowait())
+    self.assertIsNone(q.get_nowait())
+    self.assertAlmostEqual(q.next_retry_in(), athenad.UPLOAD_RETRY_DELAY, delta=1)
+    q.close()
+
+    # the backoff survives a restart
+    q = athenad.UploadQueue(journal_fn)
+    self.assertIsNone(q.get_nowait())
+    q.retry_at['id'] = 0
+    self.assertEqual(q.get_nowait(), item._replace(retry_count=1))
+
+    for _ in range(athenad.MAX_UPLOAD_RETRIES - 1):
+      q.failed('id')
+      q.retry_at['id'] = 0
+      q.get_nowait()
+    q.failed('id')
+    self.assertEqual(q.list(), [])
+    self.assertIsNone(q.next_retry_in())
+    q.close()
 
   @mock.patch('selfdrive.athena.athenad.create_connection')
   def test_startLocalProxy(self, mock_create_connection):
@@ -178,17 +267,29 @@ class TestAthenadMethods(unittest.TestCase):
     self.assertEqual(keys, MockParams().params["GithubSshKeys"].decode('utf-8'))
 
   def test_jsonrpc_handler(self):
-    end_event = threading.Event()
-    thread = threading.Thread(target=athenad.jsonrpc_handler, args=(end_event,))
+    for method, params in [("echo", ["hello"]), ("getSshAuthorizedKeys", [])]:
+      req = json.dumps({"method": method, "params": params, "jsonrpc": "2.0", "id": 0})
+      resp = json.loads(asyncio.run(athenad.jsonrpc_handler(req)))
+      self.assertEqual(resp['id'], 0)
+      self.assertIn('result', resp)
+
+  def test_handle_long_poll(self):
+    ws_recv = queue.Queue()
+    ws_send = queue.Queue()
+    ws = MockWebsocket(ws_recv, ws_send)
+
+    thread = threading.Thread(target=athenad.handle_long_poll, args=(ws,))
     thread.daemon = True
     thread.start()
-    athenad.payload_queue.put_nowait(json.dumps({"method": "echo", "params": ["hello"], "jsonrpc": "2.0", "id": 0}))
     try:
-      resp = athenad.response_queue.get(timeout=3)
-      self.assertDictEqual(resp.data, {'result': 'hello', 'id': 0, 'jsonrpc': '2.0'})
+      for i in range(3):
+        ws_recv.put_nowait(json.dumps({"method": "echo", "params": ["hello %d" % i], "jsonrpc": "2.0", "id": i}))
+      resps = [json.loads(ws_send.get(timeout=3)[0]) for _ in range(3)]
+      self.assertEqual(sorted(r['result'] for r in resps), ["hello 0", "hello 1", "hello 2"])
     finally:
-      end_event.set()
-      thread.join()
+      ws_recv.put_nowait(WebSocketConnectionClosedException())
+      thread.join(timeout=5)
+    self.assertFalse(thread.is_alive())
 
 if __name__ == '__main__':
   unittest.main()
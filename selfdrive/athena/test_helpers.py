@@ -4,6 +4,7 @@ import socket
 import time
 from functools import wraps
 from multiprocessing import Process
+from websocket import ABNF
 
 class EchoSocket():
   def __init__(self, port):
@@ -60,7 +61,7 @@ class MockWebsocket():
       raise data
     return data
 
-  def send(self, data, opcode):
+  def send(self, data, opcode=ABNF.OPCODE_TEXT):
     self.send_queue.put_nowait((data, opcode))
 
 class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
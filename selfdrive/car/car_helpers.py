@@ -1,7 +1,8 @@
 import os
+import importlib
 from common.params import Params
 from common.basedir import BASEDIR
-from selfdrive.car.fingerprints import eliminate_incompatible_cars, all_known_cars
+from selfdrive.car.fingerprints import CAR_REGISTRY, FINGERPRINT_INDEX
 from selfdrive.car.vin import get_vin, VIN_UNKNOWN
 from selfdrive.swaglog import cloudlog
 import cereal.messaging as messaging
@@ -16,43 +17,34 @@ def get_startup_alert(car_recognized, controller_available):
   return alert
 
 
-def load_interfaces(brand_names):
-  ret = {}
-  for brand_name in brand_names:
-    path = ('selfdrive.car.%s' % brand_name)
-    CarInterface = __import__(path + '.interface', fromlist=['CarInterface']).CarInterface
-    if os.path.exists(BASEDIR + '/' + path.replace('.', '/') + '/carcontroller.py'):
-      CarController = __import__(path + '.carcontroller', fromlist=['CarController']).CarController
-    else:
-      CarController = None
-    for model_name in brand_names[brand_name]:
-      ret[model_name] = (CarInterface, CarController)
-  return ret
-
-
-def _get_interface_names():
-  # read all the folders in selfdrive/car and return a dict where:
-  # - keys are all the car names that which we have an interface for
-  # - values are lists of spefic car models for a given car
-  brand_names = {}
-  for car_folder in [x[0] for x in os.walk(BASEDIR + '/selfdrive/car')]:
-    try:
-      brand_name = car_folder.split('/')[-1]
-      model_names = __import__('selfdrive.car.%s.values' % brand_name, fromlist=['CAR']).CAR
-      model_names = [getattr(model_names, c) for c in model_names.__dict__.keys() if not c.startswith("__")]
-      brand_names[brand_name] = model_names
-    except (ImportError, IOError):
-      pass
-
-  return brand_names
-
-
-# imports from directory selfdrive/car/<name>/
-interfaces = load_interfaces(_get_interface_names())
+def load_interface(brand):
+  path = ('selfdrive.car.%s' % brand)
+  CarInterface = importlib.import_module(path + '.interface').CarInterface
+  if os.path.exists(BASEDIR + '/' + path.replace('.', '/') + '/carcontroller.py'):
+    CarController = importlib.import_module(path + '.carcontroller').CarController
+  else:
+    CarController = None
+  return CarInterface, CarController
+
+
+# brand -> (CarInterface, CarController), a brand is only imported once a car needs it
+_interfaces = {}
+
+def get_interface(car_model):
+  brand = CAR_REGISTRY["models"][car_model]
+  if brand not in _interfaces:
+    _interfaces[brand] = load_interface(brand)
+  return _interfaces[brand]
 
 def only_toyota_left(candidate_cars):
   return all(("TOYOTA" in c or "LEXUS" in c) for c in candidate_cars) and len(candidate_cars) > 0
 
+_TOYOTA_CARS = FINGERPRINT_INDEX.to_bits(c for c in FINGERPRINT_INDEX.car_names if only_toyota_left([c]))
+
+def _only_toyota_left(cars):
+  # same as only_toyota_left, on a FINGERPRINT_INDEX cars bitset
+  return cars != 0 and cars & ~_TOYOTA_CARS == 0
+
 # BOUNTY: every added fingerprint in selfdrive/car/*/values.py is a $100 coupon code on shop.comma.ai
 # **** for use live only ****
 def fingerprint(logcan, sendcan, has_relay):
@@ -67,7 +59,8 @@ def fingerprint(logcan, sendcan, has_relay):
   Params().put("CarVin", vin)
 
   finger = gen_empty_fingerprint()
-  candidate_cars = {i: all_known_cars() for i in [0, 1]}  # attempt fingerprint on both bus 0 and 1
+  # bitsets of FINGERPRINT_INDEX.car_names
+  candidate_cars = {i: FINGERPRINT_INDEX.all_cars for i in [0, 1]}  # attempt fingerprint on both bus 0 and 1
   frame = 0
   frame_fingerprint = 10  # 0.1s
   car_fingerprint = None
@@ -82,26 +75,29 @@ def fingerprint(logcan, sendcan, has_relay):
       # and VIN query response.
       # Include bus 2 for toyotas to disambiguate cars using camera messages
       # (ideally should be done for all cars but we can't for Honda Bosch)
+      length = len(can.dat)
       if can.src in range(0, 4):
-        finger[can.src][can.address] = len(can.dat)
+        finger[can.src][can.address] = length
+      if can.address >= 0x800 or can.address in [0x7df, 0x7e0, 0x7e8]:
+        continue
       for b in candidate_cars:
-        if (can.src == b or (only_toyota_left(candidate_cars[b]) and can.src == 2)) and \
-           can.address < 0x800 and can.address not in [0x7df, 0x7e0, 0x7e8]:
-          candidate_cars[b] = eliminate_incompatible_cars(can, candidate_cars[b])
+        if can.src == b or (can.src == 2 and _only_toyota_left(candidate_cars[b])):
+          candidate_cars[b] = FINGERPRINT_INDEX.eliminate(can.address, length, candidate_cars[b])
 
     # if we only have one car choice and the time since we got our first
     # message has elapsed, exit
     for b in candidate_cars:
       # Toyota needs higher time to fingerprint, since DSU does not broadcast immediately
-      if only_toyota_left(candidate_cars[b]):
+      if _only_toyota_left(candidate_cars[b]):
         frame_fingerprint = 100  # 1s
-      if len(candidate_cars[b]) == 1:
+      cars = candidate_cars[b]
+      if cars != 0 and cars & (cars - 1) == 0:
         if frame > frame_fingerprint:
           # fingerprint done
-          car_fingerprint = candidate_cars[b][0]
+          car_fingerprint = FINGERPRINT_INDEX.to_names(cars)[0]
 
     # bail if no cars left or we've been waiting for more than 2s
-    failed = all(len(cc) == 0 for cc in candidate_cars.values()) or frame > 200
+    failed = all(cc == 0 for cc in candidate_cars.values()) or frame > 200
     succeeded = car_fingerprint is not None
     done = failed or succeeded
 
@@ -119,7 +115,7 @@ def get_car(logcan, sendcan, has_relay=False):
     cloudlog.warning("car doesn't match any fingerprints: %r", fingerprints)
     candidate = "mock"
 
-  CarInterface, CarController = interfaces[candidate]
+  CarInterface, CarController = get_interface(candidate)
   car_params = CarInterface.get_params(candidate, fingerprints, vin, has_relay)
 
   return CarInterface(car_params, CarController), car_params
@@ -1,33 +1,176 @@
 import os
+import importlib
+import pickle
+import tempfile
 from common.basedir import BASEDIR
 
+CAR_DIR = os.path.join(BASEDIR, "selfdrive", "car")
+CAR_REGISTRY_FN = os.environ.get("CAR_REGISTRY_FN", os.path.join(CAR_DIR, "car_registry.pkl"))
+CAR_REGISTRY_VERSION = 1
+
+
+def _registry_sources(car_dir):
+  # {brand: (mtime, size)} of the values.py of every brand, the registry is built from them
+  sources = {}
+  for brand in sorted(os.listdir(car_dir)):
+    try:
+      st = os.stat(os.path.join(car_dir, brand, "values.py"))
+    except OSError:
+      continue
+    sources[brand] = (st.st_mtime_ns, st.st_size)
+  return sources
+
+
+def build_car_registry(brands):
+  """Imports the values of every brand, returns a dict with
+  - models: car model -> brand, for all models with an interface
+  - fingerprints: brand -> FINGERPRINTS dict of the brand, for the brands that have one"""
+  registry = {"models": {}, "fingerprints": {}}
+  for brand in brands:
+    try:
+      values = importlib.import_module('selfdrive.car.%s.values' % brand)
+    except (ImportError, IOError):
+      continue
+    if hasattr(values, 'CAR'):
+      for c in values.CAR.__dict__.keys():
+        if not c.startswith("__"):
+          registry["models"][getattr(values.CAR, c)] = brand
+    if hasattr(values, 'FINGERPRINTS'):
+      registry["fingerprints"][brand] = values.FINGERPRINTS
+  return registry
+
+
+def load_car_registry(fn=CAR_REGISTRY_FN, car_dir=CAR_DIR):
+  """Returns the car registry. It's cached in fn and built again when a brand was added or
+  removed or its values.py changed, so only the brand the car is fingerprinted as gets imported."""
+  sources = _registry_sources(car_dir)
+  try:
+    with open(fn, "rb") as f:
+      version, cached_sources, registry = pickle.load(f)
+    if version == CAR_REGISTRY_VERSION and cached_sources == sources:
+      return registry
+  except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+    pass
+
+  registry = build_car_registry(sources)
+  try:
+    # write and rename, other processes might read it at the same time
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(fn), delete=False) as f:
+      pickle.dump((CAR_REGISTRY_VERSION, sources, registry), f, protocol=pickle.HIGHEST_PROTOCOL)
+    # NamedTemporaryFile is only readable by its owner
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, fn)
+  except OSError:
+    # caching is best effort, e.g. read only filesystem
+    pass
+  return registry
+
+
+CAR_REGISTRY = load_car_registry()
+
+
+def get_brand_fingerprints():
+  # return a dict where:
+  # - keys are all the car brands for which we have fingerprints
+  # - values are the FINGERPRINTS dict of each brand
+  return CAR_REGISTRY["fingerprints"]
+
+
 def get_fingerprint_list():
-  # read all the folders in selfdrive/car and return a dict where:
+  # return a dict where:
   # - keys are all the car models for which we have a fingerprint
   # - values are lists dicts of messages that constitute the unique
   #   CAN fingerprint of each car model and all its variants
   fingerprints = {}
-  for car_folder in [x[0] for x in os.walk(BASEDIR + '/selfdrive/car')]:
-    try:
-      car_name = car_folder.split('/')[-1]
-      values = __import__('selfdrive.car.%s.values' % car_name, fromlist=['FINGERPRINTS'])
-      if hasattr(values, 'FINGERPRINTS'):
-        car_fingerprints = values.FINGERPRINTS
-      else:
-        continue
-      for f, v in car_fingerprints.items():
-        fingerprints[f] = v
-    except (ImportError, IOError):
-      pass
+  for car_fingerprints in get_brand_fingerprints().values():
+    for f, v in car_fingerprints.items():
+      fingerprints[f] = v
   return fingerprints
 
 
-_FINGERPRINTS = get_fingerprint_list()
-
 _DEBUG_ADDRESS = {1880: 8}   # reserved for debug purposes
 
+
+class FingerprintIndex():
+  """Maps every (address, length) to bitsets of the cars and fingerprint variants that
+  contain it, so checking a message against all candidates is a single AND.
+
+  Car bits follow the order of car_names, variant bits the order of variants, a list
+  of (brand, car, fingerprint). A car matches a message if any of its variants does."""
+
+  def __init__(self, brand_fingerprints, debug_address=_DEBUG_ADDRESS):
+    self.car_names = []
+    self.car_bits = {}
+    self.variants = []
+    self.car_index = {}
+    self.variant_index = {}
+
+    for brand, car_fingerprints in brand_fingerprints.items():
+      for car_name, fingerprints in car_fingerprints.items():
+        if car_name not in self.car_bits:
+          self.car_bits[car_name] = 1 << len(self.car_names)
+          self.car_names.append(car_name)
+        car_bit = self.car_bits[car_name]
+        for fingerprint in fingerprints:
+          variant_bit = 1 << len(self.variants)
+          self.variants.append((brand, car_name, fingerprint))
+          for msg in fingerprint.items():
+            self.car_index[msg] = self.car_index.get(msg, 0) | car_bit
+            self.variant_index[msg] = self.variant_index.get(msg, 0) | variant_bit
+
+    self.all_cars = (1 << len(self.car_names)) - 1
+    self.all_variants = (1 << len(self.variants)) - 1
+
+    # every car is allowed to send the debug messages, with the debug length only
+    for msg in list(self.car_index):
+      if msg[0] in debug_address:
+        del self.car_index[msg]
+    for msg in debug_address.items():
+      self.car_index[msg] = self.all_cars
+
+    self._names_cache = {}
+
+  def eliminate(self, address, length, cars):
+    """Returns the subset of the cars bitset that could have sent the message"""
+    # ignore addresses that are more than 11 bits
+    if address >= 0x800:
+      return cars
+    return cars & self.car_index.get((address, length), 0)
+
+  def to_bits(self, car_names):
+    bits = 0
+    for c in car_names:
+      bits |= self.car_bits[c]
+    return bits
+
+  def to_names(self, cars):
+    """Returns the list of car names in a cars bitset"""
+    names = self._names_cache.get(cars)
+    if names is None:
+      names = [c for i, c in enumerate(self.car_names) if cars >> i & 1]
+      self._names_cache[cars] = names
+    return list(names)
+
+  def variants_containing(self, fingerprint, max_address=None):
+    """Returns the bitset of variants that contain every message of fingerprint,
+    messages from max_address up are not checked"""
+    variants = self.all_variants
+    for address, length in fingerprint.items():
+      if max_address is None or address < max_address:
+        variants &= self.variant_index.get((address, length), 0)
+        if not variants:
+          break
+    return variants
+
+
+_BRAND_FINGERPRINTS = get_brand_fingerprints()
+_FINGERPRINTS = get_fingerprint_list()
+FINGERPRINT_INDEX = FingerprintIndex(_BRAND_FINGERPRINTS)
+
 def is_valid_for_fingerprint(msg, car_fingerprint):
   adr = msg.address
+  if adr in _DEBUG_ADDRESS:
+    return _DEBUG_ADDRESS[adr] == len(msg.dat)
   # ignore addresses that are more than 11 bits
   return (adr in car_fingerprint and car_fingerprint[adr] == len(msg.dat)) or adr >= 0x800
 
@@ -42,19 +185,9 @@ def eliminate_incompatible_cars(msg, candidate_cars):
      Returns:
       A list containing the subset of candidate_cars that could have sent msg.
   """
-  compatible_cars = []
-
-  for car_name in candidate_cars:
-    car_fingerprints = _FINGERPRINTS[car_name]
-
-    for fingerprint in car_fingerprints:
-      fingerprint.update(_DEBUG_ADDRESS)  # add alien debug address
-
-      if is_valid_for_fingerprint(msg, fingerprint):
-        compatible_cars.append(car_name)
-        break
-
-  return compatible_cars
+  compatible = FINGERPRINT_INDEX.eliminate(msg.address, len(msg.dat), FINGERPRINT_INDEX.all_cars)
+  car_bits = FINGERPRINT_INDEX.car_bits
+  return [c for c in candidate_cars if car_bits[c] & compatible]
 
 
 def all_known_cars():
@@ -0,0 +1,3 @@
+from selfdrive.test import use_temp_caches
+
+use_temp_caches()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from selfdrive.car import fingerprints
+from selfdrive.car.fingerprints import CAR_DIR, load_car_registry, build_car_registry
+from selfdrive.car.toyota.values import CAR as TOYOTA, FINGERPRINTS as TOYOTA_FINGERPRINTS
+
+
+class TestCarRegistry(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.car_dir = os.path.join(self.tmp, "car")
+    os.mkdir(self.car_dir)
+    for brand in ["toyota", "honda"]:
+      os.mkdir(os.path.join(self.car_dir, brand))
+      shutil.copy(os.path.join(CAR_DIR, brand, "values.py"), os.path.join(self.car_dir, brand))
+    self.fn = os.path.join(self.tmp, "car_registry.pkl")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_registry(self):
+    registry = load_car_registry(self.fn, self.car_dir)
+    self.assertEqual(registry["models"][TOYOTA.PRIUS], "toyota")
+    self.assertEqual(registry["fingerprints"]["toyota"], TOYOTA_FINGERPRINTS)
+    self.assertEqual(set(registry["fingerprints"]), {"toyota", "honda"})
+    self.assertEqual(os.stat(self.fn).st_mode & 0o777, 0o644)
+
+  def test_stale(self):
+    with mock.patch.object(fingerprints, "build_car_registry", wraps=build_car_registry) as build:
+      load_car_registry(self.fn, self.car_dir)
+      load_car_registry(self.fn, self.car_dir)
+      self.assertEqual(build.call_count, 1)
+
+      with open(os.path.join(self.car_dir, "honda", "values.py"), "a") as f:
+        f.write("\n")
+      load_car_registry(self.fn, self.car_dir)
+      self.assertEqual(build.call_count, 2)
+
+      shutil.rmtree(os.path.join(self.car_dir, "honda"))
+      registry = load_car_registry(self.fn, self.car_dir)
+      self.assertEqual(build.call_count, 3)
+      self.assertEqual(set(registry["fingerprints"]), {"toyota"})
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -6,8 +6,10 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <unistd.h>
 #include <dirent.h>
+#include <fcntl.h>
 #include <sys/file.h>
 #include <sys/stat.h>
 
@@ -57,6 +59,31 @@ static int fsync_dir(const char* path){
   }
 }
 
+// Tell readers that cache params that something changed, see common/params.py.
+// Callers should hold the lock.
+static int bump_generation(const char* params_path) {
+  char path[1024];
+  int result = snprintf(path, sizeof(path), "%s/.generation", params_path);
+  if (result < 0) {
+    return result;
+  }
+
+  int fd = open(path, O_RDWR | O_CREAT, 0666);
+  if (fd < 0) {
+    return -1;
+  }
+
+  uint64_t gen = 0;
+  if (pread(fd, &gen, sizeof(gen), 0) != sizeof(gen)) {
+    gen = 0;
+  }
+  gen++;
+
+  result = pwrite(fd, &gen, sizeof(gen), 0) == sizeof(gen) ? 0 : -1;
+  close(fd);
+  return result;
+}
+
 int write_db_value(const char* params_path, const char* key, const char* value,
                    size_t value_size) {
   // Information about safely and atomically writing a file: https://lwn.net/Articles/457667/
@@ -139,6 +166,11 @@ int write_db_value(const char* params_path, const char* key, const char* value,
     goto cleanup;
   }
 
+  result = bump_generation(params_path);
+  if (result < 0) {
+    goto cleanup;
+  }
+
 cleanup:
   // Release lock.
   if (lock_fd >= 0) {
@@ -199,6 +231,11 @@ int delete_db_value(const char* params_path, const char* key) {
     goto cleanup;
   }
 
+  result = bump_generation(params_path);
+  if (result < 0) {
+    goto cleanup;
+  }
+
 cleanup:
   // Release lock.
   if (lock_fd >= 0) {
@@ -4,7 +4,7 @@ import gc
 import capnp
 from cereal import car, log
 from common.numpy_fast import clip
-from common.realtime import sec_since_boot, set_realtime_priority, Ratekeeper, DT_CTRL
+from common.realtime import sec_since_boot, set_realtime_priority, report_first_loop, Ratekeeper, DT_CTRL
 from common.profiler import Profiler
 from common.params import Params, put_nonblocking
 import cereal.messaging as messaging
@@ -67,11 +67,10 @@ def events_to_bytes(events):
   return ret
 
 
-def data_sample(CI, CC, sm, can_sock, driver_status, state, mismatch_counter, params):
+def data_sample(CI, CC, sm, can_strs, driver_status, state, mismatch_counter, params):
   """Receive data from sockets and create events for battery, temperature and disk space"""
 
   # Update carstate from CAN and create events
-  can_strs = messaging.drain_sock_raw(can_sock, wait_for_one=True)
   CS = CI.update(CC, can_strs)
 
   sm.update(0)
@@ -455,105 +454,112 @@ def data_send(sm, pm, CS, CI, CP, VM, state, events, actuators, v_cruise_kph, rk
   return CC, events_bytes
 
 
-def controlsd_thread(sm=None, pm=None, can_sock=None):
-  gc.disable()
-
-  # start the loop
-  set_realtime_priority(3)
-
-  params = Params()
-
-  is_metric = params.get("IsMetric", encoding='utf8') == "1"
-  is_ldw_enabled = params.get("IsLdwEnabled", encoding='utf8') == "1"
-  passive = params.get("Passive", encoding='utf8') == "1"
-  openpilot_enabled_toggle = params.get("OpenpilotEnabledToggle", encoding='utf8') == "1"
-  community_feature_toggle = params.get("CommunityFeaturesToggle", encoding='utf8') == "1"
-
-  passive = passive or not openpilot_enabled_toggle
-
-  # Pub/Sub Sockets
-  if pm is None:
-    pm = messaging.PubMaster(['sendcan', 'controlsState', 'carState', 'carControl', 'carEvents', 'carParams'])
-
-  if sm is None:
-    sm = messaging.SubMaster(['thermal', 'health', 'liveCalibration', 'driverMonitoring', 'plan', 'pathPlan', \
-                              'model', 'gpsLocation'], ignore_alive=['gpsLocation'])
-
-
-  if can_sock is None:
-    can_timeout = None if os.environ.get('NO_CAN_TIMEOUT', False) else 100
-    can_sock = messaging.sub_sock('can', timeout=can_timeout)
-
-  # wait for health and CAN packets
-  hw_type = messaging.recv_one(sm.sock['health']).health.hwType
-  has_relay = hw_type in [HwType.blackPanda, HwType.uno]
-  print("Waiting for CAN messages...")
-  messaging.get_one_can(can_sock)
-
-  CI, CP = get_car(can_sock, pm.sock['sendcan'], has_relay)
-
-  car_recognized = CP.carName != 'mock'
-  # If stock camera is disconnected, we loaded car controls and it's not chffrplus
-  controller_available = CP.enableCamera and CI.CC is not None and not passive
-  community_feature_disallowed = CP.communityFeature and not community_feature_toggle
-  read_only = not car_recognized or not controller_available or CP.dashcamOnly or community_feature_disallowed
-  if read_only:
-    CP.safetyModel = car.CarParams.SafetyModel.noOutput
-
-  # Write CarParams for radard and boardd safety mode
-  params.put("CarParams", CP.to_bytes())
-  params.put("LongitudinalControl", "1" if CP.openpilotLongitudinalControl else "0")
-
-  CC = car.CarControl.new_message()
-  AM = AlertManager()
-
-  startup_alert = get_startup_alert(car_recognized, controller_available)
-  AM.add(sm.frame, startup_alert, False)
-
-  LoC = LongControl(CP, CI.compute_gb)
-  VM = VehicleModel(CP)
-
-  if CP.lateralTuning.which() == 'pid':
-    LaC = LatControlPID(CP)
-  elif CP.lateralTuning.which() == 'indi':
-    LaC = LatControlINDI(CP)
-  elif CP.lateralTuning.which() == 'lqr':
-    LaC = LatControlLQR(CP)
-
-  driver_status = DriverStatus()
-  is_rhd = params.get("IsRHD")
-  if is_rhd is not None:
-    driver_status.is_rhd = bool(int(is_rhd))
-
-  state = State.disabled
-  soft_disable_timer = 0
-  v_cruise_kph = 255
-  v_cruise_kph_last = 0
-  mismatch_counter = 0
-  last_blinker_frame = 0
-  events_prev = []
-
-  sm['liveCalibration'].calStatus = Calibration.INVALID
-  sm['pathPlan'].sensorValid = True
-  sm['pathPlan'].posenetValid = True
-  sm['thermal'].freeSpace = 1.
-
-  # detect sound card presence
-  sounds_available = not os.path.isfile('/EON') or (os.path.isdir('/proc/asound/card0') and open('/proc/asound/card0/state').read().strip() == 'ONLINE')
-
-  # controlsd is driven by can recv, expected at 100Hz
-  rk = Ratekeeper(100, print_delay_threshold=None)
-
-  internet_needed = params.get("Offroad_ConnectivityNeeded", encoding='utf8') is not None
-
-  prof = Profiler(False)  # off by default
-
-  while True:
-    start_time = sec_since_boot()
+class Controlsd():
+  """Everything controlsd keeps between iterations. step() runs one iteration of the
+  control loop, controlsd_thread calls it for every CAN packet."""
+  def __init__(self, sm=None, pm=None, can_sock=None, clock=sec_since_boot):
+    self.params = Params()
+    self.clock = clock
+
+    self.is_metric = self.params.get("IsMetric", encoding='utf8') == "1"
+    self.is_ldw_enabled = self.params.get("IsLdwEnabled", encoding='utf8') == "1"
+    passive = self.params.get("Passive", encoding='utf8') == "1"
+    openpilot_enabled_toggle = self.params.get("OpenpilotEnabledToggle", encoding='utf8') == "1"
+    community_feature_toggle = self.params.get("CommunityFeaturesToggle", encoding='utf8') == "1"
+
+    passive = passive or not openpilot_enabled_toggle
+
+    # Pub/Sub Sockets
+    if pm is None:
+      pm = messaging.PubMaster(['sendcan', 'controlsState', 'carState', 'carControl', 'carEvents', 'carParams'])
+    self.pm = pm
+
+    if sm is None:
+      sm = messaging.LazySubMaster(['thermal', 'health', 'liveCalibration', 'driverMonitoring', 'plan', 'pathPlan', \
+                                    'model', 'gpsLocation'], ignore_alive=['gpsLocation'])
+    self.sm = sm
+
+    if can_sock is None:
+      can_timeout = None if os.environ.get('NO_CAN_TIMEOUT', False) else 100
+      can_sock = messaging.sub_sock('can', timeout=can_timeout)
+    self.can_sock = can_sock
+
+    # wait for health and CAN packets
+    hw_type = messaging.recv_one(sm.sock['health']).health.hwType
+    has_relay = hw_type in [HwType.blackPanda, HwType.uno]
+    print("Waiting for CAN messages...")
+    messaging.get_one_can(can_sock)
+
+    self.CI, self.CP = get_car(can_sock, pm.sock['sendcan'], has_relay)
+    CP = self.CP
+
+    car_recognized = CP.carName != 'mock'
+    # If stock camera is disconnected, we loaded car controls and it's not chffrplus
+    controller_available = CP.enableCamera and self.CI.CC is not None and not passive
+    self.community_feature_disallowed = CP.communityFeature and not community_feature_toggle
+    self.read_only = not car_recognized or not controller_available or CP.dashcamOnly or self.community_feature_disallowed
+    if self.read_only:
+      CP.safetyModel = car.CarParams.SafetyModel.noOutput
+
+    # Write CarParams for radard and boardd safety mode
+    self.params.put("CarParams", CP.to_bytes())
+    self.params.put("LongitudinalControl", "1" if CP.openpilotLongitudinalControl else "0")
+
+    self.CC = car.CarControl.new_message()
+    self.AM = AlertManager()
+
+    startup_alert = get_startup_alert(car_recognized, controller_available)
+    self.AM.add(sm.frame, startup_alert, False)
+
+    self.LoC = LongControl(CP, self.CI.compute_gb)
+    self.VM = VehicleModel(CP)
+
+    if CP.lateralTuning.which() == 'pid':
+      self.LaC = LatControlPID(CP)
+    elif CP.lateralTuning.which() == 'indi':
+      self.LaC = LatControlINDI(CP)
+    elif CP.lateralTuning.which() == 'lqr':
+      self.LaC = LatControlLQR(CP)
+
+    self.driver_status = DriverStatus()
+    is_rhd = self.params.get("IsRHD")
+    if is_rhd is not None:
+      self.driver_status.is_rhd = bool(int(is_rhd))
+
+    self.state = State.disabled
+    self.soft_disable_timer = 0
+    self.v_cruise_kph = 255
+    self.v_cruise_kph_last = 0
+    self.mismatch_counter = 0
+    self.last_blinker_frame = 0
+    self.events_prev = []
+
+    sm['liveCalibration'].calStatus = Calibration.INVALID
+    sm['pathPlan'].sensorValid = True
+    sm['pathPlan'].posenetValid = True
+    sm['thermal'].freeSpace = 1.
+
+    # detect sound card presence
+    self.sounds_available = not os.path.isfile('/EON') or (os.path.isdir('/proc/asound/card0') and open('/proc/asound/card0/state').read().strip() == 'ONLINE')
+
+    # controlsd is driven by can recv, expected at 100Hz
+    self.rk = Ratekeeper(100, print_delay_threshold=None, clock=clock)
+
+    self.internet_needed = self.params.get("Offroad_ConnectivityNeeded", encoding='utf8') is not None
+
+    self.prof = Profiler(False)  # off by default
+
+  def step(self):
+    sm, CP, prof = self.sm, self.CP, self.prof
+
+    start_time = self.clock()
     prof.checkpoint("Ratekeeper", ignore=True)
 
-    # Sample data and compute car events
-    CS, events, cal_perc, mismatch_counter = data_sample(CI, CC, sm, can_sock, driver_status, state, mismatch_counter, params)
+    # Sample data and compute car events, the loop time starts once the CAN packet is in
+    can_strs = messaging.drain_sock_batch(self.can_sock, wait_for_one=True)
+    loop_start = self.clock()
+    CS, events, cal_perc, self.mismatch_counter = data_sample(self.CI, self.CC, sm, can_strs, self.driver_status, self.state,
+                                                              self.mismatch_counter, self.params)
     prof.checkpoint("Sample")
 
     # Create alerts
@@ -573,39 +579,54 @@ def controlsd_thread(sm=None, pm=None, can_sock=None):
       events.append(create_event('radarCanError', [ET.NO_ENTRY, ET.SOFT_DISABLE]))
     if not CS.canValid:
       events.append(create_event('canError', [ET.NO_ENTRY, ET.IMMEDIATE_DISABLE]))
-    if not sounds_available:
+    if not self.sounds_available:
       events.append(create_event('soundsUnavailable', [ET.NO_ENTRY, ET.PERMANENT]))
-    if internet_needed:
+    if self.internet_needed:
       events.append(create_event('internetConnectivityNeeded', [ET.NO_ENTRY, ET.PERMANENT]))
-    if community_feature_disallowed:
+    if self.community_feature_disallowed:
       events.append(create_event('communityFeatureDisallowed', [ET.PERMANENT]))
 
     # Only allow engagement with brake pressed when stopped behind another stopped car
     if CS.brakePressed and sm['plan'].vTargetFuture >= STARTING_TARGET_SPEED and not CP.radarOffCan and CS.vEgo < 0.3:
       events.append(create_event('noTarget', [ET.NO_ENTRY, ET.IMMEDIATE_DISABLE]))
 
-    if not read_only:
+    if not self.read_only:
       # update control state
-      state, soft_disable_timer, v_cruise_kph, v_cruise_kph_last = \
-        state_transition(sm.frame, CS, CP, state, events, soft_disable_timer, v_cruise_kph, AM)
+      self.state, self.soft_disable_timer, self.v_cruise_kph, self.v_cruise_kph_last = \
+        state_transition(sm.frame, CS, CP, self.state, events, self.soft_disable_timer, self.v_cruise_kph, self.AM)
       prof.checkpoint("State transition")
 
     # Compute actuators (runs PID loops and lateral MPC)
-    actuators, v_cruise_kph, driver_status, v_acc, a_acc, lac_log, last_blinker_frame = \
-      state_control(sm.frame, sm.rcv_frame, sm['plan'], sm['pathPlan'], CS, CP, state, events, v_cruise_kph, v_cruise_kph_last, AM, rk,
-                    driver_status, LaC, LoC, read_only, is_metric, cal_perc, last_blinker_frame)
+    actuators, self.v_cruise_kph, self.driver_status, v_acc, a_acc, lac_log, self.last_blinker_frame = \
+      state_control(sm.frame, sm.rcv_frame, sm['plan'], sm['pathPlan'], CS, CP, self.state, events, self.v_cruise_kph,
+                    self.v_cruise_kph_last, self.AM, self.rk, self.driver_status, self.LaC, self.LoC, self.read_only,
+                    self.is_metric, cal_perc, self.last_blinker_frame)
 
     prof.checkpoint("State Control")
 
     # Publish data
-    CC, events_prev = data_send(sm, pm, CS, CI, CP, VM, state, events, actuators, v_cruise_kph, rk, AM, driver_status, LaC,
-                                LoC, read_only, start_time, v_acc, a_acc, lac_log, events_prev, last_blinker_frame, is_ldw_enabled)
+    self.CC, self.events_prev = data_send(sm, self.pm, CS, self.CI, CP, self.VM, self.state, events, actuators, self.v_cruise_kph,
+                                          self.rk, self.AM, self.driver_status, self.LaC, self.LoC, self.read_only, start_time,
+                                          v_acc, a_acc, lac_log, self.events_prev, self.last_blinker_frame, self.is_ldw_enabled)
     prof.checkpoint("Sent")
 
-    rk.monitor_time()
+    self.rk.monitor_time(loop_start)
     prof.display()
 
 
+def controlsd_thread(sm=None, pm=None, can_sock=None):
+  gc.disable()
+
+  # start the loop
+  set_realtime_priority(3)
+
+  controlsd = Controlsd(sm, pm, can_sock)
+  controlsd.step()
+  report_first_loop()
+  while True:
+    controlsd.step()
+
+
 def main(sm=None, pm=None, logcan=None):
   controlsd_thread(sm, pm, logcan)
 
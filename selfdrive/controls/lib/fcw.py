@@ -16,7 +16,8 @@ class FCWChecker():
     self.last_fcw_a = 0.0
     self.v_lead_max = 0.0
     self.lead_seen_t = cur_time
-    self.last_fcw_time = 0.0
+    # no holdoff until the first fcw, also on a clock that starts at 0
+    self.last_fcw_time = -float('inf')
     self.last_min_a = 0.0
 
     self.counters = defaultdict(lambda: 0)
@@ -38,10 +39,10 @@ class FCWChecker():
     delta = v_rel**2 + 2 * x_lead * a_rel
 
     # assign an arbitrary high ttc value if there is no solution to ttc
-    if delta < 0.1 or (np.sqrt(delta) + v_rel < 0.1):
-      ttc = max_ttc
-    else:
-      ttc = np.minimum(2 * x_lead / (np.sqrt(delta) + v_rel), max_ttc)
+    # masked so it also takes arrays of leads
+    sqrt_delta = np.sqrt(np.maximum(delta, 0.))
+    no_solution = (delta < 0.1) | (sqrt_delta + v_rel < 0.1)
+    ttc = np.where(no_solution, max_ttc, np.minimum(2 * x_lead / np.where(no_solution, 1., sqrt_delta + v_rel), max_ttc))
     return ttc
 
   def update(self, mpc_solution, cur_time, active, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, fcw_lead, blinkers):
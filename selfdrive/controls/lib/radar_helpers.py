@@ -1,4 +1,5 @@
-from common.kalman.simple_kalman import KF1D
+import numpy as np
+
 from selfdrive.config import RADAR_TO_CAMERA
 
 
@@ -6,154 +7,138 @@ from selfdrive.config import RADAR_TO_CAMERA
 # TODO is this a good default?
 _LEAD_ACCEL_TAU = 1.5
 
-# radar tracks
-SPEED, ACCEL = 0, 1   # Kalman filter states enum
-
 # stationary qualification parameters
 v_ego_stationary = 4.   # no stationary object flag below this speed
 
 
-class Track():
-  def __init__(self, v_lead, kalman_params):
-    self.cnt = 0
-    self.aLeadTau = _LEAD_ACCEL_TAU
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
-    self.vLead = v_lead
-    self.measured = measured   # measured or estimate
-
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
-
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+class Tracks():
+  """Radar tracks as a struct of arrays, one entry per track ordered by track id. Every
+  track runs the constant gain filter of KF1D on the lead speed, state vLeadK, aLeadK."""
+  def __init__(self, kalman_params):
+    A, C, K = kalman_params.A, kalman_params.C, kalman_params.K
+    self.K0, self.K1 = K[0][0], K[1][0]
+    self.A_K = [A[0][0] - self.K0 * C[0], A[0][1] - self.K0 * C[1],
+                A[1][0] - self.K1 * C[0], A[1][1] - self.K1 * C[1]]
+
+    self.ids = np.zeros(0, dtype=np.uint64)   # trackId
+    self.cnt = np.zeros(0, dtype=np.int64)
+    self.dRel = np.zeros(0)   # LONG_DIST
+    self.yRel = np.zeros(0)   # -LAT_DIST
+    self.vRel = np.zeros(0)   # REL_SPEED
+    self.vLead = np.zeros(0)
+    self.measured = np.zeros(0, dtype=bool)   # measured or estimate
+    self.vLeadK = np.zeros(0)
+    self.aLeadK = np.zeros(0)
+    self.aLeadTau = np.zeros(0)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def update(self, ids, d_rel, y_rel, v_rel, v_lead, measured):
+    """Replaces the tracks with the given points, ids sorted and unique. Tracks missing
+    from ids are dropped, new ones start with the filter at v_lead."""
+    known = np.isin(ids, self.ids)
+    prev = np.searchsorted(self.ids, ids[known])
+    cnt = np.zeros(len(ids), dtype=np.int64)
+    x0, x1 = np.array(v_lead, dtype=np.float64), np.zeros(len(ids))
+    a_lead_tau = np.full(len(ids), _LEAD_ACCEL_TAU)
+    cnt[known] = self.cnt[prev]
+    x0[known] = self.vLeadK[prev]
+    x1[known] = self.aLeadK[prev]
+    a_lead_tau[known] = self.aLeadTau[prev]
+
+    self.ids = ids
+    self.dRel, self.yRel, self.vRel, self.vLead, self.measured = d_rel, y_rel, v_rel, v_lead, measured
+
+    # computed velocity and accelerations, same operations as KF1D.update
+    A_K = self.A_K
+    updated = cnt > 0
+    self.vLeadK = np.where(updated, A_K[0] * x0 + A_K[1] * x1 + self.K0 * v_lead, x0)
+    self.aLeadK = np.where(updated, A_K[2] * x0 + A_K[3] * x1 + self.K1 * v_lead, x1)
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau *= 0.9
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, a_lead_tau * 0.9)
 
-    self.cnt += 1
+    self.cnt = cnt + 1
 
-  def get_key_for_cluster(self):
+  def get_keys_for_cluster(self):
     # Weigh y higher since radar is inaccurate in this dimension
-    return [self.dRel, self.yRel*2, self.vRel]
-
-  def reset_a_lead(self, aLeadK, aLeadTau):
-    self.kf = KF1D([[self.vLead], [aLeadK]], self.K_A, self.K_C, self.K_K)
-    self.aLeadK = aLeadK
-    self.aLeadTau = aLeadTau
-
-def mean(l):
-  return sum(l) / len(l)
-
-
-class Cluster():
-  def __init__(self):
-    self.tracks = set()
-
-  def add(self, t):
-    # add the first track
-    self.tracks.add(t)
-
-  # TODO: make generic
-  @property
-  def dRel(self):
-    return mean([t.dRel for t in self.tracks])
-
-  @property
-  def yRel(self):
-    return mean([t.yRel for t in self.tracks])
-
-  @property
-  def vRel(self):
-    return mean([t.vRel for t in self.tracks])
-
-  @property
-  def aRel(self):
-    return mean([t.aRel for t in self.tracks])
-
-  @property
-  def vLead(self):
-    return mean([t.vLead for t in self.tracks])
-
-  @property
-  def dPath(self):
-    return mean([t.dPath for t in self.tracks])
-
-  @property
-  def vLat(self):
-    return mean([t.vLat for t in self.tracks])
-
-  @property
-  def vLeadK(self):
-    return mean([t.vLeadK for t in self.tracks])
-
-  @property
-  def aLeadK(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return 0.
-    else:
-      return mean([t.aLeadK for t in self.tracks if t.cnt > 1])
-
-  @property
-  def aLeadTau(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return _LEAD_ACCEL_TAU
-    else:
-      return mean([t.aLeadTau for t in self.tracks if t.cnt > 1])
-
-  @property
-  def measured(self):
-    return any(t.measured for t in self.tracks)
-
-  def get_RadarState(self, model_prob=0.0):
+    return np.column_stack([self.dRel, self.yRel*2, self.vRel])
+
+  def reset_a_lead(self, mask, aLeadK, aLeadTau):
+    """Restarts the filter of the masked tracks at their lead speed and aLeadK"""
+    self.vLeadK = np.where(mask, self.vLead, self.vLeadK)
+    self.aLeadK = np.where(mask, aLeadK, self.aLeadK)
+    self.aLeadTau = np.where(mask, aLeadTau, self.aLeadTau)
+
+
+class Clusters():
+  """Means of the tracks in each cluster as a struct of arrays, idxs is the cluster of
+  every track. aLeadK and aLeadTau only average the tracks seen more than once."""
+  def __init__(self, tracks, idxs):
+    idxs = np.asarray(idxs, dtype=np.int64)
+    n = int(idxs.max()) + 1 if len(idxs) else 0
+    counts = np.bincount(idxs, minlength=n)
+
+    def mean(v, mask=None, default=0.):
+      if mask is None:
+        return np.bincount(idxs, weights=v, minlength=n) / counts
+      cnt = np.bincount(idxs[mask], minlength=n)
+      total = np.bincount(idxs[mask], weights=v[mask], minlength=n)
+      return np.where(cnt > 0, total / np.maximum(cnt, 1), default)
+
+    self.dRel = mean(tracks.dRel)
+    self.yRel = mean(tracks.yRel)
+    self.vRel = mean(tracks.vRel)
+    self.vLead = mean(tracks.vLead)
+    self.vLeadK = mean(tracks.vLeadK)
+    seen = tracks.cnt > 1
+    self.aLeadK = mean(tracks.aLeadK, seen, 0.)
+    self.aLeadTau = mean(tracks.aLeadTau, seen, _LEAD_ACCEL_TAU)
+    self.measured = np.bincount(idxs, weights=tracks.measured, minlength=n) > 0
+
+  def __len__(self):
+    return len(self.dRel)
+
+  def get_RadarState(self, i, model_prob=0.0):
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
+      "dRel": float(self.dRel[i]),
+      "yRel": float(self.yRel[i]),
+      "vRel": float(self.vRel[i]),
+      "vLead": float(self.vLead[i]),
+      "vLeadK": float(self.vLeadK[i]),
+      "aLeadK": float(self.aLeadK[i]),
       "status": True,
-      "fcw": self.is_potential_fcw(model_prob),
+      "fcw": is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "aLeadTau": float(self.aLeadTau)
-    }
-
-  def get_RadarState_from_vision(self, lead_msg, v_ego):
-    return {
-      "dRel": float(lead_msg.dist - RADAR_TO_CAMERA),
-      "yRel": float(lead_msg.relY),
-      "vRel": float(lead_msg.relVel),
-      "vLead": float(v_ego + lead_msg.relVel),
-      "vLeadK": float(v_ego + lead_msg.relVel),
-      "aLeadK": float(0),
-      "aLeadTau": _LEAD_ACCEL_TAU,
-      "fcw": False,
-      "modelProb": float(lead_msg.prob),
-      "radar": False,
-      "status": True
+      "aLeadTau": float(self.aLeadTau[i])
     }
 
   def __str__(self):
-    ret = "x: %4.1f  y: %4.1f  v: %4.1f  a: %4.1f" % (self.dRel, self.yRel, self.vRel, self.aLeadK)
-    return ret
+    return "\n".join("x: %4.1f  y: %4.1f  v: %4.1f  a: %4.1f" % (self.dRel[i], self.yRel[i], self.vRel[i], self.aLeadK[i])
+                     for i in range(len(self)))
 
-  def potential_low_speed_lead(self, v_ego):
+  def potential_low_speed_leads(self, v_ego):
     # stop for stuff in front of you and low speed, even without model confirmation
-    return abs(self.yRel) < 1.5 and (v_ego < v_ego_stationary) and self.dRel < 25
-
-  def is_potential_fcw(self, model_prob):
-    return model_prob > .9
+    return (np.abs(self.yRel) < 1.5) & (v_ego < v_ego_stationary) & (self.dRel < 25)
+
+
+def get_RadarState_from_vision(lead_msg, v_ego):
+  return {
+    "dRel": float(lead_msg.dist - RADAR_TO_CAMERA),
+    "yRel": float(lead_msg.relY),
+    "vRel": float(lead_msg.relVel),
+    "vLead": float(v_ego + lead_msg.relVel),
+    "vLeadK": float(v_ego + lead_msg.relVel),
+    "aLeadK": float(0),
+    "aLeadTau": _LEAD_ACCEL_TAU,
+    "fcw": False,
+    "modelProb": float(lead_msg.prob),
+    "radar": False,
+    "status": True
+  }
+
+
+def is_potential_fcw(model_prob):
+  return model_prob > .9
@@ -97,3 +97,73 @@ def speed_smoother(vEgo, aEgo, vT, aMax, aMin, jMax, jMin, ts):
   aEgo *= -1 if flipped else 1
 
   return float(vEgo), float(aEgo)
+
+
+def speed_smoother_batch(vEgo, aEgo, vT, aMax, aMin, jMax, jMin, ts):
+  """speed_smoother for arrays of vehicles, every branch is taken with a mask.
+  Returns (vEgo, aEgo) arrays, equal within floating point rounding to calling speed_smoother
+  on each element: numpy squares are not always the same ulp as python's x**2."""
+  vEgo, aEgo, vT, aMax, aMin, jMax, jMin, ts = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in
+                                                                      (vEgo, aEgo, vT, aMax, aMin, jMax, jMin, ts)])
+  # python's min and max, they keep the first argument when the other one is nan
+  fmin = lambda a, b: np.where(b < a, b, a)
+  fmax = lambda a, b: np.where(b > a, b, a)
+
+  with np.errstate(all='ignore'):
+    dV = vT - vEgo
+
+    # recover quickly if dV is positive and aEgo is negative or viceversa
+    jMax = np.where((dV > 0.) & (aEgo < 0.), jMax * 3., jMax)
+    jMin = np.where((dV < 0.) & (aEgo > 0.), jMin * 3., jMin)
+
+    hi = aEgo > aMax
+    lo = aEgo < aMin
+    tDelta = np.where(hi, (aMax - aEgo) / jMin, np.where(lo, (aMin - aEgo) / jMax, 0.))
+
+    early = (ts <= tDelta) & (lo | hi)
+    early_j = np.where(lo, jMax, jMin)
+    v_early = vEgo + (ts * aEgo + 0.5 * ts**2 * early_j)
+    a_early = aEgo + ts * early_j
+
+    dv_delta = np.where(hi, 0.5 * (aMax**2 - aEgo**2) / jMin, np.where(lo, 0.5 * (aMin**2 - aEgo**2) / jMax, 0.))
+    dV = np.where(hi | lo, dV - dv_delta, dV)
+    vEgo = np.where(hi | lo, vEgo + dv_delta, vEgo)
+    aEgo = np.where(hi, aEgo + tDelta * jMin, np.where(lo, aEgo + tDelta * jMax, aEgo))
+
+    ts = ts - tDelta
+
+    jLim = np.where(aEgo >= 0, jMin, jMax)
+    # if we reduce the accel to zero immediately, how much delta speed we generate?
+    dv_min_shift = - 0.5 * aEgo**2 / jLim
+
+    # flip signs so we can consider only one case
+    flipped = dV < dv_min_shift
+    dV = np.where(flipped, -dV, dV)
+    vEgo = np.where(flipped, -vEgo, vEgo)
+    aEgo = np.where(flipped, -aEgo, aEgo)
+    aMax = np.where(flipped, -aMin, aMax)
+    jMax, jMin = np.where(flipped, -jMin, jMax), np.where(flipped, -jMax, jMin)
+
+    # small addition needed to avoid numerical issues with sqrt of ~zero
+    aPeak = np.sqrt((0.5 * aEgo**2 / jMax + dV + 1e-9) / (0.5 / jMax - 0.5 / jMin))
+
+    limited = aPeak > aMax
+    aPeak = np.where(limited, aMax, aPeak)
+    t1 = (aPeak - aEgo) / jMax
+    # there is no solution, so stop after t1
+    no_solution = limited & (aPeak <= 0)
+    vChange = dV - 0.5 * (aPeak**2 - aEgo**2) / jMax + 0.5 * aPeak**2 / jMin
+    t2_limited = np.where(vChange < aPeak * ts, t1 + vChange / aPeak, t1 + ts)
+    t2 = np.where(no_solution, t1 + ts + 1e-9, np.where(limited, t2_limited, t1))
+    t3 = np.where(no_solution, t2, t2 - aPeak / jMin)
+
+    dt1 = fmin(ts, t1)
+    dt2 = fmax(fmin(ts, t2) - t1, 0.)
+    dt3 = fmax(fmin(ts, t3) - t2, 0.)
+
+    done = ts > t3
+    v_out = np.where(done, vEgo + dV, vEgo + (aEgo * dt1 + 0.5 * dt1**2 * jMax + aPeak * dt2 + aPeak * dt3 + 0.5 * dt3**2 * jMin))
+    a_out = np.where(done, 0., aEgo + (jMax * dt1 + dt3 * jMin))
+
+    sign = np.where(flipped, -1., 1.)
+    return np.where(early, v_early, v_out * sign), np.where(early, a_early, a_out * sign)
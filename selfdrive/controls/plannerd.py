@@ -3,7 +3,7 @@ import gc
 
 from cereal import car
 from common.params import Params
-from common.realtime import set_realtime_priority
+from common.realtime import DT_MDL, LoopStats, sec_since_boot, set_realtime_priority, report_first_loop
 from selfdrive.swaglog import cloudlog
 from selfdrive.controls.lib.planner import Planner
 from selfdrive.controls.lib.vehicle_model import VehicleModel
@@ -11,39 +11,59 @@ from selfdrive.controls.lib.pathplanner import PathPlanner
 import cereal.messaging as messaging
 
 
-def plannerd_thread(sm=None, pm=None):
-  gc.disable()
+class Plannerd():
+  """State of the plannerd process, step() runs one iteration of the planning loop."""
+  def __init__(self, sm=None, pm=None, clock=sec_since_boot):
+    cloudlog.info("plannerd is waiting for CarParams")
+    self.CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
+    cloudlog.info("plannerd got CarParams: %s", self.CP.carName)
 
-  # start the loop
-  set_realtime_priority(2)
+    self.PL = Planner(self.CP)
+    self.PP = PathPlanner(self.CP)
 
-  cloudlog.info("plannerd is waiting for CarParams")
-  CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
-  cloudlog.info("plannerd got CarParams: %s", CP.carName)
+    self.VM = VehicleModel(self.CP)
 
-  PL = Planner(CP)
-  PP = PathPlanner(CP)
+    if sm is None:
+      sm = messaging.LazySubMaster(['carState', 'controlsState', 'radarState', 'model', 'liveParameters'])
+    self.sm = sm
 
-  VM = VehicleModel(CP)
+    if pm is None:
+      pm = messaging.PubMaster(['plan', 'liveLongitudinalMpc', 'pathPlan', 'liveMpc'])
+    self.pm = pm
 
-  if sm is None:
-    sm = messaging.SubMaster(['carState', 'controlsState', 'radarState', 'model', 'liveParameters'])
+    sm['liveParameters'].valid = True
+    sm['liveParameters'].sensorValid = True
+    sm['liveParameters'].steerRatio = self.CP.steerRatio
+    sm['liveParameters'].stiffnessFactor = 1.0
 
-  if pm is None:
-    pm = messaging.PubMaster(['plan', 'liveLongitudinalMpc', 'pathPlan', 'liveMpc'])
+    self.clock = clock
+    # plans are made at the model rate
+    self.loop_stats = LoopStats(DT_MDL)
 
-  sm['liveParameters'].valid = True
-  sm['liveParameters'].sensorValid = True
-  sm['liveParameters'].steerRatio = CP.steerRatio
-  sm['liveParameters'].stiffnessFactor = 1.0
+  def step(self):
+    self.sm.update()
+    loop_start = self.clock()
+
+    if self.sm.updated['model']:
+      self.PP.update(self.sm, self.pm, self.CP, self.VM)
+    if self.sm.updated['radarState']:
+      self.PL.update(self.sm, self.pm, self.CP, self.VM, self.PP, self.clock())
+
+    cur_time = self.clock()
+    self.loop_stats.update(cur_time - loop_start, cur_time=cur_time)
 
-  while True:
-    sm.update()
 
-    if sm.updated['model']:
-      PP.update(sm, pm, CP, VM)
-    if sm.updated['radarState']:
-      PL.update(sm, pm, CP, VM, PP)
+def plannerd_thread(sm=None, pm=None):
+  gc.disable()
+
+  # start the loop
+  set_realtime_priority(2)
+
+  plannerd = Plannerd(sm, pm)
+  plannerd.step()
+  report_first_loop()
+  while True:
+    plannerd.step()
 
 
 def main(sm=None, pm=None):
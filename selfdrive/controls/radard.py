@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 import importlib
-import math
-from collections import defaultdict, deque
+from collections import deque
+
+import numpy as np
 
 import cereal.messaging as messaging
 from cereal import car
 from common.numpy_fast import interp
 from common.params import Params
-from common.realtime import Ratekeeper, set_realtime_priority
+from common.realtime import Ratekeeper, sec_since_boot, set_realtime_priority, report_first_loop
 from selfdrive.config import RADAR_TO_CAMERA
 from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
-from selfdrive.controls.lib.radar_helpers import Cluster, Track
+from selfdrive.controls.lib.radar_helpers import Clusters, Tracks, get_RadarState_from_vision
 from selfdrive.swaglog import cloudlog
 
 
@@ -32,29 +33,26 @@ class KalmanParams():
 
 def laplacian_cdf(x, mu, b):
   b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
+  return np.exp(-np.abs(x-mu)/b)
 
 
 def match_vision_to_cluster(v_ego, lead, clusters):
   # match vision point to best statistical cluster match
   offset_vision_dist = lead.dist - RADAR_TO_CAMERA
 
-  def prob(c):
-    prob_d = laplacian_cdf(c.dRel, offset_vision_dist, lead.std)
-    prob_y = laplacian_cdf(c.yRel, lead.relY, lead.relYStd)
-    prob_v = laplacian_cdf(c.vRel, lead.relVel, lead.relVelStd)
-
-    # This is isn't exactly right, but good heuristic
-    return prob_d * prob_y * prob_v
+  prob_d = laplacian_cdf(clusters.dRel, offset_vision_dist, lead.std)
+  prob_y = laplacian_cdf(clusters.yRel, lead.relY, lead.relYStd)
+  prob_v = laplacian_cdf(clusters.vRel, lead.relVel, lead.relVelStd)
 
-  cluster = max(clusters, key=prob)
+  # This is isn't exactly right, but good heuristic
+  i = int(np.argmax(prob_d * prob_y * prob_v))
 
-  # if no 'sane' match is found return -1
+  # if no 'sane' match is found return None
   # stationary radar points can be false positives
-  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(cluster.vRel - lead.relVel) < 10) or (v_ego + cluster.vRel > 2)
+  dist_sane = abs(clusters.dRel[i] - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(clusters.vRel[i] - lead.relVel) < 10) or (v_ego + clusters.vRel[i] > 2)
   if dist_sane and vel_sane:
-    return cluster
+    return i
   else:
     return None
 
@@ -68,18 +66,18 @@ def get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
 
   lead_dict = {'status': False}
   if cluster is not None:
-    lead_dict = cluster.get_RadarState(lead_msg.prob)
+    lead_dict = clusters.get_RadarState(cluster, lead_msg.prob)
   elif (cluster is None) and ready and (lead_msg.prob > .5):
-    lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
+    lead_dict = get_RadarState_from_vision(lead_msg, v_ego)
 
-  if low_speed_override:
-    low_speed_clusters = [c for c in clusters if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_clusters) > 0:
-      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
+  if low_speed_override and len(clusters) > 0:
+    low_speed = clusters.potential_low_speed_leads(v_ego)
+    if low_speed.any():
+      closest_cluster = int(np.argmin(np.where(low_speed, clusters.dRel, np.inf)))
 
       # Only choose new cluster if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
-        lead_dict = closest_cluster.get_RadarState()
+      if (not lead_dict['status']) or (clusters.dRel[closest_cluster] < lead_dict['dRel']):
+        lead_dict = clusters.get_RadarState(closest_cluster)
 
   return lead_dict
 
@@ -88,8 +86,8 @@ class RadarD():
   def __init__(self, radar_ts, delay=0):
     self.current_time = 0
 
-    self.tracks = defaultdict(dict)
     self.kalman_params = KalmanParams(radar_ts)
+    self.tracks = Tracks(self.kalman_params)
 
     self.last_md_ts = 0
     self.last_controls_state_ts = 0
@@ -112,55 +110,31 @@ class RadarD():
     if sm.updated['model']:
       self.ready = True
 
-    ar_pts = {}
-    for pt in rr.points:
-      ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
-
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
+    # trackId is a UInt64, it doesn't fit in a float64
+    ids = np.fromiter((pt.trackId for pt in rr.points), dtype=np.uint64, count=len(rr.points))
+    pts = np.array([(pt.dRel, pt.yRel, pt.vRel, pt.measured) for pt in rr.points], dtype=np.float64).reshape(-1, 4)
+    # sorted by track id, the last point of an id wins
+    _, last = np.unique(ids[::-1], return_index=True)
+    idxs = len(ids) - 1 - last
+    ids, pts = ids[idxs], pts[idxs]
 
     # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
-
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
-
-    idens = list(sorted(self.tracks.keys()))
-    track_pts = list([self.tracks[iden].get_key_for_cluster() for iden in idens])
-
+    # align v_ego by a fixed time to align it with the radar measurement
+    v_lead = pts[:, 2] + self.v_ego_hist[0]
+    self.tracks.update(ids, pts[:, 0], pts[:, 1], pts[:, 2], v_lead, pts[:, 3] > 0)
 
     # If we have multiple points, cluster them
-    if len(track_pts) > 1:
-      cluster_idxs = cluster_points_centroid(track_pts, 2.5)
-      clusters = [None] * (max(cluster_idxs) + 1)
-
-      for idx in range(len(track_pts)):
-        cluster_i = cluster_idxs[idx]
-        if clusters[cluster_i] is None:
-          clusters[cluster_i] = Cluster()
-        clusters[cluster_i].add(self.tracks[idens[idx]])
-    elif len(track_pts) == 1:
-      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
-      cluster_idxs = [0]
-      clusters = [Cluster()]
-      clusters[0].add(self.tracks[idens[0]])
+    if len(self.tracks) > 1:
+      cluster_idxs = cluster_points_centroid(self.tracks.get_keys_for_cluster(), 2.5)
     else:
-      clusters = []
+      # FIXME: cluster_points_centroid hangs forever with a single track
+      cluster_idxs = [0] * len(self.tracks)
+    clusters = Clusters(self.tracks, cluster_idxs)
 
     # if a new point, reset accel to the rest of the cluster
-    for idx in range(len(track_pts)):
-      if self.tracks[idens[idx]].cnt <= 1:
-        aLeadK = clusters[cluster_idxs[idx]].aLeadK
-        aLeadTau = clusters[cluster_idxs[idx]].aLeadTau
-        self.tracks[idens[idx]].reset_a_lead(aLeadK, aLeadTau)
+    if len(self.tracks):
+      cluster_idxs = np.asarray(cluster_idxs)
+      self.tracks.reset_a_lead(self.tracks.cnt <= 1, clusters.aLeadK[cluster_idxs], clusters.aLeadTau[cluster_idxs])
 
     # *** publish radarState ***
     dat = messaging.new_message()
@@ -177,65 +151,81 @@ class RadarD():
     return dat
 
 
-# fuses camera and radar data for best lead detection
-def radard_thread(sm=None, pm=None, can_sock=None):
-  set_realtime_priority(2)
+class Radard():
+  """State of the radard process, step() handles one CAN packet. The fusion itself is done by RadarD."""
+  def __init__(self, sm=None, pm=None, can_sock=None, clock=sec_since_boot):
+    # wait for stats about the car to come in from controls
+    cloudlog.info("radard is waiting for CarParams")
+    CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
+    cloudlog.info("radard got CarParams")
 
-  # wait for stats about the car to come in from controls
-  cloudlog.info("radard is waiting for CarParams")
-  CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
-  cloudlog.info("radard got CarParams")
+    # import the radar from the fingerprint
+    cloudlog.info("radard is importing %s", CP.carName)
+    RadarInterface = importlib.import_module('selfdrive.car.%s.radar_interface' % CP.carName).RadarInterface
 
-  # import the radar from the fingerprint
-  cloudlog.info("radard is importing %s", CP.carName)
-  RadarInterface = importlib.import_module('selfdrive.car.%s.radar_interface' % CP.carName).RadarInterface
+    if can_sock is None:
+      can_sock = messaging.sub_sock('can')
+    self.can_sock = can_sock
 
-  if can_sock is None:
-    can_sock = messaging.sub_sock('can')
+    if sm is None:
+      sm = messaging.LazySubMaster(['model', 'controlsState', 'liveParameters'])
+    self.sm = sm
 
-  if sm is None:
-    sm = messaging.SubMaster(['model', 'controlsState', 'liveParameters'])
+    # *** publish radarState and liveTracks
+    if pm is None:
+      pm = messaging.PubMaster(['radarState', 'liveTracks'])
+    self.pm = pm
 
-  # *** publish radarState and liveTracks
-  if pm is None:
-    pm = messaging.PubMaster(['radarState', 'liveTracks'])
+    self.RI = RadarInterface(CP)
 
-  RI = RadarInterface(CP)
+    self.clock = clock
+    self.rk = Ratekeeper(1.0 / CP.radarTimeStep, print_delay_threshold=None, clock=clock)
+    self.RD = RadarD(CP.radarTimeStep, self.RI.delay)
 
-  rk = Ratekeeper(1.0 / CP.radarTimeStep, print_delay_threshold=None)
-  RD = RadarD(CP.radarTimeStep, RI.delay)
+    self.has_radar = not CP.radarOffCan
 
-  has_radar = not CP.radarOffCan
-
-  while 1:
-    can_strings = messaging.drain_sock_raw(can_sock, wait_for_one=True)
-    rr = RI.update(can_strings)
+  def step(self):
+    can_strings = messaging.drain_sock_batch(self.can_sock, wait_for_one=True)
+    loop_start = self.clock()
+    rr = self.RI.update(can_strings)
 
     if rr is None:
-      continue
+      return
 
-    sm.update(0)
+    self.sm.update(0)
 
-    dat = RD.update(rk.frame, sm, rr, has_radar)
-    dat.radarState.cumLagMs = -rk.remaining*1000.
+    dat = self.RD.update(self.rk.frame, self.sm, rr, self.has_radar)
+    dat.radarState.cumLagMs = -self.rk.remaining*1000.
 
-    pm.send('radarState', dat)
+    self.pm.send('radarState', dat)
 
     # *** publish tracks for UI debugging (keep last) ***
-    tracks = RD.tracks
+    tracks = self.RD.tracks
     dat = messaging.new_message()
     dat.init('liveTracks', len(tracks))
 
-    for cnt, ids in enumerate(sorted(tracks.keys())):
+    for cnt, (ids, d_rel, y_rel, v_rel) in enumerate(zip(tracks.ids.tolist(), tracks.dRel.tolist(),
+                                                         tracks.yRel.tolist(), tracks.vRel.tolist())):
       dat.liveTracks[cnt] = {
         "trackId": ids,
-        "dRel": float(tracks[ids].dRel),
-        "yRel": float(tracks[ids].yRel),
-        "vRel": float(tracks[ids].vRel),
+        "dRel": d_rel,
+        "yRel": y_rel,
+        "vRel": v_rel,
       }
-    pm.send('liveTracks', dat)
+    self.pm.send('liveTracks', dat)
+
+    self.rk.monitor_time(loop_start)
 
-    rk.monitor_time()
+
+# fuses camera and radar data for best lead detection
+def radard_thread(sm=None, pm=None, can_sock=None):
+  set_realtime_priority(2)
+
+  radard = Radard(sm, pm, can_sock)
+  radard.step()
+  report_first_loop()
+  while 1:
+    radard.step()
 
 
 def main(sm=None, pm=None, can_sock=None):
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import unittest
+import numpy as np
+
+from selfdrive.controls.radard import KalmanParams
+from selfdrive.controls.lib.radar_helpers import Clusters, Tracks, _LEAD_ACCEL_TAU
+
+
+class TestTracks(unittest.TestCase):
+  def test_kalman(self):
+    kp = KalmanParams(0.05)
+    tracks = Tracks(kp)
+    ones = np.ones(2)
+
+    tracks.update(np.array([1, 2]), ones, ones, ones, np.array([10., 20.]), ones > 0)
+    np.testing.assert_array_equal(tracks.vLeadK, [10., 20.])
+    np.testing.assert_array_equal(tracks.aLeadK, [0., 0.])
+    np.testing.assert_array_equal(tracks.cnt, [1, 1])
+
+    # track 1 is gone, 3 is new
+    tracks.update(np.array([2, 3]), ones, ones, ones, np.array([21., 30.]), ones > 0)
+    np.testing.assert_array_equal(tracks.ids, [2, 3])
+    np.testing.assert_array_equal(tracks.cnt, [2, 1])
+    A, C, K = kp.A, kp.C, kp.K
+    v = (A[0][0] - K[0][0] * C[0]) * 20. + (A[0][1] - K[0][0] * C[1]) * 0. + K[0][0] * 21.
+    a = (A[1][0] - K[1][0] * C[0]) * 20. + (A[1][1] - K[1][0] * C[1]) * 0. + K[1][0] * 21.
+    self.assertEqual(tracks.vLeadK.tolist(), [v, 30.])
+    self.assertEqual(tracks.aLeadK.tolist(), [a, 0.])
+
+    tracks.reset_a_lead(tracks.cnt <= 1, np.array([5., 5.]), np.array([.3, .3]))
+    self.assertEqual(tracks.aLeadK.tolist(), [a, 5.])
+    self.assertEqual(tracks.aLeadTau.tolist(), [_LEAD_ACCEL_TAU * 0.9 if abs(a) >= 0.5 else _LEAD_ACCEL_TAU, .3])
+
+  def test_large_track_ids(self):
+    # trackId is a UInt64, these two are the same float64
+    ids = np.array([2**63, 2**63 + 1], dtype=np.uint64)
+    tracks = Tracks(KalmanParams(0.05))
+    ones = np.ones(2)
+    tracks.update(ids, ones, ones, ones, np.array([10., 20.]), ones > 0)
+    tracks.update(ids[1:], ones[1:], ones[1:], ones[1:], np.array([21.]), ones[1:] > 0)
+    self.assertEqual(tracks.ids.tolist(), [2**63 + 1])
+    self.assertEqual(tracks.cnt.tolist(), [2])
+
+  def test_clusters(self):
+    tracks = Tracks(KalmanParams(0.05))
+    n = np.arange(4.)
+    tracks.update(np.arange(4), n, n, n, n, n > 2)
+    tracks.update(np.arange(1, 5), n, n, n, n, n > 2)
+
+    clusters = Clusters(tracks, [0, 1, 0, 1])
+    np.testing.assert_array_equal(clusters.dRel, [1., 2.])
+    np.testing.assert_array_equal(clusters.measured, [False, True])
+    # the last track is new, only the others count for the accel
+    self.assertEqual(clusters.aLeadK[1], tracks.aLeadK[1])
+    self.assertEqual(clusters.aLeadTau[1], tracks.aLeadTau[1])
+
+    clusters = Clusters(tracks, [0, 0, 0, 1])
+    self.assertEqual(clusters.aLeadK[1], 0.)
+    self.assertEqual(clusters.aLeadTau[1], _LEAD_ACCEL_TAU)
+
+
+if __name__ == "__main__":
+  unittest.main()
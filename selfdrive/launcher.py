@@ -1,15 +1,46 @@
 import importlib
+import os
+import signal
+import sys
 from setproctitle import setproctitle  #pylint: disable=no-name-in-module
 
 import cereal.messaging as messaging
 import selfdrive.crash as crash
+from common.realtime import sec_since_boot
 from selfdrive.swaglog import cloudlog
 
-def launcher(proc):
+# heavy modules most python daemons need
+PREIMPORT_MODULES = [
+  "numpy",
+  "cereal.messaging",
+  "opendbc.can.parser",
+  "selfdrive.car.car_helpers",
+]
+
+def preimport(proc):
+  """Imports proc and the shared modules in the manager, so the daemons forked from it
+  start warm."""
+  for mod in PREIMPORT_MODULES + [proc]:
+    if mod not in sys.modules:
+      try:
+        importlib.import_module(mod)
+      except Exception:
+        # the child fails to import it again and reports it
+        cloudlog.exception("preimporting %s failed" % mod)
+
+def launcher(proc, launch_time=None):
+  # forked from the manager, its SIGCHLD wakeup isn't ours
+  signal.set_wakeup_fd(-1)
+  signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
   try:
-    # import the process
+    # import the process, a no-op if the manager preimported it
     mod = importlib.import_module(proc)
 
+    if launch_time is not None:
+      cloudlog.event("launcher.started", proc=proc, time_to_main=sec_since_boot() - launch_time)
+      os.environ["LAUNCH_TIME"] = repr(launch_time)
+
     # rename the process
     setproctitle(proc)
 
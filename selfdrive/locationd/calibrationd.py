@@ -8,6 +8,7 @@ import cereal.messaging as messaging
 from selfdrive.locationd.calibration_helpers import Calibration
 from selfdrive.swaglog import cloudlog
 from common.params import Params, put_nonblocking
+from common.realtime import DT_MDL, LoopStats, sec_since_boot, report_first_loop
 from common.transformations.model import model_height
 from common.transformations.camera import view_frame_from_device_frame, get_view_frame_from_road_frame, \
                                           eon_intrinsics, get_calib_from_vp, H, W
@@ -35,7 +36,12 @@ class Calibrator():
   def __init__(self, param_put=False):
     self.param_put = param_put
     self.vp = copy.copy(VP_INIT)
-    self.vps = []
+    # ring buffer of the last INPUTS_WANTED vps. Every vp is stored twice, so the window is
+    # always one contiguous slice in arrival order.
+    self.vps = np.zeros((2 * INPUTS_WANTED, 2))
+    self.vps_idx = 0
+    self.valid_points = 0
+    self.vp_sum = np.zeros(2)
     self.cal_status = Calibration.UNCALIBRATED
     self.write_counter = 0
     self.just_calibrated = False
@@ -46,14 +52,38 @@ class Calibrator():
       try:
         calibration_params = json.loads(calibration_params)
         self.vp = np.array(calibration_params["vanishing_point"])
-        self.vps = np.tile(self.vp, (calibration_params['valid_points'], 1)).tolist()
+        self.reset_vps(self.vp, calibration_params['valid_points'])
         self.update_status()
       except Exception:
         cloudlog.exception("CalibrationParams file found but error encountered")
 
+  def reset_vps(self, vp, valid_points):
+    """Fills the window with valid_points times vp"""
+    self.valid_points = min(valid_points, INPUTS_WANTED)
+    self.vps[:self.valid_points] = vp
+    self.vps[INPUTS_WANTED:INPUTS_WANTED + self.valid_points] = vp
+    self.vps_idx = self.valid_points % INPUTS_WANTED
+    self.vp_sum = np.add.reduce(self.vps[:self.valid_points], axis=0) if self.valid_points else np.zeros(2)
+
+  def add_vp(self, vp):
+    """Adds vp to the window and returns the mean of the window"""
+    self.vps[self.vps_idx] = vp
+    self.vps[self.vps_idx + INPUTS_WANTED] = vp
+    self.vps_idx = (self.vps_idx + 1) % INPUTS_WANTED
+
+    if self.valid_points < INPUTS_WANTED:
+      # same additions in the same order as summing the window, so same result
+      self.valid_points += 1
+      self.vp_sum = self.vp_sum + vp
+    else:
+      # once it slides, subtracting the oldest vp drifts from the sum of the window, sum
+      # the window again instead, a single reduction over a contiguous slice
+      self.vp_sum = np.add.reduce(self.vps[self.vps_idx:self.vps_idx + INPUTS_WANTED], axis=0)
+    return self.vp_sum / self.valid_points
+
   def update_status(self):
     start_status = self.cal_status
-    if len(self.vps) < INPUTS_NEEDED:
+    if self.valid_points < INPUTS_NEEDED:
       self.cal_status = Calibration.UNCALIBRATED
     else:
       self.cal_status = Calibration.CALIBRATED if is_calibration_valid(self.vp) else Calibration.INVALID
@@ -68,14 +98,12 @@ class Calibrator():
     if np.linalg.norm(trans) > MIN_SPEED_FILTER and abs(rot[2]) < MAX_YAW_RATE_FILTER:
       new_vp = eon_intrinsics.dot(view_frame_from_device_frame.dot(trans))
       new_vp = new_vp[:2]/new_vp[2]
-      self.vps.append(new_vp)
-      self.vps = self.vps[-INPUTS_WANTED:]
-      self.vp = np.mean(self.vps, axis=0)
+      self.vp = self.add_vp(new_vp)
       self.update_status()
       self.write_counter += 1
       if self.param_put and (self.write_counter % WRITE_CYCLES == 0 or self.just_calibrated):
         cal_params = {"vanishing_point": list(self.vp),
-                      "valid_points": len(self.vps)}
+                      "valid_points": self.valid_points}
         put_nonblocking("CalibrationParams", json.dumps(cal_params).encode('utf8'))
       return new_vp
     else:
@@ -88,31 +116,46 @@ class Calibrator():
     cal_send = messaging.new_message()
     cal_send.init('liveCalibration')
     cal_send.liveCalibration.calStatus = self.cal_status
-    cal_send.liveCalibration.calPerc = min(len(self.vps) * 100 // INPUTS_NEEDED, 100)
+    cal_send.liveCalibration.calPerc = min(self.valid_points * 100 // INPUTS_NEEDED, 100)
     cal_send.liveCalibration.extrinsicMatrix = [float(x) for x in extrinsic_matrix.flatten()]
     cal_send.liveCalibration.rpyCalib = [float(x) for x in calib]
 
     pm.send('liveCalibration', cal_send)
 
 
-def calibrationd_thread(sm=None, pm=None):
-  if sm is None:
-    sm = messaging.SubMaster(['cameraOdometry'])
+class Calibrationd():
+  """State of the calibrationd process, step() handles one cameraOdometry message."""
+  def __init__(self, sm=None, pm=None):
+    if sm is None:
+      sm = messaging.SubMaster(['cameraOdometry'])
+    self.sm = sm
 
-  if pm is None:
-    pm = messaging.PubMaster(['liveCalibration'])
+    if pm is None:
+      pm = messaging.PubMaster(['liveCalibration'])
+    self.pm = pm
 
-  calibrator = Calibrator(param_put=True)
+    self.calibrator = Calibrator(param_put=True)
+    # cameraOdometry comes at the model rate
+    self.loop_stats = LoopStats(DT_MDL)
 
-  # buffer with all the messages that still need to be input into the kalman
-  while 1:
-    sm.update()
+  def step(self):
+    self.sm.update()
+    loop_start = sec_since_boot()
 
-    new_vp = calibrator.handle_cam_odom(sm['cameraOdometry'])
+    new_vp = self.calibrator.handle_cam_odom(self.sm['cameraOdometry'])
     if DEBUG and new_vp is not None:
       print('got new vp', new_vp)
 
-    calibrator.send_data(pm)
+    self.calibrator.send_data(self.pm)
+    self.loop_stats.update(sec_since_boot() - loop_start)
+
+
+def calibrationd_thread(sm=None, pm=None):
+  calibrationd = Calibrationd(sm, pm)
+  calibrationd.step()
+  report_first_loop()
+  while 1:
+    calibrationd.step()
 
 
 def main(sm=None, pm=None):
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from selfdrive.locationd.calibrationd import Calibrator, INPUTS_WANTED, MIN_SPEED_FILTER
+from common.transformations.camera import eon_intrinsics, view_frame_from_device_frame
+
+CameraOdometry = namedtuple('CameraOdometry', ['trans', 'rot'])
+
+
+class TestCalibrator(unittest.TestCase):
+  def setUp(self):
+    self.params_dir = tempfile.mkdtemp()
+    os.environ["PARAMS_PATH"] = self.params_dir
+
+  def tearDown(self):
+    del os.environ["PARAMS_PATH"]
+    shutil.rmtree(self.params_dir)
+
+  def test_same_as_mean_of_window(self):
+    np.random.seed(0)
+    for valid_points in [0, 200, INPUTS_WANTED]:
+      c = Calibrator()
+      vps = []
+      if valid_points:
+        c.vp = np.array([585., 435.])
+        c.reset_vps(c.vp, valid_points)
+        vps = np.tile(c.vp, (valid_points, 1)).tolist()
+
+      for _ in range(3 * INPUTS_WANTED):
+        trans = np.array([MIN_SPEED_FILTER + 10., np.random.randn(), np.random.randn()])
+        new_vp = c.handle_cam_odom(CameraOdometry(trans=trans, rot=[0., 0., 0.]))
+
+        expected_vp = eon_intrinsics.dot(view_frame_from_device_frame.dot(trans))
+        vps.append(expected_vp[:2] / expected_vp[2])
+        vps = vps[-INPUTS_WANTED:]
+        np.testing.assert_array_equal(new_vp, vps[-1])
+        # bit for bit, not almost equal
+        self.assertEqual(c.vp.tolist(), np.mean(vps, axis=0).tolist())
+        self.assertEqual(c.valid_points, len(vps))
+
+  def test_filtered(self):
+    c = Calibrator()
+    self.assertIsNone(c.handle_cam_odom(CameraOdometry(trans=[1., 0., 0.], rot=[0., 0., 0.])))
+    self.assertEqual(c.valid_points, 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,32 +1,169 @@
 #!/usr/bin/env python3
 import os
-import shutil
 import threading
 from selfdrive.swaglog import cloudlog
-from selfdrive.loggerd.config import ROOT, get_available_percent
-from selfdrive.loggerd.uploader import listdir_by_creation
+from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.uploader import get_directory_sort, get_upload_sort
 
+MIN_FREE_PERCENT = 10.0
 
-def deleter_thread(exit_event):
-  while not exit_event.is_set():
-    available_percent = get_available_percent()
+RAW_CAMERA_FILES = ["fcamera.hevc", "dcamera.hevc"]
+
+
+class FS():
+  """Filesystem calls of the deleter, tests replace it with a fake"""
+  def statvfs(self, path):
+    return os.statvfs(path)
+
+  def listdir(self, path):
+    return os.listdir(path)
+
+  def stat(self, path):
+    return os.stat(path)
+
+  def remove(self, path):
+    os.remove(path)
+
+  def rmdir(self, path):
+    os.rmdir(path)
 
-    if available_percent < 10.0:
-      # remove the earliest directory we can
-      dirs = listdir_by_creation(ROOT)
-      for delete_dir in dirs:
-        delete_path = os.path.join(ROOT, delete_dir)
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+def disk_usage(st):
+  # allocated size, that's what deleting frees
+  blocks = getattr(st, "st_blocks", None)
+  return blocks * 512 if blocks is not None else st.st_size
+
+
+class SegmentIndex():
+  """The segments in root in creation order with the size of their files. A segment is
+  only listed again when the mtime of its directory changed."""
+  def __init__(self, root, fs):
+    self.root = root
+    self.fs = fs
+    self.lognames = []
+    # logname -> (directory mtime, {name: size})
+    self.segments = {}
+
+  def refresh(self):
+    try:
+      lognames = set(self.fs.listdir(self.root))
+    except OSError:
+      cloudlog.exception("deleter: listing %s failed" % self.root)
+      lognames = set()
+
+    for logname in set(self.segments) - lognames:
+      del self.segments[logname]
+
+    for logname in lognames:
+      path = os.path.join(self.root, logname)
+      try:
+        mtime = self.fs.stat(path).st_mtime_ns
+        if logname in self.segments and self.segments[logname][0] == mtime:
           continue
+        files = {}
+        for name in self.fs.listdir(path):
+          try:
+            files[name] = disk_usage(self.fs.stat(os.path.join(path, name)))
+          except OSError:
+            pass
+        self.segments[logname] = (mtime, files)
+      except OSError:
+        # not a directory or deleted meanwhile
+        self.segments.pop(logname, None)
+
+    if set(self.lognames) != set(self.segments):
+      self.lognames = sorted(self.segments, key=get_directory_sort)
+
+  def files(self, logname):
+    return self.segments[logname][1]
+
+  def is_locked(self, logname):
+    return any(name.endswith(".lock") for name in self.files(logname))
+
+
+def delete_priority(name, files):
+  """Lower goes first: raw camera before logs, then segments with the qlog uploaded
+  (the uploader removes uploaded files) before the ones without"""
+  is_log = name not in RAW_CAMERA_FILES
+  not_uploaded = "qlog.bz2" in files
+  return (is_log, not_uploaded)
+
+
+def plan_deletion(index, bytes_to_free):
+  """Returns the [(logname, name, size)] to delete to free bytes_to_free, in order.
+  Within a priority older segments go first, within a segment the files the uploader
+  would send last. Locked segments are never deleted from."""
+  candidates = []
+  for age, logname in enumerate(index.lognames):
+    if index.is_locked(logname):
+      continue
+    files = index.files(logname)
+    for name, size in files.items():
+      candidates.append((delete_priority(name, files), age, -get_upload_sort(name), name, logname, size))
+  candidates.sort()
+
+  plan = []
+  freed = 0
+  for _, _, _, name, logname, size in candidates:
+    if freed >= bytes_to_free:
+      break
+    plan.append((logname, name, size))
+    freed += size
+  return plan
+
+
+class Deleter():
+  def __init__(self, root, fs=None, min_free_percent=MIN_FREE_PERCENT):
+    self.root = root
+    self.fs = fs if fs is not None else FS()
+    self.min_free_percent = min_free_percent
+    self.index = SegmentIndex(root, self.fs)
+
+  def bytes_to_free(self):
+    try:
+      st = self.fs.statvfs(self.root)
+    except OSError:
+      return 0
+    missing_blocks = st.f_blocks * self.min_free_percent / 100. - st.f_bavail
+    return int(missing_blocks * st.f_frsize) if missing_blocks > 0 else 0
+
+  def delete(self, bytes_to_free):
+    """Deletes the planned files, then the segment directories left empty. Returns the plan."""
+    self.index.refresh()
+    plan = plan_deletion(self.index, bytes_to_free)
+    cloudlog.info("deleter: freeing %d bytes, deleting %d files" % (bytes_to_free, len(plan)))
+
+    for logname, name, _ in plan:
+      try:
+        self.fs.remove(os.path.join(self.root, logname, name))
+      except FileNotFoundError:
+        # uploaded meanwhile
+        pass
+      except OSError:
+        cloudlog.exception("issue deleting %s" % os.path.join(self.root, logname, name))
+
+    for logname in set(logname for logname, _, _ in plan):
+      path = os.path.join(self.root, logname)
+      try:
+        if not self.fs.listdir(path):
+          self.fs.rmdir(path)
+      except OSError:
+        cloudlog.exception("issue deleting %s" % path)
+
+    return plan
+
+
+def deleter_thread(exit_event):
+  deleter = Deleter(ROOT)
+  while not exit_event.is_set():
+    bytes_to_free = deleter.bytes_to_free()
 
-        try:
-          cloudlog.info("deleting %s" % delete_path)
-          shutil.rmtree(delete_path)
-          break
-        except OSError:
-          cloudlog.exception("issue deleting %s" % delete_path)
-      exit_event.wait(.1)
+    if bytes_to_free > 0:
+      if deleter.delete(bytes_to_free):
+        exit_event.wait(.1)
+      else:
+        # everything left is locked
+        exit_event.wait(5)
     else:
       exit_event.wait(30)
 
@@ -3,7 +3,11 @@ import errno
 import shutil
 import random
 import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
 
 import selfdrive.loggerd.uploader as uploader
 
@@ -32,15 +36,83 @@ class MockResponse():
     self.text = text
 
 class MockApi():
+  url = "http://localhost/does/not/exist"
+
   def __init__(self, dongle_id):
     pass
 
   def get(self, *args, **kwargs):
-    return MockResponse('{"url": "http://localhost/does/not/exist", "headers": {}}')
+    return MockResponse('{"url": "%s/%s?sig=fake", "headers": {"x-ms-blob-type": "BlockBlob"}}' % (self.url, kwargs.get("path")))
 
   def get_token(self):
     return "fake-token"
 
+class FakeBlobServer(ThreadingMixIn, HTTPServer):
+  """Local stand-in for the block blob upload urls. Every fail_every-th block upload
+  gets a 500, blocks are kept until they are committed with a block list."""
+  daemon_threads = True
+
+  def __init__(self, fail_every=0):
+    self.blobs = {}
+    self.blocks = {}
+    self.requests = []
+    self.fail_every = fail_every
+    self.block_puts = 0
+    self.lock = threading.Lock()
+    HTTPServer.__init__(self, ("127.0.0.1", 0), FakeBlobHandler)
+    self.url = "http://127.0.0.1:%d" % self.server_address[1]
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+class FakeBlobHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, code, body=b""):
+    self.send_response(code)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    with self.server.lock:
+      self.server.requests.append(("GET", url.path, query.get("comp", [None])[0]))
+      blocks = self.server.blocks.get(url.path, {})
+      body = "".join("<Block><Name>%s</Name><Size>%d</Size></Block>" % (k, len(v)) for k, v in blocks.items())
+    self.reply(200, ("<BlockList><UncommittedBlocks>%s</UncommittedBlocks></BlockList>" % body).encode())
+
+  def do_PUT(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    data = self.rfile.read(int(self.headers["Content-Length"]))
+    comp = query.get("comp", [None])[0]
+    with self.server.lock:
+      self.server.requests.append(("PUT", url.path, comp))
+      if comp == "block":
+        self.server.block_puts += 1
+        if self.server.fail_every and self.server.block_puts % self.server.fail_every == 0:
+          self.reply(500)
+          return
+        self.server.blocks.setdefault(url.path, {})[query["blockid"][0]] = data
+      elif comp == "blocklist":
+        blocks = self.server.blocks.pop(url.path, {})
+        ids = [l.split("</Latest>")[0] for l in data.decode().split("<Latest>")[1:]]
+        if any(i not in blocks for i in ids):
+          self.reply(400)
+          return
+        self.server.blobs[url.path] = b"".join(blocks[i] for i in ids)
+      else:
+        self.server.blobs[url.path] = data
+    self.reply(201)
+
 class MockParams():
   def __init__(self):
     self.params = {
@@ -1,6 +1,7 @@
 import os
 import time
 import threading
+import unittest
 from collections import namedtuple
 
 import selfdrive.loggerd.deleter as deleter
@@ -8,7 +9,43 @@ from common.timeout import Timeout, TimeoutException
 
 from selfdrive.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
-Stats = namedtuple("Stats", ['f_bavail', 'f_blocks'])
+Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
+FileStat = namedtuple("FileStat", ['st_size', 'st_mtime_ns'])
+
+class FakeFS():
+  def __init__(self, segments, f_bavail=0, f_blocks=100, f_frsize=1000):
+    # logname -> {name: size}
+    self.segments = segments
+    self.stats = Stats(f_bavail=f_bavail, f_blocks=f_blocks, f_frsize=f_frsize)
+    self.mtimes = {logname: 0 for logname in segments}
+    self.calls = []
+
+  def statvfs(self, path):
+    return self.stats
+
+  def listdir(self, path):
+    self.calls.append(("listdir", path))
+    if path == "/root":
+      return list(self.segments)
+    return list(self.segments[os.path.basename(path)])
+
+  def stat(self, path):
+    logname, name = os.path.relpath(path, "/root"), None
+    if "/" in logname:
+      logname, name = logname.split("/")
+    if logname not in self.segments:
+      raise FileNotFoundError(path)
+    if name is None:
+      return FileStat(0, self.mtimes[logname])
+    return FileStat(self.segments[logname][name], 0)
+
+  def remove(self, path):
+    logname, name = os.path.relpath(path, "/root").split("/")
+    del self.segments[logname][name]
+    self.mtimes[logname] += 1
+
+  def rmdir(self, path):
+    del self.segments[os.path.basename(path)]
 
 class TestDeleter(UploaderTestCase):
   def fake_statvfs(self, d):
@@ -17,7 +54,7 @@ class TestDeleter(UploaderTestCase):
   def setUp(self):
     self.f_type = "fcamera.hevc"
     super(TestDeleter, self).setUp()
-    self.fake_stats = Stats(f_bavail=0, f_blocks=10)
+    self.fake_stats = Stats(f_bavail=0, f_blocks=10, f_frsize=4096)
     deleter.os.statvfs = self.fake_statvfs
     deleter.ROOT = self.root
 
@@ -68,7 +105,7 @@ class TestDeleter(UploaderTestCase):
   def test_no_delete_when_available_space(self):
     f_path = self.make_file_with_data(self.seg_dir, self.f_type)
 
-    self.fake_stats = Stats(f_bavail=10, f_blocks=10)
+    self.fake_stats = Stats(f_bavail=10, f_blocks=10, f_frsize=4096)
 
     self.start_thread()
 
@@ -98,3 +135,63 @@ class TestDeleter(UploaderTestCase):
       self.join_thread()
 
     self.assertTrue(os.path.exists(f_path), "File deleted when locked")
+
+
+class TestDeletePolicy(unittest.TestCase):
+  def setUp(self):
+    self.seg = ["2019-04-18--12-52-54--%d" % i for i in range(4)]
+
+  def plan(self, fs, bytes_to_free):
+    d = deleter.Deleter("/root", fs)
+    return [(logname, name) for logname, name, _ in d.delete(bytes_to_free)]
+
+  def test_bytes_to_free(self):
+    fs = FakeFS({}, f_bavail=4, f_blocks=100, f_frsize=1000)
+    self.assertEqual(deleter.Deleter("/root", fs).bytes_to_free(), 6000)
+    fs.stats = Stats(f_bavail=20, f_blocks=100, f_frsize=1000)
+    self.assertEqual(deleter.Deleter("/root", fs).bytes_to_free(), 0)
+
+  def test_camera_first(self):
+    fs = FakeFS({
+      self.seg[0]: {"rlog.bz2": 100, "qlog.bz2": 10},
+      self.seg[1]: {"rlog.bz2": 100, "qlog.bz2": 10, "fcamera.hevc": 1000},
+      self.seg[2]: {"rlog.bz2": 100, "qlog.bz2": 10, "dcamera.hevc": 1000, "fcamera.hevc": 1000},
+    })
+    self.assertEqual(self.plan(fs, 2500), [(self.seg[1], "fcamera.hevc"), (self.seg[2], "dcamera.hevc"),
+                                           (self.seg[2], "fcamera.hevc")])
+    self.assertEqual(self.plan(fs, 100), [(self.seg[0], "rlog.bz2")])
+    self.assertEqual(self.plan(fs, 10), [(self.seg[0], "qlog.bz2")])
+    # empty segment directories are removed
+    self.assertNotIn(self.seg[0], fs.segments)
+
+  def test_uploaded_first(self):
+    fs = FakeFS({
+      self.seg[0]: {"rlog.bz2": 100, "qlog.bz2": 10},
+      self.seg[1]: {"rlog.bz2": 100},
+      self.seg[2]: {"fcamera.hevc": 100, "qlog.bz2": 10},
+      self.seg[3]: {"fcamera.hevc": 100},
+    })
+    self.assertEqual(self.plan(fs, 350), [(self.seg[3], "fcamera.hevc"), (self.seg[2], "fcamera.hevc"),
+                                          (self.seg[1], "rlog.bz2"), (self.seg[0], "rlog.bz2")])
+
+  def test_skip_locked(self):
+    fs = FakeFS({
+      self.seg[0]: {"fcamera.hevc": 100, "fcamera.hevc.lock": 0},
+      self.seg[1]: {"fcamera.hevc": 100},
+    })
+    self.assertEqual(self.plan(fs, 1000), [(self.seg[1], "fcamera.hevc")])
+    self.assertEqual(self.plan(fs, 1000), [])
+
+  def test_index_relists_changed_segments_only(self):
+    fs = FakeFS({
+      self.seg[0]: {"rlog.bz2": 100},
+      self.seg[1]: {"rlog.bz2": 100, "qlog.bz2": 10},
+    })
+    d = deleter.Deleter("/root", fs)
+    d.index.refresh()
+    fs.calls = []
+    fs.segments[self.seg[1]].pop("qlog.bz2")
+    fs.mtimes[self.seg[1]] += 1
+    d.index.refresh()
+    self.assertEqual(fs.calls, [("listdir", "/root"), ("listdir", "/root/" + self.seg[1])])
+    self.assertEqual(d.index.files(self.seg[1]), {"rlog.bz2": 100})
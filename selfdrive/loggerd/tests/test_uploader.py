@@ -3,13 +3,15 @@ import time
 import threading
 import logging
 import json
+import unittest
 
+from cereal import log
 from selfdrive.swaglog import cloudlog
 import selfdrive.loggerd.uploader as uploader
 
 from common.timeout import Timeout
 
-from selfdrive.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from selfdrive.loggerd.tests.loggerd_tests_common import UploaderTestCase, FakeBlobServer, MockApi
 
 class TestLogHandler(logging.Handler):
   def __init__(self):
@@ -27,6 +29,8 @@ class TestLogHandler(logging.Handler):
     except BaseException:
       pass
 
+ThermalStatus = log.ThermalData.ThermalStatus
+
 log_handler = TestLogHandler()
 cloudlog.addHandler(log_handler)
 
@@ -114,3 +118,160 @@ class TestUploader(UploaderTestCase):
 
     for f_path in f_paths:
       self.assertTrue(os.path.exists(f_path), "File upload when locked")
+
+  def test_upload_order_by_size(self):
+    # within a segment and priority class smaller files go first
+    self.make_file_with_data(self.seg_dir, "rlog.bz2", 0.2)
+    self.make_file_with_data(self.seg_dir, "fcamera.hevc", 0.1)
+    self.make_file_with_data(self.seg_dir, "qlog.bz2", 0.1)
+
+    up = uploader.Uploader("0000000000000000", self.root)
+    self.assertEqual(up.next_file_to_upload(with_raw=False)[0], f"{self.seg_dir}/qlog.bz2")
+    up.index.remove(f"{self.seg_dir}/qlog.bz2")
+    self.assertIsNone(up.next_file_to_upload(with_raw=False))
+    self.assertEqual(up.next_file_to_upload(with_raw=True)[0], f"{self.seg_dir}/fcamera.hevc")
+
+  def test_index_picks_up_new_segments(self):
+    up = uploader.Uploader("0000000000000000", self.root)
+    self.assertIsNone(up.next_file_to_upload(with_raw=True))
+
+    f_paths = self.gen_files(lock=True)
+    self.assertIsNone(up.next_file_to_upload(with_raw=True), "Upload from locked segment")
+
+    # segment closed
+    for f_path in f_paths:
+      os.remove(f_path + ".lock")
+    if up.index.watcher is None:
+      up.index.last_scan = 0
+    self.assertEqual(up.next_file_to_upload(with_raw=True), (f"{self.seg_dir}/qlog.bz2", f_paths[1]))
+
+  def test_index_relists_unwatched_segments(self):
+    up = uploader.Uploader("0000000000000000", self.root)
+    self.assertIsNone(up.next_file_to_upload(with_raw=True))
+    if not up.index.root_watched:
+      self.skipTest("inotify not available")
+
+    # out of inotify watches for the segments
+    watch = up.index._watch
+    up.index._watch = lambda path, mask: path == self.root and watch(path, mask)
+    f_paths = self.gen_files(lock=True)
+    self.assertIsNone(up.next_file_to_upload(with_raw=True), "Upload from locked segment")
+    self.assertIn(self.seg_dir, up.index.unwatched)
+
+    # segment closed without an event for it
+    for f_path in f_paths:
+      os.remove(f_path + ".lock")
+    self.assertIsNone(up.next_file_to_upload(with_raw=True))
+
+    up.index._watch = watch
+    up.index.last_relist = 0
+    self.assertEqual(up.next_file_to_upload(with_raw=True), (f"{self.seg_dir}/qlog.bz2", f_paths[1]))
+    self.assertNotIn(self.seg_dir, up.index.unwatched)
+
+
+class TestChunkedUpload(UploaderTestCase):
+  def setUp(self):
+    super(TestChunkedUpload, self).setUp()
+    uploader.fake_upload = False
+    self.chunk_size = uploader.UPLOAD_CHUNK_SIZE
+    uploader.UPLOAD_CHUNK_SIZE = 64 * 1024
+
+  def tearDown(self):
+    uploader.UPLOAD_CHUNK_SIZE = self.chunk_size
+    self.server.stop()
+    super(TestChunkedUpload, self).tearDown()
+
+  def start_server(self, fail_every=0):
+    self.server = FakeBlobServer(fail_every)
+    MockApi.url = self.server.url
+
+  def upload(self, fn):
+    with open(os.path.join(self.root, self.seg_dir, fn), "rb") as f:
+      data = f.read()
+    up = uploader.Uploader("0000000000000000", self.root)
+    key = os.path.join(self.seg_dir, fn)
+    success = up.upload(key, os.path.join(self.root, key))
+    return up, data, success
+
+  def test_chunked_upload(self):
+    self.start_server()
+    self.make_file_with_data(self.seg_dir, "rlog.bz2", 1)
+    _, data, success = self.upload("rlog.bz2")
+
+    self.assertTrue(success)
+    self.assertEqual(self.server.blobs[f"/{self.seg_dir}/rlog.bz2"], data)
+    self.assertEqual(self.server.block_puts, 16)
+
+  def test_small_file_single_put(self):
+    self.start_server()
+    self.make_file_with_data(self.seg_dir, "qlog.bz2", 0.01)
+    _, data, success = self.upload("qlog.bz2")
+
+    self.assertTrue(success)
+    self.assertEqual(self.server.blobs[f"/{self.seg_dir}/qlog.bz2"], data)
+    self.assertEqual(self.server.requests, [("PUT", f"/{self.seg_dir}/qlog.bz2", None)])
+
+  def test_retry_failed_blocks(self):
+    self.start_server(fail_every=3)
+    self.make_file_with_data(self.seg_dir, "fcamera.hevc", 1)
+    _, data, success = self.upload("fcamera.hevc")
+
+    self.assertTrue(success)
+    self.assertEqual(self.server.blobs[f"/{self.seg_dir}/fcamera.hevc"], data)
+
+  def test_resume(self):
+    self.start_server()
+    self.make_file_with_data(self.seg_dir, "rlog.bz2", 1)
+    with open(os.path.join(self.root, self.seg_dir, "rlog.bz2"), "rb") as f:
+      data = f.read()
+
+    # a previous attempt got the first half of the blocks through
+    up = uploader.Uploader("0000000000000000", self.root)
+    path = f"/{self.seg_dir}/rlog.bz2"
+    for offset in range(0, len(data) // 2, uploader.UPLOAD_CHUNK_SIZE):
+      block_id = uploader.base64.b64encode(b"%012d" % offset).decode()
+      up.put_block(self.server.url + path, {}, os.path.join(self.root, self.seg_dir, "rlog.bz2"),
+                   offset, uploader.UPLOAD_CHUNK_SIZE, block_id)
+    self.assertEqual(self.server.block_puts, 8)
+
+    _, data, success = self.upload("rlog.bz2")
+    self.assertTrue(success)
+    self.assertEqual(self.server.blobs[path], data)
+    self.assertEqual(self.server.block_puts, 16)
+
+
+class TestUploadScheduler(unittest.TestCase):
+  def test_rates(self):
+    bucket = uploader.TokenBucket(None)
+    scheduler = uploader.UploadScheduler(bucket, target_rate=1e6, cpu_budget=50)
+    self.assertEqual(bucket.rate, 1e6)
+
+    scheduler.update(ThermalStatus.yellow, 10)
+    self.assertEqual(bucket.rate, 0.25e6)
+    scheduler.update(ThermalStatus.green, 80)
+    self.assertEqual(bucket.rate, 0.5e6)
+    scheduler.update(ThermalStatus.red, 10)
+    self.assertEqual(bucket.rate, 0.)
+    scheduler.update(ThermalStatus.green, 10)
+    self.assertEqual(bucket.rate, 1e6)
+
+  def test_token_bucket(self):
+    bucket = uploader.TokenBucket(1e6, burst=0.1)
+    t = time.monotonic()
+    for _ in range(10):
+      bucket.consume(50000)
+    # 500 kB at 1 MB/s
+    self.assertGreater(time.monotonic() - t, 0.35)
+
+    bucket.set_rate(0)
+    self.assertGreater(bucket.delay(1), 0)
+    bucket.set_rate(None)
+    self.assertEqual(bucket.delay(1e9), 0)
+
+  def test_ttl_cache(self):
+    calls = []
+    check = uploader.TTLCache(lambda: calls.append(1) or len(calls), 0.1)
+    self.assertEqual(check(), 1)
+    self.assertEqual(check(), 1)
+    time.sleep(0.15)
+    self.assertEqual(check(), 2)
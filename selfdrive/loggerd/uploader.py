@@ -3,6 +3,8 @@ import os
 import re
 import time
 import json
+import base64
+import bisect
 import random
 import ctypes
 import inspect
@@ -10,16 +12,33 @@ import requests
 import traceback
 import threading
 import subprocess
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
+import cereal.messaging as messaging
+from cereal import log
 from selfdrive.swaglog import cloudlog
 from selfdrive.loggerd.config import ROOT
 
 from common import android
+from common import inotify
 from common.params import Params
 from common.api import Api
 
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
+# files larger than a chunk are uploaded as blocks of a block blob, in parallel
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_WORKERS = 3
+UPLOAD_BLOCK_RETRIES = 3
+UPLOAD_TIMEOUT = (10, 30)  # connect, read, per request
+
+UPLOAD_RATE = 5e6  # bytes/s
+UPLOAD_CPU_BUDGET = 70  # percent
+NETWORK_CHECK_TTL = 10.  # s
+
+ThermalStatus = log.ThermalData.ThermalStatus
+
 def raise_on_thread(t, exctype):
   for ctid, tobj in threading._active.items():
     if tobj is t:
@@ -64,6 +83,113 @@ def clear_locks(root):
     except OSError:
       cloudlog.exception("clear_locks failed")
 
+class TTLCache():
+  """Calls fn at most once every ttl seconds, returns the last result in between"""
+  def __init__(self, fn, ttl):
+    self.fn = fn
+    self.ttl = ttl
+    self.t = None
+    self.value = None
+
+  def __call__(self):
+    now = time.monotonic()
+    if self.t is None or now - self.t > self.ttl:
+      self.value = self.fn()
+      self.t = now
+    return self.value
+
+class TokenBucket():
+  """Limits the upload rate. rate is in bytes/s, None doesn't limit and 0 pauses until the
+  rate is raised again. Thread safe, shared by all upload workers."""
+  def __init__(self, rate, burst=1.):
+    self.lock = threading.Lock()
+    self.rate = rate
+    self.burst = burst
+    self.tokens = 0.
+    self.t = time.monotonic()
+
+  def set_rate(self, rate):
+    with self.lock:
+      self._refill()
+      self.rate = rate
+
+  def _refill(self):
+    now = time.monotonic()
+    if self.rate:
+      self.tokens = min(self.tokens + (now - self.t) * self.rate, self.rate * self.burst)
+    self.t = now
+
+  def delay(self, n):
+    """Takes n tokens if there are any left, returns how long to wait otherwise. Going below
+    zero lets chunks bigger than the burst through, the next caller waits for them."""
+    with self.lock:
+      if self.rate is None:
+        return 0.
+      self._refill()
+      if self.rate == 0:
+        return 1.
+      if self.tokens > 0:
+        self.tokens -= n
+        return 0.
+      return max(-self.tokens / self.rate, 0.01)
+
+  def consume(self, n):
+    while True:
+      d = self.delay(n)
+      if d == 0.:
+        return
+      time.sleep(min(d, 1.))
+
+class ThrottledFile():
+  """File wrapper for requests that takes tokens for every read"""
+  def __init__(self, f, size, bucket):
+    self.f = f
+    self.size = size
+    self.bucket = bucket
+
+  def __len__(self):
+    return self.size
+
+  def read(self, n=-1):
+    dat = self.f.read(n)
+    self.bucket.consume(len(dat))
+    return dat
+
+class UploadScheduler():
+  """Sets the upload rate from thermal: the full target rate when green, a quarter of it when
+  yellow and paused from red up. Above the cpu budget the rate is halved."""
+  def __init__(self, bucket, target_rate=UPLOAD_RATE, cpu_budget=UPLOAD_CPU_BUDGET):
+    self.bucket = bucket
+    self.target_rate = target_rate
+    self.cpu_budget = cpu_budget
+    self.bucket.set_rate(target_rate)
+
+  def get_rate(self, thermal_status, cpu_perc):
+    if thermal_status >= ThermalStatus.red:
+      return 0.
+    rate = self.target_rate
+    if thermal_status >= ThermalStatus.yellow:
+      rate *= 0.25
+    if cpu_perc > self.cpu_budget:
+      rate *= 0.5
+    return rate
+
+  def update(self, thermal_status, cpu_perc):
+    rate = self.get_rate(thermal_status, cpu_perc)
+    if rate != self.bucket.rate:
+      cloudlog.info("upload rate %r, thermal status %r, cpu %r", rate, thermal_status, cpu_perc)
+      self.bucket.set_rate(rate)
+
+  def thermal_thread(self):
+    thermal_sock = messaging.sub_sock('thermal', conflate=True)
+    while True:
+      msg = messaging.recv_sock(thermal_sock, wait=True)
+      self.update(msg.thermal.thermalStatus, msg.thermal.cpuPerc)
+
+  def start(self):
+    # on its own thread, the rate also changes in the middle of an upload
+    threading.Thread(target=self.thermal_thread, daemon=True).start()
+
 def is_on_wifi():
   # ConnectivityManager.getActiveNetworkInfo()
   try:
@@ -85,75 +211,278 @@ def is_on_hotspot():
   except:
     return False
 
+IMMEDIATE_PRIORITY = {"qlog.bz2": 0, "qcamera.ts": 1}
+HIGH_PRIORITY = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2}
+
+def get_upload_sort(name):
+  if name in IMMEDIATE_PRIORITY:
+    return IMMEDIATE_PRIORITY[name]
+  if name in HIGH_PRIORITY:
+    return HIGH_PRIORITY[name] + 100
+  return 1000
+
+def get_priority_class(name):
+  # 0: qlogs, 1: full logs and cameras, 2: everything else, None: not uploaded
+  if name in IMMEDIATE_PRIORITY:
+    return 0
+  if name in HIGH_PRIORITY:
+    return 1
+  if not name.endswith('.lock') and not name.endswith(".tmp"):
+    return 2
+  return None
+
+class UploadIndex():
+  """The files in root by segment, in upload order. Segment directories are only listed again
+  when inotify reports a change in them, e.g. loggerd removing the .lock when a segment is
+  closed. Without inotify root is rescanned every rescan_interval seconds, segments that
+  couldn't be watched (e.g. out of inotify watches) are listed again at the same interval."""
+  WATCH_ROOT = inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_MOVED_FROM
+  WATCH_SEGMENT = WATCH_ROOT | inotify.IN_CLOSE_WRITE
+
+  def __init__(self, root, rescan_interval=10.):
+    self.root = root
+    self.rescan_interval = rescan_interval
+    self.last_scan = None
+    self.last_relist = None
+    self.root_watched = False
+    # segments without a watch, listed again every rescan_interval
+    self.unwatched = set()
+
+    # lognames and their sort keys, in creation order
+    self.lognames = []
+    self.sort_keys = []
+    # logname -> (name, size) sorted by upload priority, empty for locked segments
+    self.segments = {}
+
+    self.watcher = None
+    if inotify.available():
+      try:
+        self.watcher = inotify.Watcher()
+      except OSError:
+        cloudlog.exception("upload index: inotify failed, rescanning instead")
+
+  def close(self):
+    if self.watcher is not None:
+      self.watcher.close()
+      self.watcher = None
+
+  def _watch(self, path, mask):
+    if self.watcher is None:
+      return False
+    try:
+      self.watcher.add_watch(path, mask)
+      return True
+    except OSError:
+      return False
+
+  def scan(self):
+    self.last_scan = time.monotonic()
+    self.lognames, self.sort_keys, self.segments = [], [], {}
+    self.unwatched = set()
+    self.last_relist = self.last_scan
+    self.root_watched = self._watch(self.root, self.WATCH_ROOT)
+    if not os.path.isdir(self.root):
+      return
+    for logname in listdir_by_creation(self.root):
+      self.update_segment(logname)
+
+  def update_segment(self, logname):
+    """Lists the segment directory again"""
+    path = os.path.join(self.root, logname)
+    if logname not in self.segments or logname in self.unwatched:
+      if not os.path.isdir(path):
+        self.remove_segment(logname)
+        return
+      # watch before listing, files created in between show up in both
+      if self._watch(path, self.WATCH_SEGMENT):
+        self.unwatched.discard(logname)
+      else:
+        self.unwatched.add(logname)
+
+    try:
+      names = os.listdir(path)
+    except OSError:
+      self.remove_segment(logname)
+      return
+
+    if any(name.endswith(".lock") for name in names):
+      files = []
+    else:
+      files = []
+      for name in sorted(names, key=get_upload_sort):
+        try:
+          files.append((name, os.path.getsize(os.path.join(path, name))))
+        except OSError:
+          pass
+
+    if logname not in self.segments:
+      sort_key = get_directory_sort(logname)
+      i = bisect.bisect_right(self.sort_keys, sort_key)
+      self.sort_keys.insert(i, sort_key)
+      self.lognames.insert(i, logname)
+    self.segments[logname] = files
+
+  def remove_segment(self, logname):
+    self.unwatched.discard(logname)
+    if self.segments.pop(logname, None) is not None:
+      i = self.lognames.index(logname)
+      del self.lognames[i]
+      del self.sort_keys[i]
+
+  def remove(self, key):
+    """Drops an uploaded file without listing its segment again"""
+    logname, name = os.path.split(key)
+    files = self.segments.get(logname)
+    if files is not None:
+      self.segments[logname] = [f for f in files if f[0] != name]
+
+  def refresh(self):
+    if self.last_scan is None:
+      self.scan()
+      return
+
+    # also when root didn't exist yet on the last scan
+    if not self.root_watched:
+      if time.monotonic() - self.last_scan > self.rescan_interval:
+        self.scan()
+      return
+
+    dirty = set()
+    for path, mask, name in self.watcher.read(0):
+      if mask & inotify.IN_Q_OVERFLOW:
+        self.scan()
+        return
+      if path == self.root:
+        if name:
+          dirty.add(name)
+      elif path is not None:
+        dirty.add(os.path.basename(path))
+
+    if self.unwatched and time.monotonic() - self.last_relist > self.rescan_interval:
+      self.last_relist = time.monotonic()
+      dirty |= self.unwatched
+
+    for logname in dirty:
+      self.update_segment(logname)
+
+  def gen_upload_files(self):
+    for logname in self.lognames:
+      path = os.path.join(self.root, logname)
+      for name, _ in self.segments[logname]:
+        yield (name, os.path.join(logname, name), os.path.join(path, name))
+
 class Uploader():
   def __init__(self, dongle_id, root):
     self.dongle_id = dongle_id
     self.api = Api(dongle_id)
     self.root = root
+    self.index = UploadIndex(root)
 
     self.upload_thread = None
 
     self.last_resp = None
     self.last_exc = None
 
-    self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
-    self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2}
+    self.immediate_priority = IMMEDIATE_PRIORITY
+    self.high_priority = HIGH_PRIORITY
+
+    self.bucket = TokenBucket(None)
+
+    # one pool of connections shared by all upload workers
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_WORKERS)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.executor = None
 
-  def clean_dirs(self):
+  def clean_dir(self, logname):
+    # remove the segment directory if it's empty
     try:
-      for logname in os.listdir(self.root):
-        path = os.path.join(self.root, logname)
-        # remove empty directories
-        if not os.listdir(path):
-          os.rmdir(path)
+      os.rmdir(os.path.join(self.root, logname))
+      self.index.remove_segment(logname)
     except OSError:
-      cloudlog.exception("clean_dirs failed")
+      pass
 
   def get_upload_sort(self, name):
-    if name in self.immediate_priority:
-      return self.immediate_priority[name]
-    if name in self.high_priority:
-      return self.high_priority[name] + 100
-    return 1000
+    return get_upload_sort(name)
 
   def gen_upload_files(self):
-    if not os.path.isdir(self.root):
-      return
-    for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-
-        yield (name, key, fn)
+    self.index.refresh()
+    return self.index.gen_upload_files()
 
   def next_file_to_upload(self, with_raw):
-    upload_files = list(self.gen_upload_files())
-    # try to upload qlog files first
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return (key, fn)
-
-    if with_raw:
-      # then upload the full log files, rear and front camera files
-      for name, key, fn in upload_files:
-        if name in self.high_priority:
-          return (key, fn)
-
-      # then upload other files
-      for name, key, fn in upload_files:
-        if not name.endswith('.lock') and not name.endswith(".tmp"):
-          return (key, fn)
+    """Returns the file first in (priority class, age, size) order. Qlogs come first, the
+    full logs and cameras and then everything else only with_raw."""
+    self.index.refresh()
+
+    for priority_class in ([0, 1, 2] if with_raw else [0]):
+      # segments are oldest first, the first one with files of the class has the file
+      for logname in self.index.lognames:
+        files = [(sz, get_upload_sort(name), name) for name, sz in self.index.segments[logname]
+                 if get_priority_class(name) == priority_class]
+        if files:
+          name = min(files)[2]
+          return (os.path.join(logname, name), os.path.join(self.root, logname, name))
 
     return None
 
+  def get_uncommitted_blocks(self, url, headers):
+    """Returns {block id: size} of the blocks uploaded by a previous attempt"""
+    try:
+      resp = self.session.get(url, params={"comp": "blocklist", "blocklisttype": "uncommitted"},
+                              headers=headers, timeout=UPLOAD_TIMEOUT)
+      if resp.status_code != 200:
+        return {}
+      blocks = ET.fromstring(resp.content).iter("Block")
+      return {b.findtext("Name"): int(b.findtext("Size")) for b in blocks}
+    except Exception:
+      cloudlog.exception("get_uncommitted_blocks failed")
+      return {}
+
+  def put_block(self, url, headers, fn, offset, length, block_id):
+    with open(fn, "rb") as f:
+      f.seek(offset)
+      data = f.read(length)
+    self.bucket.consume(length)
+
+    for i in range(UPLOAD_BLOCK_RETRIES):
+      try:
+        resp = self.session.put(url, params={"comp": "block", "blockid": block_id}, data=data,
+                                headers=headers, timeout=UPLOAD_TIMEOUT)
+        if resp.status_code in (200, 201):
+          return
+        err = "status %d" % resp.status_code
+      except requests.exceptions.RequestException as e:
+        err = e
+      time.sleep(0.1 * 2**i)
+    raise Exception("upload of block at %d failed: %s" % (offset, err))
+
+  def chunked_upload(self, url, headers, fn, sz):
+    """Uploads fn as a block blob, UPLOAD_CHUNK_SIZE per block on UPLOAD_WORKERS threads.
+    Blocks a previous attempt already uploaded aren't sent again."""
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(UPLOAD_WORKERS)
+
+    block_headers = {k: v for k, v in headers.items() if k.lower() != "x-ms-blob-type"}
+    uploaded = self.get_uncommitted_blocks(url, block_headers)
+
+    block_ids, futures = [], []
+    for offset in range(0, sz, UPLOAD_CHUNK_SIZE):
+      # ids have to be the same length, the offset makes them valid across chunk sizes
+      block_id = base64.b64encode(b"%012d" % offset).decode()
+      length = min(UPLOAD_CHUNK_SIZE, sz - offset)
+      block_ids.append(block_id)
+      if uploaded.get(block_id) != length:
+        futures.append(self.executor.submit(self.put_block, url, block_headers, fn, offset, length, block_id))
+
+    cloudlog.info("chunked upload %s: %d blocks, %d already uploaded", fn, len(block_ids), len(block_ids) - len(futures))
+    for f in futures:
+      f.result()
+
+    block_list = "".join("<Latest>%s</Latest>" % b for b in block_ids)
+    return self.session.put(url, params={"comp": "blocklist"}, headers=block_headers, timeout=UPLOAD_TIMEOUT,
+                            data='<?xml version="1.0" encoding="utf-8"?><BlockList>%s</BlockList>' % block_list)
+
   def do_upload(self, key, fn):
     try:
       url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -169,8 +498,12 @@ class Uploader():
             self.status_code = 200
         self.last_resp = FakeResponse()
       else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
+        sz = os.path.getsize(fn)
+        if sz > UPLOAD_CHUNK_SIZE:
+          self.last_resp = self.chunked_upload(url, headers, fn, sz)
+        else:
+          with open(fn, "rb") as f:
+            self.last_resp = self.session.put(url, data=ThrottledFile(f, sz, self.bucket), headers=headers, timeout=UPLOAD_TIMEOUT)
     except Exception as e:
       self.last_exc = (e, traceback.format_exc())
       raise
@@ -191,6 +524,7 @@ class Uploader():
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
+      self.index.update_segment(os.path.dirname(key))
       return False
 
     cloudlog.event("upload", key=key, fn=fn, sz=sz)
@@ -200,6 +534,7 @@ class Uploader():
     if sz == 0:
       # can't upload files of 0 size
       os.unlink(fn) # delete the file
+      self.index.remove(key)
       success = True
     else:
       cloudlog.info("uploading %r", fn)
@@ -212,13 +547,14 @@ class Uploader():
           os.unlink(fn)
         except OSError:
           cloudlog.event("delete_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz)
+        self.index.remove(key)
 
         success = True
       else:
         cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz)
         success = False
 
-    self.clean_dirs()
+    self.clean_dir(os.path.dirname(key))
 
     return success
 
@@ -233,12 +569,18 @@ def uploader_fn(exit_event):
     raise Exception("uploader can't start without dongle id")
 
   uploader = Uploader(dongle_id, ROOT)
+  scheduler = UploadScheduler(uploader.bucket)
+  scheduler.start()
+
+  # shelling out for these is slow, they change rarely
+  check_hotspot = TTLCache(lambda: is_on_hotspot(), NETWORK_CHECK_TTL)
+  check_wifi = TTLCache(lambda: is_on_wifi(), NETWORK_CHECK_TTL)
 
   backoff = 0.1
   while True:
     allow_raw_upload = (params.get("IsUploadRawEnabled") != b"0")
-    on_hotspot = is_on_hotspot()
-    on_wifi = is_on_wifi()
+    on_hotspot = check_hotspot()
+    on_wifi = check_wifi()
     should_upload = on_wifi and not on_hotspot
 
     if exit_event.is_set():
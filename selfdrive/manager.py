@@ -1,6 +1,5 @@
 #!/usr/bin/env python3.7
 import os
-import time
 import sys
 import fcntl
 import errno
@@ -61,6 +60,7 @@ if __name__ == "__main__":
 else:
   from common.spinner import FakeSpinner as Spinner
 
+import gc
 import importlib
 import traceback
 from multiprocessing import Process
@@ -107,12 +107,14 @@ import cereal
 import cereal.messaging as messaging
 
 from common.params import Params
+from common.realtime import sec_since_boot
 import selfdrive.crash as crash
 from selfdrive.swaglog import cloudlog
 from selfdrive.registration import register
 from selfdrive.version import version, dirty
 from selfdrive.loggerd.config import ROOT
-from selfdrive.launcher import launcher
+from selfdrive.launcher import launcher, preimport
+from selfdrive.supervisor import Supervisor
 from common import android
 from common.apk import update_apks, pm_apply_packages, start_frame
 
@@ -149,6 +151,7 @@ daemon_processes = {
 }
 
 running = {}
+supervisor = Supervisor(running)
 def get_running():
   return running
 
@@ -213,13 +216,20 @@ def start_managed_process(name):
   proc = managed_processes[name]
   if isinstance(proc, str):
     cloudlog.info("starting python %s" % proc)
-    running[name] = Process(name=name, target=launcher, args=(proc,))
+    # the manager is the fork server, the daemon starts from its already imported modules
+    preimport(proc)
+    # frozen only across the fork: the gc of the child leaves the inherited objects alone,
+    # so their pages stay shared, and the manager keeps collecting its own garbage
+    gc.freeze()
+    try:
+      supervisor.start(name, Process(name=name, target=launcher, args=(proc, sec_since_boot())))
+    finally:
+      gc.unfreeze()
   else:
     pdir, pargs = proc
     cwd = os.path.join(BASEDIR, pdir)
     cloudlog.info("starting process %s" % name)
-    running[name] = Process(name=name, target=nativelauncher, args=(pargs, cwd))
-  running[name].start()
+    supervisor.start(name, Process(name=name, target=nativelauncher, args=(pargs, cwd)))
 
 def start_daemon_process(name):
   params = Params()
@@ -261,43 +271,46 @@ def prepare_managed_process(p):
       subprocess.check_call(["make", "clean"], cwd=os.path.join(BASEDIR, proc[0]))
       subprocess.check_call(["make", "-j4"], cwd=os.path.join(BASEDIR, proc[0]))
 
-def kill_managed_process(name):
-  if name not in running or name not in managed_processes:
+def exit_signal(name):
+  if name in interrupt_processes:
+    return signal.SIGINT
+  elif name in kill_processes:
+    return signal.SIGKILL
+  return signal.SIGTERM
+
+def kill_managed_processes(names):
+  """Stops all processes in names at once, they get 5s together to exit"""
+  names = [name for name in names if name in running and name in managed_processes]
+  if not names:
     return
-  cloudlog.info("killing %s" % name)
-
-  if running[name].exitcode is None:
-    if name in interrupt_processes:
-      os.kill(running[name].pid, signal.SIGINT)
-    elif name in kill_processes:
-      os.kill(running[name].pid, signal.SIGKILL)
-    else:
-      running[name].terminate()
-
-    # Process().join(timeout) will hang due to a python 3 bug: https://bugs.python.org/issue28382
-    # We have to poll the exitcode instead
-    # running[name].join(5.0)
-
-    t = time.time()
-    while time.time() - t < 5 and running[name].exitcode is None:
-      time.sleep(0.001)
-
-    if running[name].exitcode is None:
-      if name in unkillable_processes:
-        cloudlog.critical("unkillable process %s failed to exit! rebooting in 15 if it doesn't die" % name)
-        running[name].join(15.0)
-        if running[name].exitcode is None:
-          cloudlog.critical("FORCE REBOOTING PHONE!")
-          os.system("date >> /sdcard/unkillable_reboot")
-          os.system("reboot")
-          raise RuntimeError
-      else:
-        cloudlog.info("killing %s with SIGKILL" % name)
-        os.kill(running[name].pid, signal.SIGKILL)
-        running[name].join()
+  cloudlog.info("killing %s" % ' '.join(names))
+
+  supervisor.signal(names, exit_signal)
+  alive = supervisor.wait(names, 5.0)
+
+  killable = [name for name in alive if name not in unkillable_processes]
+  for name in killable:
+    cloudlog.info("killing %s with SIGKILL" % name)
+  supervisor.signal(killable, signal.SIGKILL)
+  # until they are gone, a second instance would fight the old one for its sockets and devices
+  supervisor.wait(killable)
+
+  unkillable = [name for name in alive if name in unkillable_processes]
+  if unkillable:
+    cloudlog.critical("unkillable processes %s failed to exit! rebooting in 15 if they don't die" % ' '.join(unkillable))
+    if supervisor.wait(unkillable, 15.0):
+      cloudlog.critical("FORCE REBOOTING PHONE!")
+      os.system("date >> /sdcard/unkillable_reboot")
+      os.system("reboot")
+      raise RuntimeError
+
+  for name in names:
+    if running[name].exitcode is not None:
+      cloudlog.info("%s is dead with %s" % (name, supervisor.remove(name)))
+  supervisor.log_stats()
 
-  cloudlog.info("%s is dead with %d" % (name, running[name].exitcode))
-  del running[name]
+def kill_managed_process(name):
+  kill_managed_processes([name])
 
 
 def cleanup_all_processes(signal, frame):
@@ -305,8 +318,7 @@ def cleanup_all_processes(signal, frame):
 
   pm_apply_packages('disable')
 
-  for name in list(running.keys()):
-    kill_managed_process(name)
+  kill_managed_processes(list(running.keys()))
   cloudlog.info("everything is dead")
 
 # ****************** run loop ******************
@@ -376,12 +388,6 @@ def manager_thread():
   while 1:
     msg = messaging.recv_sock(thermal_sock, wait=True)
 
-    # uploader is gated based on the phone temperature
-    if msg.thermal.thermalStatus >= ThermalStatus.yellow:
-      kill_managed_process("uploader")
-    else:
-      start_managed_process("uploader")
-
     if msg.thermal.freeSpace < 0.05:
       logger_dead = True
 
@@ -393,12 +399,13 @@ def manager_thread():
           start_managed_process(p)
     else:
       logger_dead = False
-      for p in reversed(car_started_processes):
-        kill_managed_process(p)
+      kill_managed_processes(car_started_processes)
 
-    # check the status of all processes, did any of them die?
-    running_list = ["%s%s\u001b[0m" % ("\u001b[32m" if running[p].is_alive() else "\u001b[31m", p) for p in running]
-    cloudlog.debug(' '.join(running_list))
+    # did any of them die?
+    crashed = supervisor.check()
+    if crashed:
+      cloudlog.error("processes died: %s" % ' '.join(crashed))
+      supervisor.log_stats()
 
     # Exit main loop when uninstall is needed
     if params.get("DoUninstall", encoding='utf8') == "1":
@@ -0,0 +1,120 @@
+import os
+import select
+import signal
+import threading
+import time
+
+from selfdrive.swaglog import cloudlog
+
+
+class ProcessStats():
+  def __init__(self):
+    self.starts = 0
+    self.stops = 0
+    self.crashes = 0
+    self.exitcode = None
+
+  def to_dict(self):
+    return {"starts": self.starts, "stops": self.stops, "crashes": self.crashes, "exitcode": self.exitcode}
+
+
+class Supervisor():
+  """Keeps the running processes by name and counts their starts, stops and crashes.
+  A crash is an exit the supervisor didn't ask for.
+
+  Stopping signals all processes at once and waits for them together with one deadline.
+  On the main thread the wait wakes up on SIGCHLD through the signal wakeup fd, elsewhere
+  it polls."""
+  POLL_INTERVAL = 0.01
+
+  def __init__(self, running=None):
+    self.running = running if running is not None else {}
+    self.stats = {}
+    # names whose exit was already counted
+    self.exited = set()
+    self.wakeup_fd = None
+
+  def _stats(self, name):
+    if name not in self.stats:
+      self.stats[name] = ProcessStats()
+    return self.stats[name]
+
+  def _install_sigchld(self):
+    if self.wakeup_fd is not None or threading.current_thread() is not threading.main_thread():
+      return
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    os.set_blocking(w, False)
+    # a python handler is needed for the signal to reach the wakeup fd
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(w)
+    self.wakeup_fd = r
+
+  def _sleep(self, timeout):
+    if self.wakeup_fd is None:
+      time.sleep(self.POLL_INTERVAL if timeout is None else min(timeout, self.POLL_INTERVAL))
+      return
+    if select.select([self.wakeup_fd], [], [], timeout)[0]:
+      try:
+        while os.read(self.wakeup_fd, 512):
+          pass
+      except BlockingIOError:
+        pass
+
+  def start(self, name, proc):
+    self._install_sigchld()
+    proc.start()
+    self.running[name] = proc
+    self.exited.discard(name)
+    self._stats(name).starts += 1
+
+  def signal(self, names, sig):
+    """Sends sig to the processes in names that are still alive, sig is a signal number
+    or a function of the name returning it"""
+    for name in names:
+      proc = self.running[name]
+      if proc.exitcode is None:
+        try:
+          os.kill(proc.pid, sig(name) if callable(sig) else sig)
+        except ProcessLookupError:
+          pass
+
+  def wait(self, names, timeout=None):
+    """Waits until all processes in names exited or timeout passed, returns the alive ones.
+    Without a timeout it only returns once all of them exited."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    alive = list(names)
+    while True:
+      alive = [name for name in alive if self.running[name].exitcode is None]
+      remaining = None if deadline is None else deadline - time.monotonic()
+      if not alive or (remaining is not None and remaining <= 0):
+        return alive
+      self._sleep(remaining)
+
+  def check(self):
+    """Returns the processes that died on their own since the last check"""
+    crashed = []
+    for name, proc in self.running.items():
+      if name not in self.exited and proc.exitcode is not None:
+        self.exited.add(name)
+        stats = self._stats(name)
+        stats.crashes += 1
+        stats.exitcode = proc.exitcode
+        crashed.append(name)
+    return crashed
+
+  def remove(self, name):
+    """Forgets a process that exited, counted as a stop unless check() saw it die"""
+    proc = self.running.pop(name)
+    stats = self._stats(name)
+    if name not in self.exited:
+      stats.stops += 1
+      stats.exitcode = proc.exitcode
+    self.exited.discard(name)
+    return proc.exitcode
+
+  def get_stats(self):
+    return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+  def log_stats(self):
+    cloudlog.event("supervisor.stats", stats=self.get_stats())
@@ -0,0 +1,18 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+
+def use_temp_caches():
+  """Points the car registry and dbc caches to a temporary directory, so the tests don't write
+  them to the source tree. It's removed on exit."""
+  if "CAR_REGISTRY_FN" in os.environ and "DBC_CACHE_DIR" in os.environ:
+    return
+  cache_dir = tempfile.mkdtemp(prefix="test_cache_")
+  atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+  os.environ.setdefault("CAR_REGISTRY_FN", os.path.join(cache_dir, "car_registry.pkl"))
+  os.environ.setdefault("DBC_CACHE_DIR", os.path.join(cache_dir, "dbc_cache"))
+
+
+use_temp_caches()
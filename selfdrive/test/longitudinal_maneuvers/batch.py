@@ -0,0 +1,193 @@
+"""Longitudinal model of the plant for a batch of vehicles stepped together with numpy, and
+a runner that sweeps lead and grade scenarios through a vectorized controller. It is meant
+for tuning sweeps, maneuver.py runs the full control stack on one scenario at a time."""
+import numpy as np
+
+from selfdrive.controls.lib.fcw import FCWChecker
+from selfdrive.controls.lib.drive_helpers import _A_CRUISE_MIN_BP, _A_CRUISE_MIN_V, _A_CRUISE_MAX_BP, _A_CRUISE_MAX_V
+from selfdrive.controls.lib.speed_smoother import speed_smoother_batch
+
+# vehicle parameters
+MASS = 1700
+AERO_CD = 0.3
+FORCE_PEAK = MASS*3.
+FORCE_BRAKE_PEAK = -MASS*10.     #1g
+POWER_PEAK = 100000   # 100kW
+SPEED_BASE = POWER_PEAK/FORCE_PEAK  # speed where peak torque meets peak power
+ROLLING_RES = 0.01
+G = 9.81
+FRONTAL_AREA = 2.2
+AIR_DENSITY = 1.225
+GAS_TO_PEAK_LINEAR_SLOPE = 3.33
+BRAKE_TO_PEAK_LINEAR_SLOPE = 0.3
+CREEP_ACCEL_V = [1., 0.]
+CREEP_ACCEL_BP = [0., 1.5]
+
+# what the radar reports without a relevant lead
+NO_LEAD_D_REL = 200.
+
+
+def car_plant_accel(speed, grade, gas, brake):
+  """Acceleration of the car, works on scalars and on arrays of vehicles"""
+  force_brake = brake * FORCE_BRAKE_PEAK * BRAKE_TO_PEAK_LINEAR_SLOPE
+  # both branches are evaluated, the power one is only picked above SPEED_BASE
+  force_gas = np.where(speed < SPEED_BASE,
+                       gas * FORCE_PEAK * GAS_TO_PEAK_LINEAR_SLOPE,  # torque control
+                       gas * POWER_PEAK / np.maximum(speed, SPEED_BASE) * GAS_TO_PEAK_LINEAR_SLOPE)  # power control
+
+  force_grade = - grade * MASS  # positive grade means uphill
+
+  creep_accel = np.interp(speed, CREEP_ACCEL_BP, CREEP_ACCEL_V)
+  force_creep = creep_accel * MASS
+
+  force_resistance = -(ROLLING_RES * MASS * G + 0.5 * speed**2 * AERO_CD * AIR_DENSITY * FRONTAL_AREA)
+  force = force_gas + force_brake + force_resistance + force_grade + force_creep
+  return force / MASS
+
+
+def car_plant_gas_brake(speed, grade, accel):
+  """Inverse of car_plant_accel, the gas and brake that give accel. Both are clipped
+  to [0, 1], so accel is only reached within what the car can do."""
+  force_external = -(ROLLING_RES * MASS * G + 0.5 * speed**2 * AERO_CD * AIR_DENSITY * FRONTAL_AREA) - \
+                   grade * MASS + np.interp(speed, CREEP_ACCEL_BP, CREEP_ACCEL_V) * MASS
+  force = accel * MASS - force_external
+
+  force_gas_peak = np.where(speed < SPEED_BASE, FORCE_PEAK, POWER_PEAK / np.maximum(speed, SPEED_BASE)) * GAS_TO_PEAK_LINEAR_SLOPE
+  gas = np.where(force > 0., np.clip(force / force_gas_peak, 0., 1.), 0.)
+  brake = np.where(force < 0., np.clip(force / (FORCE_BRAKE_PEAK * BRAKE_TO_PEAK_LINEAR_SLOPE), 0., 1.), 0.)
+  return gas, brake
+
+
+def interp_rows(x, xp, fp):
+  """np.interp of x on every row of fp, the rows share the breakpoints xp"""
+  xp = np.asarray(xp, dtype=np.float64)
+  fp = np.asarray(fp, dtype=np.float64)
+  i = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+  w = np.clip((x - xp[i]) / (xp[i+1] - xp[i]), 0., 1.)
+  return fp[..., i] * (1. - w) + fp[..., i+1] * w
+
+
+class BatchPlant():
+  """The longitudinal model of Plant.step for arrays of vehicles, one element per vehicle"""
+  def __init__(self, speed, distance_lead, rate=100):
+    self.rate = rate
+    self.ts = 1./rate
+    self.frame = 0
+
+    speed, distance_lead = np.broadcast_arrays(np.asarray(speed, dtype=np.float64),
+                                               np.asarray(distance_lead, dtype=np.float64))
+    self.speed = speed.copy()
+    self.acceleration = np.zeros_like(self.speed)
+    self.distance = np.zeros_like(self.speed)
+    self.distance_lead = distance_lead.copy()
+
+  def current_time(self):
+    return float(self.frame) / self.rate
+
+  def step(self, gas, brake, v_lead, grade=0.):
+    """Advances every vehicle by one time step, returns the distance to the lead"""
+    acceleration = car_plant_accel(self.speed, grade, gas, brake)
+    self.distance_lead = self.distance_lead + v_lead * self.ts
+    self.distance = self.distance + self.speed * self.ts
+    speed = self.speed + self.ts * acceleration
+
+    stopped = speed <= 0
+    self.speed = np.where(stopped, 0., speed)
+    self.acceleration = np.where(stopped, 0., acceleration)
+    self.frame += 1
+
+    return np.maximum(0., self.distance_lead - self.distance)
+
+
+class BatchManeuver():
+  """A maneuver run on a batch of scenarios. The lead speed and the grade are interpolated
+  on breakpoints shared by the batch, the values have one row per scenario. The initial
+  speed and lead distance, the lead relevancy and the cruise speed of the controller can
+  be given per scenario too, everything is broadcast to the batch."""
+  def __init__(self, duration, initial_speed=0., initial_distance_lead=200., lead_relevancy=True,
+               speed_lead_breakpoints=None, speed_lead_values=None, grade_breakpoints=None, grade_values=None,
+               rate=100):
+    self.duration = duration
+    self.rate = rate
+
+    self.speed_lead_breakpoints = [0., duration] if speed_lead_breakpoints is None else speed_lead_breakpoints
+    self.speed_lead_values = np.asarray([0., 0.] if speed_lead_values is None else speed_lead_values, dtype=np.float64)
+    self.grade_breakpoints = [0., duration] if grade_breakpoints is None else grade_breakpoints
+    self.grade_values = np.asarray([0., 0.] if grade_values is None else grade_values, dtype=np.float64)
+
+    self.shape = np.broadcast(np.empty(np.shape(initial_speed)), np.empty(np.shape(initial_distance_lead)),
+                              np.empty(np.shape(lead_relevancy)),
+                              self.speed_lead_values[..., 0], self.grade_values[..., 0]).shape
+    self.speed = np.broadcast_to(initial_speed, self.shape)
+    self.distance_lead = np.broadcast_to(initial_distance_lead, self.shape)
+    self.lead_relevancy = np.broadcast_to(lead_relevancy, self.shape).astype(bool)
+
+  def evaluate(self, controller):
+    """Runs the batch with the controller, returns a dict of arrays with the checks of
+    test_longitudinal per scenario: no_collision, fcw and engaged, and the min_d_rel,
+    final_speed and final_d_rel to rank them.
+
+    Every step the controller is called with the arrays (v_ego, a_ego, d_rel, v_lead, lead_status)
+    of the radar and returns (a_target, fcw, active). a_target goes to the plant as the gas
+    and brake of car_plant_gas_brake, so it is reached within the limits of the car."""
+    plant = BatchPlant(self.speed, self.distance_lead, self.rate)
+
+    d_rel = np.where(self.lead_relevancy, plant.distance_lead, NO_LEAD_D_REL)
+    v_lead = interp_rows(0., self.speed_lead_breakpoints, self.speed_lead_values) * np.ones(self.shape)
+    min_d_rel = d_rel.copy()
+    fcw = np.zeros(self.shape, dtype=bool)
+    active = np.ones(self.shape, dtype=bool)
+
+    while plant.current_time() < self.duration:
+      t = plant.current_time()
+      grade = interp_rows(t, self.grade_breakpoints, self.grade_values)
+
+      # the controller sees the radar of the last step
+      a_target, fcw_t, active = controller.update(plant.speed, plant.acceleration, d_rel,
+                                                  np.where(self.lead_relevancy, v_lead, plant.speed), self.lead_relevancy)
+      gas, brake = car_plant_gas_brake(plant.speed, grade, a_target)
+
+      v_lead = interp_rows(t, self.speed_lead_breakpoints, self.speed_lead_values)
+      d_rel = np.where(self.lead_relevancy, plant.step(gas, brake, v_lead, grade), NO_LEAD_D_REL)
+
+      min_d_rel = np.minimum(min_d_rel, d_rel)
+      fcw |= fcw_t
+
+    return {
+      'no_collision': min_d_rel > 0,
+      'fcw': fcw,
+      'engaged': np.broadcast_to(active, self.shape).astype(bool),
+      'min_d_rel': min_d_rel,
+      'final_speed': plant.speed,
+      'final_d_rel': d_rel,
+    }
+
+
+def follow_distance(v_ego, v_lead, time_gap=1.8):
+  """Steady state distance the long mpc keeps behind a lead, see test_following_distance"""
+  return 4. + v_ego * time_gap - (v_lead - v_ego) * time_gap + v_ego * v_ego / (2 * G) - v_lead * v_lead / (2 * G)
+
+
+class CruiseFollowController():
+  """Reference controller for BatchManeuver, not the long mpc. The cruise speed_smoother of
+  the planner aims for the slower of the cruise speed and the speed that closes the gap to
+  follow_distance in time_gap seconds, braking down to a_follow_min for the lead. fcw is
+  raised on a time to collision below 2.5s like FCWChecker. It never disengages."""
+  def __init__(self, v_cruise, rate=100, time_gap=1.8, a_follow_min=-3.5):
+    self.v_cruise = v_cruise
+    self.ts = 1./rate
+    self.time_gap = time_gap
+    self.a_follow_min = a_follow_min
+
+  def update(self, v_ego, a_ego, d_rel, v_lead, lead_status):
+    v_follow = np.maximum(0., v_lead + (d_rel - follow_distance(v_ego, v_lead, self.time_gap)) / self.time_gap)
+    following = lead_status & (v_follow < self.v_cruise)
+    v_target = np.where(following, v_follow, self.v_cruise)
+
+    a_max = np.interp(v_ego, _A_CRUISE_MAX_BP, _A_CRUISE_MAX_V)
+    a_min = np.where(following, self.a_follow_min, np.interp(v_ego, _A_CRUISE_MIN_BP, _A_CRUISE_MIN_V))
+    j_max, j_min = np.maximum(0.1, a_max), np.minimum(-0.1, a_min)
+    _, a_target = speed_smoother_batch(v_ego, a_ego, v_target, a_max, a_min, j_max, j_min, self.ts)
+
+    fcw = lead_status & (FCWChecker.calc_ttc(v_ego, a_ego, d_rel, v_lead, 0.) < 2.5)
+    return a_target, fcw, np.ones(np.shape(v_ego), dtype=bool)
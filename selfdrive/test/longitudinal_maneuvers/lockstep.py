@@ -0,0 +1,157 @@
+"""Runs controlsd, radard and plannerd in the calling process, stepped together with the
+plant. Messages are passed in memory and time only advances when the plant steps, so a
+maneuver runs as fast as the CPU allows. The daemons read the time of the bus instead of
+the wall clock."""
+import os
+import traceback
+from collections import deque
+
+import cereal.messaging as messaging
+from selfdrive.controls.controlsd import Controlsd
+from selfdrive.controls.radard import Radard
+from selfdrive.controls.plannerd import Plannerd
+
+CONTROLSD_SUB = ['thermal', 'health', 'liveCalibration', 'driverMonitoring', 'plan', 'pathPlan', 'model', 'gpsLocation']
+CONTROLSD_PUB = ['sendcan', 'controlsState', 'carState', 'carControl', 'carEvents', 'carParams']
+RADARD_SUB = ['model', 'controlsState', 'liveParameters']
+RADARD_PUB = ['radarState', 'liveTracks']
+PLANNERD_SUB = ['carState', 'controlsState', 'radarState', 'model', 'liveParameters']
+PLANNERD_PUB = ['plan', 'liveLongitudinalMpc', 'pathPlan', 'liveMpc']
+
+
+class QueueSocket():
+  """In memory socket. receive() returns None when nothing is queued instead of blocking,
+  a conflated socket only keeps the last message."""
+  def __init__(self, conflate=False):
+    self.q = deque(maxlen=1 if conflate else None)
+
+  def send(self, dat):
+    self.q.append(dat)
+
+  def receive(self, non_blocking=False):
+    return self.q.popleft() if self.q else None
+
+  def receive_many(self, wait_for_one=False):
+    msgs = list(self.q)
+    self.q.clear()
+    return messaging.MessageBatch.from_messages(msgs)
+
+
+class BusPubSocket():
+  def __init__(self, bus, service):
+    self.bus = bus
+    self.service = service
+
+  def send(self, dat):
+    self.bus.publish(self.service, dat)
+
+
+class Bus():
+  """Delivers every published message to the sockets subscribed to the service. time is
+  the simulated time in seconds, clock() is the sec_since_boot of the daemons on the bus."""
+  def __init__(self):
+    self.socks = {}
+    self.time = 0.
+
+  def sub_sock(self, service, conflate=False):
+    sock = QueueSocket(conflate)
+    self.socks.setdefault(service, []).append(sock)
+    return sock
+
+  def pub_sock(self, service):
+    return BusPubSocket(self, service)
+
+  def clock(self):
+    return self.time
+
+  def publish(self, service, dat):
+    if not isinstance(dat, bytes):
+      dat = dat.to_bytes()
+    for sock in self.socks.get(service, []):
+      sock.send(dat)
+
+
+class BusSubMaster(messaging.SubMaster):
+  """SubMaster on conflated bus sockets, alive is checked against the simulated time"""
+  def __init__(self, bus, services, ignore_alive=None):
+    super(BusSubMaster, self).__init__(services, ignore_alive=ignore_alive, addr=None)
+    self.bus = bus
+    self.sock = {s: bus.sub_sock(s, conflate=True) for s in services}
+
+  def has_messages(self):
+    return any(sock.q for sock in self.sock.values())
+
+  def update(self, timeout=-1):
+    msgs = [messaging.recv_one_or_none(sock) for sock in self.sock.values()]
+    self.update_msgs(self.bus.time, msgs)
+
+
+class BusPubMaster(messaging.PubMaster):
+  def __init__(self, bus, services):
+    self.sock = {s: bus.pub_sock(s) for s in services}
+
+
+class LockstepStack():
+  """controlsd, radard and plannerd on a bus. Every daemon runs one iteration per step()
+  if it has input, in the order data flows: controlsd and radard on the can packet,
+  then plannerd on their outputs. With keep_going a daemon that raises is stopped and
+  its traceback kept in crashed, the others keep running like under the manager."""
+  def __init__(self, bus, keep_going=False):
+    self.bus = bus
+    self.keep_going = keep_going
+    self.crashed = {}
+    # controlsd fingerprints on the can packets published until start()
+    self.controlsd_can = bus.sub_sock('can')
+    self.controlsd_sm = BusSubMaster(bus, CONTROLSD_SUB, ignore_alive=['gpsLocation'])
+    self.controlsd = self.radard = self.plannerd = None
+
+  def start(self):
+    # don't pace radard on cars without a radar
+    os.environ['NO_RADAR_SLEEP'] = "1"
+
+    self.controlsd = Controlsd(self.controlsd_sm, BusPubMaster(self.bus, CONTROLSD_PUB), self.controlsd_can,
+                               clock=self.bus.clock)
+    # drop what the fingerprinting didn't use
+    self.controlsd_can.q.clear()
+
+    # both read the CarParams controlsd just wrote
+    self.radard = Radard(BusSubMaster(self.bus, RADARD_SUB), BusPubMaster(self.bus, RADARD_PUB), self.bus.sub_sock('can'),
+                         clock=self.bus.clock)
+    self.plannerd = Plannerd(BusSubMaster(self.bus, PLANNERD_SUB), BusPubMaster(self.bus, PLANNERD_PUB),
+                             clock=self.bus.clock)
+
+  def step(self, t):
+    self.bus.time = t
+    for name, daemon, has_input in [('controlsd', self.controlsd, lambda: self.controlsd_can.q),
+                                    ('radard', self.radard, lambda: self.radard.can_sock.q),
+                                    ('plannerd', self.plannerd, self.plannerd.sm.has_messages)]:
+      if name in self.crashed or not has_input():
+        continue
+      try:
+        daemon.step()
+      except Exception:
+        if not self.keep_going:
+          raise
+        self.crashed[name] = traceback.format_exc()
+
+
+class SimRatekeeper():
+  """Ratekeeper for the simulated time, it never sleeps"""
+  def __init__(self, rate):
+    self._frame = 0
+    self._remaining = 0.
+
+  @property
+  def frame(self):
+    return self._frame
+
+  @property
+  def remaining(self):
+    return self._remaining
+
+  def keep_time(self):
+    return self.monitor_time()
+
+  def monitor_time(self, loop_start=None):
+    self._frame += 1
+    return False
@@ -1,3 +1,4 @@
+import multiprocessing
 from collections import defaultdict
 from selfdrive.test.longitudinal_maneuvers.maneuverplots import ManeuverPlot
 from selfdrive.test.longitudinal_maneuvers.plant import Plant
@@ -22,12 +23,13 @@ class Maneuver():
     self.duration = duration
     self.title = title
 
-  def evaluate(self):
+  def evaluate(self, lockstep=False):
     """runs the plant sim and returns (score, run_data)"""
     plant = Plant(
       lead_relevancy = self.lead_relevancy,
       speed = self.speed,
-      distance_lead = self.distance_lead
+      distance_lead = self.distance_lead,
+      lockstep = lockstep
     )
 
     logs = defaultdict(list)
@@ -55,6 +57,7 @@ class Maneuver():
       v_rel = speed_lead - log['speed'] if self.lead_relevancy else 0.
       log['d_rel'] = d_rel
       log['v_rel'] = v_rel
+      log['time'] = plant.current_time()
 
       if last_controls_state:
         # print(last_controls_state)
@@ -84,3 +87,18 @@ class Maneuver():
 
     print("maneuver end", valid)
     return (plot, valid)
+
+
+# the maneuvers of evaluate_maneuvers, forked workers get them by index
+_maneuvers = []
+
+def _evaluate_lockstep(i):
+  return _maneuvers[i].evaluate(lockstep=True)
+
+def evaluate_maneuvers(maneuvers, processes=None):
+  """Runs the maneuvers in lockstep mode across a process pool, returns [(plot, valid)].
+  Every maneuver gets a fresh process, the control stack has module level state."""
+  global _maneuvers
+  _maneuvers = maneuvers
+  with multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1) as pool:
+    return pool.map(_evaluate_lockstep, range(len(maneuvers)), chunksize=1)
@@ -18,6 +18,8 @@ from selfdrive.boardd.boardd import can_list_to_can_capnp
 
 from opendbc.can.parser import CANParser
 from selfdrive.car.honda.interface import CarInterface
+from selfdrive.test.longitudinal_maneuvers.batch import car_plant_accel
+from selfdrive.test.longitudinal_maneuvers.lockstep import Bus, LockstepStack, SimRatekeeper
 
 from opendbc.can.dbc import dbc
 honda = dbc(os.path.join(DBC_PATH, "honda_civic_touring_2016_can_generated.dbc"))
@@ -41,38 +43,8 @@ def fix(msg, addr):
 
 
 def car_plant(pos, speed, grade, gas, brake):
-  # vehicle parameters
-  mass = 1700
-  aero_cd = 0.3
-  force_peak = mass*3.
-  force_brake_peak = -mass*10.     #1g
-  power_peak = 100000   # 100kW
-  speed_base = power_peak/force_peak
-  rolling_res = 0.01
-  g = 9.81
-  frontal_area = 2.2
-  air_density = 1.225
-  gas_to_peak_linear_slope = 3.33
-  brake_to_peak_linear_slope = 0.3
-  creep_accel_v = [1., 0.]
-  creep_accel_bp = [0., 1.5]
-
   #*** longitudinal model ***
-  # find speed where peak torque meets peak power
-  force_brake = brake * force_brake_peak * brake_to_peak_linear_slope
-  if speed < speed_base: # torque control
-    force_gas = gas * force_peak * gas_to_peak_linear_slope
-  else: # power control
-    force_gas = gas * power_peak / speed * gas_to_peak_linear_slope
-
-  force_grade = - grade * mass  # positive grade means uphill
-
-  creep_accel = np.interp(speed, creep_accel_bp, creep_accel_v)
-  force_creep = creep_accel * mass
-
-  force_resistance = -(rolling_res * mass * g + 0.5 * speed**2 * aero_cd * air_density * frontal_area)
-  force = force_gas + force_brake + force_resistance + force_grade + force_creep
-  acceleration = force / mass
+  acceleration = float(car_plant_accel(speed, grade, gas, brake))
 
   # TODO: lateral model
   return speed, acceleration
@@ -93,6 +65,54 @@ def get_car_can_parser():
   ]
   return CANParser(dbc_f, signals, checks, 0)
 
+# values of the car signals, in the plant's order
+VLS = namedtuple('vls', [
+  'XMISSION_SPEED',
+  'WHEEL_SPEED_FL', 'WHEEL_SPEED_FR', 'WHEEL_SPEED_RL', 'WHEEL_SPEED_RR',
+  'STEER_ANGLE', 'STEER_ANGLE_RATE', 'STEER_TORQUE_SENSOR', 'STEER_TORQUE_MOTOR',
+  'LEFT_BLINKER', 'RIGHT_BLINKER',
+  'GEAR',
+  'WHEELS_MOVING',
+  'BRAKE_ERROR_1', 'BRAKE_ERROR_2',
+  'SEATBELT_DRIVER_LAMP', 'SEATBELT_DRIVER_LATCHED',
+  'BRAKE_PRESSED', 'BRAKE_SWITCH',
+  'CRUISE_BUTTONS',
+  'ESP_DISABLED',
+  'HUD_LEAD',
+  'USER_BRAKE',
+  'STEER_STATUS',
+  'GEAR_SHIFTER',
+  'PEDAL_GAS',
+  'CRUISE_SETTING',
+  'ACC_STATUS',
+
+  'CRUISE_SPEED_PCM',
+  'CRUISE_SPEED_OFFSET',
+
+  'DOOR_OPEN_FL', 'DOOR_OPEN_FR', 'DOOR_OPEN_RL', 'DOOR_OPEN_RR',
+
+  'CAR_GAS',
+  'MAIN_ON',
+  'EPB_STATE',
+  'BRAKE_HOLD_ACTIVE',
+  'INTERCEPTOR_GAS',
+  'INTERCEPTOR_GAS2',
+  'IMPERIAL_UNIT',
+])
+
+def get_car_can_msgs():
+  """[(address, car signals, dbc signals)] of the messages the plant sends for the car"""
+  gen_signals, _ = get_can_signals(CP)
+  signals = {}
+  for sig, msg, _ in gen_signals:
+    signals.setdefault(msg, []).append(sig)
+  return [(honda.lookup_msg_id(msg), sgs, set(honda.get_signals(msg))) for msg, sgs in signals.items()]
+
+CAR_CAN_MSGS = get_car_can_msgs()
+
+# controlsd fingerprints on the first can packets, it gives up after 200
+FINGERPRINT_FRAMES = 250
+
 def to_3_byte(x):
   # Convert into 12 bit value
   s = struct.pack("!H", int(x))
@@ -105,10 +125,24 @@ def to_3s_byte(x):
 class Plant():
   messaging_initialized = False
 
-  def __init__(self, lead_relevancy=False, rate=100, speed=0.0, distance_lead=2.0):
+  def __init__(self, lead_relevancy=False, rate=100, speed=0.0, distance_lead=2.0, lockstep=False):
+    """With lockstep controlsd, radard and plannerd run in this process and step with the
+    plant, otherwise they are separate processes talking to the plant over msgq"""
     self.rate = rate
 
-    if not Plant.messaging_initialized:
+    if lockstep:
+      self.bus = Bus()
+      for name, service in [('logcan', 'can'), ('model', 'model'), ('live_params', 'liveParameters'), ('health', 'health'),
+                            ('thermal', 'thermal'), ('driverMonitoring', 'driverMonitoring'), ('cal', 'liveCalibration')]:
+        setattr(self, name, self.bus.pub_sock(service))
+      self.sendcan = self.bus.sub_sock('sendcan')
+      self.controls_state = self.bus.sub_sock('controlsState')
+      self.plan = self.bus.sub_sock('plan')
+      self.stack = LockstepStack(self.bus)
+    else:
+      self.stack = None
+
+    if not lockstep and not Plant.messaging_initialized:
       Plant.logcan = messaging.pub_sock('can')
       Plant.sendcan = messaging.sub_sock('sendcan')
       Plant.model = messaging.pub_sock('model')
@@ -147,133 +181,77 @@ class Plant():
     # lead car
     self.distance_lead, self.distance_lead_prev = distance_lead , distance_lead
 
-    self.rk = Ratekeeper(rate, print_delay_threshold=100)
     self.ts = 1./rate
 
     self.cp = get_car_can_parser()
     self.response_seen = False
 
-    time.sleep(1)
-    messaging.drain_sock(Plant.sendcan)
-    messaging.drain_sock(Plant.controls_state)
-
-  def close(self):
-    Plant.logcan.close()
-    Plant.model.close()
-    Plant.live_params.close()
-
-  def speed_sensor(self, speed):
-    if speed<0.3:
-      return 0
-    else:
-      return speed * CV.MS_TO_KPH
-
-  def current_time(self):
-    return float(self.rk.frame) / self.rate
-
-  def step(self, v_lead=0.0, cruise_buttons=None, grade=0.0, publish_model = True):
-    gen_signals, gen_checks = get_can_signals(CP)
-    sgs = [s[0] for s in gen_signals]
-    msgs = [s[1] for s in gen_signals]
-    cks_msgs = set(check[0] for check in gen_checks)
-    cks_msgs.add(0x18F)
-    cks_msgs.add(0x30C)
+    # the messages that don't change
+    live_parameters = messaging.new_message()
+    live_parameters.init('liveParameters')
+    live_parameters.liveParameters.valid = True
+    live_parameters.liveParameters.sensorValid = True
+    live_parameters.liveParameters.posenetValid = True
+    live_parameters.liveParameters.steerRatio = CP.steerRatio
+    live_parameters.liveParameters.stiffnessFactor = 1.0
 
-    # ******** get messages sent to the car ********
-    can_strings = messaging.drain_sock_raw(Plant.sendcan, wait_for_one=self.response_seen)
+    driver_monitoring = messaging.new_message()
+    driver_monitoring.init('driverMonitoring')
+    driver_monitoring.driverMonitoring.faceOrientation = [0.] * 3
+    driver_monitoring.driverMonitoring.facePosition = [0.] * 2
 
-    # After the first response the car is done fingerprinting, so we can run in lockstep with controlsd
-    if can_strings:
-      self.response_seen = True
+    health = messaging.new_message()
+    health.init('health')
+    health.health.controlsAllowed = True
 
-    self.cp.update_strings(can_strings, sendcan=True)
+    thermal = messaging.new_message()
+    thermal.init('thermal')
+    thermal.thermal.freeSpace = 1.
+    thermal.thermal.batteryPercent = 100
 
-    # ******** get controlsState messages for plotting ***
-    controls_state_msgs = []
-    for a in messaging.drain_sock(Plant.controls_state, wait_for_one=self.response_seen):
-      controls_state_msgs.append(a.controlsState)
+    self.status_msgs = [(self.live_params, live_parameters.to_bytes()), (self.driverMonitoring, driver_monitoring.to_bytes()),
+                        (self.health, health.to_bytes()), (self.thermal, thermal.to_bytes())]
 
-    fcw = None
-    for a in messaging.drain_sock(Plant.plan):
-      if a.plan.fcw:
-        fcw = True
+    if self.stack is None:
+      self.rk = Ratekeeper(rate, print_delay_threshold=100)
 
-    if self.cp.vl[0x1fa]['COMPUTER_BRAKE_REQUEST']:
-      brake = self.cp.vl[0x1fa]['COMPUTER_BRAKE'] * 0.003906248
+      time.sleep(1)
+      messaging.drain_sock(self.sendcan)
+      messaging.drain_sock(self.controls_state)
     else:
-      brake = 0.0
+      self.rk = SimRatekeeper(rate)
+
+      # controlsd fingerprints the car while it starts, after that it steps with the plant
+      for _ in range(FINGERPRINT_FRAMES):
+        self.send_status()
+        self.logcan.send(can_list_to_can_capnp(self.car_can_msgs(self.speed, 0, 200., 0.)))
+        self.frame += 1
+      self.stack.start()
+      self.response_seen = True
 
-    if self.cp.vl[0x200]['GAS_COMMAND'] > 0:
-      gas = self.cp.vl[0x200]['GAS_COMMAND'] / 256.0
-    else:
-      gas = 0.0
+  def close(self):
+    if self.stack is None:
+      Plant.logcan.close()
+      Plant.model.close()
+      Plant.live_params.close()
 
-    if self.cp.vl[0xe4]['STEER_TORQUE_REQUEST']:
-      steer_torque = self.cp.vl[0xe4]['STEER_TORQUE']*1.0/0xf00
+  def speed_sensor(self, speed):
+    if speed<0.3:
+      return 0
     else:
-      steer_torque = 0.0
-
-    distance_lead = self.distance_lead_prev + v_lead * self.ts
+      return speed * CV.MS_TO_KPH
 
-    # ******** run the car ********
-    speed, acceleration = car_plant(self.distance_prev, self.speed_prev, grade, gas, brake)
-    distance = self.distance_prev + speed * self.ts
-    speed = self.speed_prev + self.ts * acceleration
-    if speed <= 0:
-      speed = 0
-      acceleration = 0
+  def current_time(self):
+    return float(self.rk.frame) / self.rate
 
-    # ******** lateral ********
-    self.angle_steer -= (steer_torque/10.0) * self.ts
+  def send_status(self):
+    for sock, dat in self.status_msgs:
+      sock.send(dat)
 
-    # *** radar model ***
-    if self.lead_relevancy:
-      d_rel = np.maximum(0., distance_lead - distance)
-      v_rel = v_lead - speed
-    else:
-      d_rel = 200.
-      v_rel = 0.
+  def car_can_msgs(self, speed, cruise_buttons, d_rel, v_rel):
     lateral_pos_rel = 0.
 
-    # print at 5hz
-    if (self.frame % (self.rate//5)) == 0:
-      print("%6.2f m  %6.2f m/s  %6.2f m/s2   %.2f ang   gas: %.2f  brake: %.2f  steer: %5.2f     lead_rel: %6.2f m  %6.2f m/s" % (distance, speed, acceleration, self.angle_steer, gas, brake, steer_torque, d_rel, v_rel))
-
-    # ******** publish the car ********
-    vls_tuple = namedtuple('vls', [
-           'XMISSION_SPEED',
-           'WHEEL_SPEED_FL', 'WHEEL_SPEED_FR', 'WHEEL_SPEED_RL', 'WHEEL_SPEED_RR',
-           'STEER_ANGLE', 'STEER_ANGLE_RATE', 'STEER_TORQUE_SENSOR', 'STEER_TORQUE_MOTOR',
-           'LEFT_BLINKER', 'RIGHT_BLINKER',
-           'GEAR',
-           'WHEELS_MOVING',
-           'BRAKE_ERROR_1', 'BRAKE_ERROR_2',
-           'SEATBELT_DRIVER_LAMP', 'SEATBELT_DRIVER_LATCHED',
-           'BRAKE_PRESSED', 'BRAKE_SWITCH',
-           'CRUISE_BUTTONS',
-           'ESP_DISABLED',
-           'HUD_LEAD',
-           'USER_BRAKE',
-           'STEER_STATUS',
-           'GEAR_SHIFTER',
-           'PEDAL_GAS',
-           'CRUISE_SETTING',
-           'ACC_STATUS',
-
-           'CRUISE_SPEED_PCM',
-           'CRUISE_SPEED_OFFSET',
-
-           'DOOR_OPEN_FL', 'DOOR_OPEN_FR', 'DOOR_OPEN_RL', 'DOOR_OPEN_RR',
-
-           'CAR_GAS',
-           'MAIN_ON',
-           'EPB_STATE',
-           'BRAKE_HOLD_ACTIVE',
-           'INTERCEPTOR_GAS',
-           'INTERCEPTOR_GAS2',
-           'IMPERIAL_UNIT',
-           ])
-    vls = vls_tuple(
+    vls = VLS(
            self.speed_sensor(speed),
            self.speed_sensor(speed), self.speed_sensor(speed), self.speed_sensor(speed), self.speed_sensor(speed),
            self.angle_steer, self.angle_steer_rate, 0, 0,#Steer torque sensor
@@ -309,25 +287,21 @@ class Plant():
 
     # TODO: publish each message at proper frequency
     can_msgs = []
-    for msg in set(msgs):
-      msg_struct = {}
-      indxs = [i for i, x in enumerate(msgs) if msg == msgs[i]]
-      for i in indxs:
-        msg_struct[sgs[i]] = getattr(vls, sgs[i])
+    for msg, sgs, dbc_sgs in CAR_CAN_MSGS:
+      msg_struct = {sg: getattr(vls, sg) for sg in sgs}
 
-      if "COUNTER" in honda.get_signals(msg):
+      if "COUNTER" in dbc_sgs:
         msg_struct["COUNTER"] = self.frame % 4
 
-      if "COUNTER_PEDAL" in honda.get_signals(msg):
+      if "COUNTER_PEDAL" in dbc_sgs:
         msg_struct["COUNTER_PEDAL"] = self.frame % 0xf
 
-      msg = honda.lookup_msg_id(msg)
       msg_data = honda.encode(msg, msg_struct)
 
-      if "CHECKSUM" in honda.get_signals(msg):
+      if "CHECKSUM" in dbc_sgs:
         msg_data = fix(msg_data, msg)
 
-      if "CHECKSUM_PEDAL" in honda.get_signals(msg):
+      if "CHECKSUM_PEDAL" in dbc_sgs:
         msg_struct["CHECKSUM_PEDAL"] = crc8_pedal(msg_data[:-1])
         msg_data = honda.encode(msg, msg_struct)
 
@@ -347,39 +321,76 @@ class Plant():
       can_msgs.append([0x445, 0, radar_msg, 1])
 
     # add camera msg so controlsd thinks it's alive
-    msg_struct["COUNTER"] = self.frame % 4
-    msg = honda.lookup_msg_id(0xe4)
-    msg_data = honda.encode(msg, msg_struct)
+    msg_data = honda.encode(0xe4, {"COUNTER": self.frame % 4})
     msg_data = fix(msg_data, 0xe4)
     can_msgs.append([0xe4, 0, msg_data, 2])
+    return can_msgs
 
+  def step(self, v_lead=0.0, cruise_buttons=None, grade=0.0, publish_model = True):
+    # ******** get messages sent to the car ********
+    can_strings = messaging.drain_sock_raw(self.sendcan, wait_for_one=self.response_seen)
 
-    # Fake sockets that controlsd subscribes to
-    live_parameters = messaging.new_message()
-    live_parameters.init('liveParameters')
-    live_parameters.liveParameters.valid = True
-    live_parameters.liveParameters.sensorValid = True
-    live_parameters.liveParameters.posenetValid = True
-    live_parameters.liveParameters.steerRatio = CP.steerRatio
-    live_parameters.liveParameters.stiffnessFactor = 1.0
-    Plant.live_params.send(live_parameters.to_bytes())
+    # After the first response the car is done fingerprinting, so we can run in lockstep with controlsd
+    if can_strings:
+      self.response_seen = True
 
-    driver_monitoring = messaging.new_message()
-    driver_monitoring.init('driverMonitoring')
-    driver_monitoring.driverMonitoring.faceOrientation = [0.] * 3
-    driver_monitoring.driverMonitoring.facePosition = [0.] * 2
-    Plant.driverMonitoring.send(driver_monitoring.to_bytes())
+    self.cp.update_strings(can_strings, sendcan=True)
 
-    health = messaging.new_message()
-    health.init('health')
-    health.health.controlsAllowed = True
-    Plant.health.send(health.to_bytes())
+    # ******** get controlsState messages for plotting ***
+    controls_state_msgs = []
+    for a in messaging.drain_sock(self.controls_state, wait_for_one=self.response_seen):
+      controls_state_msgs.append(a.controlsState)
 
-    thermal = messaging.new_message()
-    thermal.init('thermal')
-    thermal.thermal.freeSpace = 1.
-    thermal.thermal.batteryPercent = 100
-    Plant.thermal.send(thermal.to_bytes())
+    fcw = None
+    for a in messaging.drain_sock(self.plan):
+      if a.plan.fcw:
+        fcw = True
+
+    if self.cp.vl[0x1fa]['COMPUTER_BRAKE_REQUEST']:
+      brake = self.cp.vl[0x1fa]['COMPUTER_BRAKE'] * 0.003906248
+    else:
+      brake = 0.0
+
+    if self.cp.vl[0x200]['GAS_COMMAND'] > 0:
+      gas = self.cp.vl[0x200]['GAS_COMMAND'] / 256.0
+    else:
+      gas = 0.0
+
+    if self.cp.vl[0xe4]['STEER_TORQUE_REQUEST']:
+      steer_torque = self.cp.vl[0xe4]['STEER_TORQUE']*1.0/0xf00
+    else:
+      steer_torque = 0.0
+
+    distance_lead = self.distance_lead_prev + v_lead * self.ts
+
+    # ******** run the car ********
+    speed, acceleration = car_plant(self.distance_prev, self.speed_prev, grade, gas, brake)
+    distance = self.distance_prev + speed * self.ts
+    speed = self.speed_prev + self.ts * acceleration
+    if speed <= 0:
+      speed = 0
+      acceleration = 0
+
+    # ******** lateral ********
+    self.angle_steer -= (steer_torque/10.0) * self.ts
+
+    # *** radar model ***
+    if self.lead_relevancy:
+      d_rel = np.maximum(0., distance_lead - distance)
+      v_rel = v_lead - speed
+    else:
+      d_rel = 200.
+      v_rel = 0.
+
+    # print at 5hz
+    if (self.frame % (self.rate//5)) == 0:
+      print("%6.2f m  %6.2f m/s  %6.2f m/s2   %.2f ang   gas: %.2f  brake: %.2f  steer: %5.2f     lead_rel: %6.2f m  %6.2f m/s" % (distance, speed, acceleration, self.angle_steer, gas, brake, steer_torque, d_rel, v_rel))
+
+    # ******** publish the car ********
+    can_msgs = self.car_can_msgs(speed, cruise_buttons, d_rel, v_rel)
+
+    # Fake sockets that controlsd subscribes to
+    self.send_status()
 
     # ******** publish a fake model going straight and fake calibration ********
     # note that this is worst case for MPC, since model will delay long mpc by one time step
@@ -417,10 +428,13 @@ class Plant():
       cal.liveCalibration.calPerc = 100
       cal.liveCalibration.rpyCalib = [0.] * 3
       # fake values?
-      Plant.model.send(md.to_bytes())
-      Plant.cal.send(cal.to_bytes())
+      self.model.send(md.to_bytes())
+      self.cal.send(cal.to_bytes())
+
+    self.logcan.send(can_list_to_can_capnp(can_msgs))
 
-    Plant.logcan.send(can_list_to_can_capnp(can_msgs))
+    if self.stack is not None:
+      self.stack.step(self.current_time())
 
     # ******** update prevs ********
     self.frame += 1
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import unittest
+import numpy as np
+
+from selfdrive.config import Conversions as CV
+from selfdrive.controls.lib.fcw import FCWChecker
+from selfdrive.controls.lib.speed_smoother import speed_smoother, speed_smoother_batch
+from selfdrive.test.longitudinal_maneuvers.batch import BatchManeuver, CruiseFollowController, SPEED_BASE, \
+                                                       car_plant_accel, car_plant_gas_brake
+
+
+def car_plant_reference(speed, grade, gas, brake):
+  """The scalar force model of plant.car_plant before it moved to car_plant_accel"""
+  # vehicle parameters
+  mass = 1700
+  aero_cd = 0.3
+  force_peak = mass*3.
+  force_brake_peak = -mass*10.     #1g
+  power_peak = 100000   # 100kW
+  speed_base = power_peak/force_peak
+  rolling_res = 0.01
+  g = 9.81
+  frontal_area = 2.2
+  air_density = 1.225
+  gas_to_peak_linear_slope = 3.33
+  brake_to_peak_linear_slope = 0.3
+  creep_accel_v = [1., 0.]
+  creep_accel_bp = [0., 1.5]
+
+  #*** longitudinal model ***
+  # find speed where peak torque meets peak power
+  force_brake = brake * force_brake_peak * brake_to_peak_linear_slope
+  if speed < speed_base: # torque control
+    force_gas = gas * force_peak * gas_to_peak_linear_slope
+  else: # power control
+    force_gas = gas * power_peak / speed * gas_to_peak_linear_slope
+
+  force_grade = - grade * mass  # positive grade means uphill
+
+  creep_accel = np.interp(speed, creep_accel_bp, creep_accel_v)
+  force_creep = creep_accel * mass
+
+  force_resistance = -(rolling_res * mass * g + 0.5 * speed**2 * aero_cd * air_density * frontal_area)
+  force = force_gas + force_brake + force_resistance + force_grade + force_creep
+  return force / mass
+
+
+class TestBatch(unittest.TestCase):
+  def setUp(self):
+    np.random.seed(0)
+
+  def test_car_plant(self):
+    n = 1000
+    speed = np.random.uniform(0., 45., n)
+    speed[:10] = 0.
+    grade = np.random.uniform(-0.2, 0.2, n)
+    gas = np.random.uniform(0., 1., n) * (np.random.rand(n) > .5)
+    brake = np.random.uniform(0., 1., n) * (gas == 0)
+
+    # both the torque and the power branch
+    speed[10:20] = SPEED_BASE
+    self.assertTrue((speed < SPEED_BASE).any() and (speed > SPEED_BASE).any())
+
+    accel = car_plant_accel(speed, grade, gas, brake)
+    for i in range(n):
+      args = [float(x[i]) for x in (speed, grade, gas, brake)]
+      expected = car_plant_reference(*args)
+      self.assertAlmostEqual(accel[i], expected, places=12)
+      self.assertEqual(float(car_plant_accel(*args)), expected)
+
+    # what the car can do is reached exactly
+    gas, brake = car_plant_gas_brake(speed, grade, accel)
+    np.testing.assert_allclose(car_plant_accel(speed, grade, gas, brake), accel, atol=1e-9)
+
+  def test_speed_smoother(self):
+    n = 10000
+    v_ego = np.random.uniform(0., 40., n)
+    a_ego = np.random.uniform(-4., 3., n)
+    v_target = np.random.uniform(0., 40., n)
+    v_target[:100] = v_ego[:100]
+    a_min, a_max = np.random.uniform(-1., -.3, n), np.random.uniform(.4, 1.6, n)
+    j_min, j_max = np.minimum(-0.1, a_min), np.maximum(0.1, a_max)
+    ts = np.random.choice([0.01, 0.2, 1.], n)
+
+    v, a = speed_smoother_batch(v_ego, a_ego, v_target, a_max, a_min, j_max, j_min, ts)
+    expected = np.array([speed_smoother(*x) for x in zip(v_ego, a_ego, v_target, a_max, a_min, j_max, j_min, ts)])
+    np.testing.assert_allclose(v, expected[:, 0], rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(a, expected[:, 1], rtol=1e-12, atol=1e-12)
+
+  def test_ttc(self):
+    n = 1000
+    args = [np.random.uniform(0., 40., n), np.random.uniform(-3., 2., n), np.random.uniform(0., 100., n),
+            np.random.uniform(0., 40., n), np.random.uniform(-3., 2., n)]
+    ttc = FCWChecker.calc_ttc(*args)
+    for i in range(n):
+      self.assertEqual(ttc[i], FCWChecker.calc_ttc(*[x[i] for x in args]))
+
+  def test_batch_maneuver(self):
+    v = 30. * CV.MPH_TO_MS
+    # cruising, following a lead that slows down, and a lead stopped too close to stop for
+    maneuver = BatchManeuver(
+      duration=20.,
+      initial_speed=v,
+      initial_distance_lead=[200., 60., 20.],
+      lead_relevancy=[False, True, True],
+      speed_lead_values=[[v, v], [v, 10. * CV.MPH_TO_MS], [0., 0.]],
+      speed_lead_breakpoints=[0., 10.],
+    )
+    res = maneuver.evaluate(CruiseFollowController(v))
+    np.testing.assert_equal(res['no_collision'], [True, True, False])
+    np.testing.assert_equal(res['fcw'], [False, False, True])
+    self.assertTrue(res['engaged'].all())
+    self.assertAlmostEqual(res['final_speed'][0], v, delta=0.1)
+
+    # every scenario runs as if it was alone
+    for i in range(3):
+      single = BatchManeuver(
+        duration=20.,
+        initial_speed=v,
+        initial_distance_lead=maneuver.distance_lead[i],
+        lead_relevancy=maneuver.lead_relevancy[i],
+        speed_lead_values=maneuver.speed_lead_values[i],
+        speed_lead_breakpoints=[0., 10.],
+      ).evaluate(CruiseFollowController(v))
+      for k, r in single.items():
+        self.assertEqual(r, res[k][i])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -3,15 +3,15 @@ import os
 os.environ['OLD_CAN'] = '1'
 os.environ['NOCRASH'] = '1'
 
-import time
 import unittest
 import shutil
+import tempfile
 import matplotlib
 matplotlib.use('svg')
 
 from selfdrive.config import Conversions as CV
 from selfdrive.car.honda.values import CruiseButtons as CB
-from selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver
+from selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver, evaluate_maneuvers
 import selfdrive.manager as manager
 from common.params import Params
 
@@ -32,6 +32,9 @@ def check_fcw(log):
 def check_engaged(log):
   return log['controls_state_msgs'][-1][-1].active
 
+def first_fcw_time(log):
+  return next((t for t, fcw in zip(log['time'], log['fcw']) if fcw), None)
+
 maneuvers = [
   Maneuver(
     'while cruising at 40 mph, change cruise speed to 50mph',
@@ -322,27 +325,33 @@ def setup_output():
     with open(os.path.join(output_dir, "index.html"), "w") as f:
       f.write(view_html)
 
+def setup_params():
+  params_path = tempfile.mkdtemp()
+  os.environ['PARAMS_PATH'] = params_path
+  params = Params()
+  params.put("Passive", "1" if os.getenv("PASSIVE") else "0")
+  params.put("OpenpilotEnabledToggle", "1")
+  params.put("CommunityFeaturesToggle", "1")
+  return params_path
+
 class LongitudinalControl(unittest.TestCase):
   @classmethod
   def setUpClass(cls):
-    os.environ['NO_CAN_TIMEOUT'] = "1"
-
     setup_output()
 
-    shutil.rmtree('/data/params', ignore_errors=True)
-    params = Params()
-    params.put("Passive", "1" if os.getenv("PASSIVE") else "0")
-    params.put("OpenpilotEnabledToggle", "1")
-    params.put("CommunityFeaturesToggle", "1")
+    # the maneuvers share the params, controlsd writes the same CarParams for all of them
+    cls.params_path = setup_params()
+
+    # controlsd, radard and plannerd run in lockstep with the plant, one process per maneuver
+    cls.results = evaluate_maneuvers(maneuvers)
 
-    manager.gctx = {}
-    manager.prepare_managed_process('radard')
-    manager.prepare_managed_process('controlsd')
-    manager.prepare_managed_process('plannerd')
+    output_dir = os.path.join(os.getcwd(), 'out/longitudinal')
+    for k, (plot, _) in enumerate(cls.results):
+      plot.write_plot(output_dir, "maneuver" + str(k+1).zfill(2))
 
   @classmethod
   def tearDownClass(cls):
-    pass
+    shutil.rmtree(cls.params_path, ignore_errors=True)
 
   # hack
   def test_longitudinal_setup(self):
@@ -350,22 +359,10 @@ class LongitudinalControl(unittest.TestCase):
 
 def run_maneuver_worker(k):
   man = maneuvers[k]
-  output_dir = os.path.join(os.getcwd(), 'out/longitudinal')
 
   def run(self):
     print(man.title)
-    manager.start_managed_process('radard')
-    manager.start_managed_process('controlsd')
-    manager.start_managed_process('plannerd')
-
-    plot, valid = man.evaluate()
-    plot.write_plot(output_dir, "maneuver" + str(k+1).zfill(2))
-
-    manager.kill_managed_process('radard')
-    manager.kill_managed_process('controlsd')
-    manager.kill_managed_process('plannerd')
-    time.sleep(5)
-
+    _, valid = self.results[k]
     self.assertTrue(valid)
 
   return run
@@ -373,5 +370,52 @@ def run_maneuver_worker(k):
 for k in range(len(maneuvers)):
   setattr(LongitudinalControl, "test_longitudinal_maneuvers_%d" % (k+1), run_maneuver_worker(k))
 
+
+class FCWTiming(unittest.TestCase):
+  """The fcw holdoff runs on the time the planner reads. The same maneuver has to warn at the
+  same time with the daemons as processes on the wall clock and in lockstep on the simulated time."""
+  DAEMONS = ['radard', 'controlsd', 'plannerd']
+
+  @classmethod
+  def setUpClass(cls):
+    cls.params_path = setup_params()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.params_path, ignore_errors=True)
+
+  def fcw_time(self, lockstep):
+    fcw_times = []
+    def check_fcw_time(log):
+      fcw_times.append(first_fcw_time(log))
+      return fcw_times[-1] is not None
+
+    maneuver = Maneuver(
+      "fcw: traveling at 20 m/s following a lead that decels from 20m/s to 0 at 3m/s2",
+      duration=13.,
+      initial_speed=20.,
+      lead_relevancy=True,
+      initial_distance_lead=35.,
+      speed_lead_values=[20., 0.],
+      speed_lead_breakpoints=[3., 9.6],
+      checks=[check_fcw_time],
+    )
+    _, valid = maneuver.evaluate(lockstep=lockstep)
+    self.assertTrue(valid, "no fcw")
+    return fcw_times[0]
+
+  def test_fcw_time_matches(self):
+    os.environ['NO_CAN_TIMEOUT'] = "1"
+    for p in self.DAEMONS:
+      manager.prepare_managed_process(p)
+      manager.start_managed_process(p)
+    try:
+      fcw_time = self.fcw_time(lockstep=False)
+    finally:
+      for p in self.DAEMONS:
+        manager.kill_managed_process(p)
+
+    self.assertAlmostEqual(self.fcw_time(lockstep=True), fcw_time, delta=0.5)
+
 if __name__ == "__main__":
   unittest.main(failfast=True)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import bz2
+import math
 import os
 import sys
 
-import dictdiffer
+import capnp
 if "CI" in os.environ:
   tqdm = lambda x: x
 else:
@@ -11,53 +12,87 @@ else:
 
 from tools.lib.logreader import LogReader
 
-def save_log(dest, log_msgs):
-  dat = b""
-  for msg in log_msgs:
-    dat += msg.as_builder().to_bytes()
-  dat = bz2.compress(dat)
+_StructReader = capnp.lib.capnp._DynamicStructReader
+_ListReader = capnp.lib.capnp._DynamicListReader
 
+def save_log(dest, log_msgs):
+  """Writes the messages to a bz2 compressed log, one message at a time"""
+  compressor = bz2.BZ2Compressor()
   with open(dest, "wb") as f:
-   f.write(dat)
-
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key, val in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() not in key and len(keys) > 1:
-      continue
-
-    for k in keys[:-1]:
-      try:
-        attr = getattr(msg, k)
-      except:
-        break
-    else:
-      setattr(attr, keys[-1], val)
-  return msg.as_reader()
-
-def compare_logs(log1, log2, ignore=[]):
-  assert len(log1) == len(log2), "logs are not same length: " + str(len(log1)) + " VS " + str(len(log2))
-
-  ignore_fields = [k for k, v in ignore]
+    for msg in log_msgs:
+      f.write(compressor.compress(msg.as_builder().to_bytes()))
+    f.write(compressor.flush())
+
+def _schema_path(path, name):
+  return name if not path else path + "." + name
+
+def _diff_values(v1, v2, path, diff_path, ignore, tolerance, field_tolerances, diff):
+  """Appends the differences between two capnp readers or values to diff. path is the
+  field path without list indices, which is what ignore and field_tolerances refer to."""
+  if isinstance(v1, _StructReader):
+    fields = list(v1.schema.non_union_fields)
+    if v1.schema.union_fields:
+      which1, which2 = v1.which(), v2.which()
+      if which1 != which2:
+        diff.append(('change', _schema_path(diff_path, "which"), (which1, which2)))
+        return
+      fields.append(which1)
+
+    for f in fields:
+      p = _schema_path(path, f)
+      if p in ignore:
+        continue
+      _diff_values(getattr(v1, f), getattr(v2, f), p, _schema_path(diff_path, f), ignore, tolerance, field_tolerances, diff)
+
+  elif isinstance(v1, _ListReader):
+    if len(v1) != len(v2):
+      diff.append(('change', diff_path, (len(v1), len(v2))))
+      return
+    for i in range(len(v1)):
+      _diff_values(v1[i], v2[i], path, _schema_path(diff_path, str(i)), ignore, tolerance, field_tolerances, diff)
+
+  elif isinstance(v1, float):
+    tol = field_tolerances.get(path, tolerance)
+    if not (v1 == v2 or abs(v1 - v2) <= tol or (math.isnan(v1) and math.isnan(v2))):
+      diff.append(('change', diff_path, (v1, v2)))
+
+  elif isinstance(v1, (bool, int, bytes, str)):
+    if v1 != v2:
+      diff.append(('change', diff_path, (v1, v2)))
+
+  # enums and anything else
+  elif str(v1) != str(v2):
+    diff.append(('change', diff_path, (str(v1), str(v2))))
+
+def compare_logs(log1, log2, ignore=[], tolerance=0., field_tolerances=None):
+  """Compares two logs message by message, without keeping them in memory. Fields in ignore
+  are skipped. Floats are equal if they're within tolerance, field_tolerances overrides
+  that per field, e.g. {"controlsState.vPid": 1e-3}."""
+  ignore_fields = set(k for k, v in ignore)
+  field_tolerances = field_tolerances or {}
+
   diff = []
-  for msg1, msg2 in tqdm(zip(log1, log2)):
+  cnt1, cnt2 = 0, 0
+  log1, log2 = iter(log1), iter(log2)
+  for msg1 in tqdm(log1):
+    cnt1 += 1
+    msg2 = next(log2, None)
+    if msg2 is None:
+      break
+    cnt2 += 1
+
     if msg1.which() != msg2.which():
       print(msg1, msg2)
       assert False, "msgs not aligned between logs"
 
-    msg1_bytes = remove_ignored_fields(msg1, ignore).as_builder().to_bytes()
-    msg2_bytes = remove_ignored_fields(msg2, ignore).as_builder().to_bytes()
+    _diff_values(msg1, msg2, "", "", ignore_fields, tolerance, field_tolerances, diff)
 
-    if msg1_bytes != msg2_bytes:
-      msg1_dict = msg1.to_dict(verbose=True)
-      msg2_dict = msg2.to_dict(verbose=True)
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields, tolerance=0)
-      diff.extend(dd)
+  cnt1 += sum(1 for _ in log1)
+  cnt2 += sum(1 for _ in log2)
+  assert cnt1 == cnt2, "logs are not same length: " + str(cnt1) + " VS " + str(cnt2)
   return diff
 
 if __name__ == "__main__":
-  log1 = list(LogReader(sys.argv[1]))
-  log2 = list(LogReader(sys.argv[2]))
-  print(compare_logs(log1, log2, sys.argv[3:]))
+  log1 = LogReader(sys.argv[1])
+  log2 = LogReader(sys.argv[2])
+  print(compare_logs(log1, log2, [(k, None) for k in sys.argv[3:]]))
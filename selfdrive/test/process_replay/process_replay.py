@@ -13,11 +13,12 @@ from cereal import car, log
 from selfdrive.car.car_helpers import get_car
 import selfdrive.manager as manager
 import cereal.messaging as messaging
-from common.params import Params
+from common.params import Params, default_params_path
 from cereal.services import service_list
 from collections import namedtuple
 
-ProcessConfig = namedtuple('ProcessConfig', ['proc_name', 'pub_sub', 'ignore', 'init_callback', 'should_recv_callback'])
+ProcessConfig = namedtuple('ProcessConfig', ['proc_name', 'pub_sub', 'ignore', 'init_callback', 'should_recv_callback',
+                                             'step_class', 'step_init_callback'])
 
 class FakeSocket:
   def __init__(self, wait=True):
@@ -36,6 +37,9 @@ class FakeSocket:
       self.recv_ready.clear()
     return self.data.pop()
 
+  def receive_many(self, wait_for_one=False):
+    return messaging.MessageBatch.from_messages(messaging.drain_sock_raw(self, wait_for_one))
+
   def send(self, data):
     if self.wait:
       self.recv_called.wait()
@@ -126,6 +130,29 @@ class FakePubMaster(messaging.PubMaster):
     self.get_called.set()
     return dat
 
+class StepSubMaster(messaging.SubMaster):
+  """SubMaster for step mode, update() applies the messages queued in msgs"""
+  def __init__(self, services):
+    super(StepSubMaster, self).__init__(services, addr=None)
+    self.sock = {s: DumbSocket(s) for s in services}
+    self.msgs = []
+
+  def update(self, timeout=-1):
+    msgs, self.msgs = self.msgs, []
+    self.update_msgs(0, msgs)
+
+class StepPubMaster(messaging.PubMaster):
+  """PubMaster for step mode, sent messages are collected in msgs"""
+  def __init__(self, services):
+    self.sock = {s: DumbSocket() for s in services}
+    self.msgs = []
+
+  def send(self, s, dat):
+    if isinstance(dat, bytes):
+      self.msgs.append(log.Event.from_bytes(dat))
+    else:
+      self.msgs.append(dat.as_reader())
+
 def fingerprint(msgs, fsm, can_sock):
   print("start fingerprinting")
   fsm.wait_on_getitem = True
@@ -159,6 +186,14 @@ def get_car_params(msgs, fsm, can_sock):
   _, CP = get_car(can, sendcan)
   Params().put("CarParams", CP.to_bytes())
 
+def fingerprint_step(msgs, can_sock):
+  # fingerprinting runs in the daemon's constructor, leftovers are dropped after
+  canmsgs = [msg for msg in msgs if msg.which() == "can"]
+  can_sock.data = [msg.as_builder().to_bytes() for msg in canmsgs[:300]]
+
+def get_car_params_step(msgs, can_sock):
+  get_car_params(msgs, None, None)
+
 def radar_rcv_callback(msg, CP):
   if msg.which() != "can":
     return []
@@ -187,6 +222,8 @@ CONFIGS = [
     ignore=[("logMonoTime", 0), ("valid", True), ("controlsState.startMonoTime", 0), ("controlsState.cumLagMs", 0)],
     init_callback=fingerprint,
     should_recv_callback=None,
+    step_class="Controlsd",
+    step_init_callback=fingerprint_step,
   ),
   ProcessConfig(
     proc_name="radard",
@@ -197,6 +234,8 @@ CONFIGS = [
     ignore=[("logMonoTime", 0), ("valid", True), ("radarState.cumLagMs", 0)],
     init_callback=get_car_params,
     should_recv_callback=radar_rcv_callback,
+    step_class="Radard",
+    step_init_callback=get_car_params_step,
   ),
   ProcessConfig(
     proc_name="plannerd",
@@ -207,6 +246,8 @@ CONFIGS = [
     ignore=[("logMonoTime", 0), ("valid", True), ("plan.processingDelay", 0)],
     init_callback=get_car_params,
     should_recv_callback=None,
+    step_class="Plannerd",
+    step_init_callback=get_car_params_step,
   ),
   ProcessConfig(
     proc_name="calibrationd",
@@ -216,10 +257,84 @@ CONFIGS = [
     ignore=[("logMonoTime", 0), ("valid", True)],
     init_callback=get_car_params,
     should_recv_callback=None,
+    step_class="Calibrationd",
+    step_init_callback=get_car_params_step,
   ),
 ]
 
-def replay_process(cfg, lr):
+def setup_process(cfg):
+  shutil.rmtree(default_params_path(), ignore_errors=True)
+  params = Params()
+  params.manager_start()
+  params.put("OpenpilotEnabledToggle", "1")
+  params.put("Passive", "0")
+  params.put("CommunityFeaturesToggle", "1")
+
+  os.environ['NO_RADAR_SLEEP'] = "1"
+  manager.prepare_managed_process(cfg.proc_name)
+  return importlib.import_module(manager.managed_processes[cfg.proc_name])
+
+def get_recv_socks(cfg, msg, CP, fsm):
+  if cfg.should_recv_callback is not None:
+    return cfg.should_recv_callback(msg, CP)
+  return [s for s in cfg.pub_sub[msg.which()] if
+            (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
+
+def replay_process(cfg, lr, threaded=False):
+  """Replays the input messages of lr through the process and returns its output messages.
+  Processes with a step_class are run synchronously unless threaded is set."""
+  if cfg.step_class is None or threaded:
+    return replay_process_threaded(cfg, lr)
+  return replay_process_step(cfg, lr)
+
+def replay_process_step(cfg, lr):
+  """Calls the step() function of the process once for every frame it would wake up for,
+  on the calling thread and with the input messages queued up front."""
+  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
+  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+
+  fsm = StepSubMaster(pub_sockets)
+  fpm = StepPubMaster(sub_sockets)
+  args = (fsm, fpm)
+  can_sock = None
+  if 'can' in list(cfg.pub_sub.keys()):
+    can_sock = FakeSocket(wait=False)
+    args = (fsm, fpm, can_sock)
+
+  all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
+  pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
+
+  mod = setup_process(cfg)
+  cfg.step_init_callback(all_msgs, can_sock)
+  process = getattr(mod, cfg.step_class)(*args)
+  if can_sock is not None:
+    can_sock.data = []
+  fpm.msgs = []
+
+  CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
+
+  log_msgs, msg_queue = [], []
+  for msg in tqdm(pub_msgs):
+    should_recv = bool(len(get_recv_socks(cfg, msg, CP, fsm)))
+
+    # processes with a can socket run an iteration on every can packet
+    is_can = msg.which() == 'can'
+    if is_can:
+      can_sock.send(msg.as_builder().to_bytes())
+    else:
+      msg_queue.append(msg.as_builder())
+
+    if should_recv:
+      fsm.msgs.extend(msg_queue)
+      msg_queue = []
+
+    if should_recv or is_can:
+      process.step()
+      log_msgs.extend(fpm.msgs)
+      fpm.msgs = []
+  return log_msgs
+
+def replay_process_threaded(cfg, lr):
   sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
   pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
 
@@ -233,16 +348,7 @@ def replay_process(cfg, lr):
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
   pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
 
-  shutil.rmtree('/data/params', ignore_errors=True)
-  params = Params()
-  params.manager_start()
-  params.put("OpenpilotEnabledToggle", "1")
-  params.put("Passive", "0")
-  params.put("CommunityFeaturesToggle", "1")
-
-  os.environ['NO_RADAR_SLEEP'] = "1"
-  manager.prepare_managed_process(cfg.proc_name)
-  mod = importlib.import_module(manager.managed_processes[cfg.proc_name])
+  mod = setup_process(cfg)
   thread = threading.Thread(target=mod.main, args=args)
   thread.daemon = True
   thread.start()
@@ -252,7 +358,7 @@ def replay_process(cfg, lr):
       can_sock = None
     cfg.init_callback(all_msgs, fsm, can_sock)
 
-  CP = car.CarParams.from_bytes(params.get("CarParams", block=True))
+  CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
 
   # wait for started process to be ready
   if 'can' in list(cfg.pub_sub.keys()):
@@ -262,12 +368,7 @@ def replay_process(cfg, lr):
 
   log_msgs, msg_queue = [], []
   for msg in tqdm(pub_msgs):
-    if cfg.should_recv_callback is not None:
-      recv_socks = cfg.should_recv_callback(msg, CP)
-    else:
-      recv_socks = [s for s in cfg.pub_sub[msg.which()] if
-                      (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
-
+    recv_socks = get_recv_socks(cfg, msg, CP, fsm)
     should_recv = bool(len(recv_socks))
 
     if msg.which() == 'can':
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import requests
+import shutil
 import sys
 import tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from selfdrive.test.process_replay.compare_logs import compare_logs
 from selfdrive.test.process_replay.process_replay import replay_process, CONFIGS
@@ -18,11 +22,22 @@ segments = [
   "7873afaf022d36e2|2019-07-03--18-46-44--0", # SUBARU.IMPREZA
 ]
 
-def get_segment(segment_name):
+BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
+process_replay_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_segment(segment_name, rlog_dir=None):
+  """Returns the path to the rlog of the segment. With rlog_dir the rlog is expected at
+  <rlog_dir>/<dongle id>/<route>/<segment number>/rlog.bz2, same layout as the CI bucket,
+  otherwise it's downloaded to a temporary file."""
   route_name, segment_num = segment_name.rsplit("--", 1)
-  rlog_url = "https://commadataci.blob.core.windows.net/openpilotci/%s/%s/rlog.bz2" \
-                % (route_name.replace("|", "/"), segment_num)
-  r = requests.get(rlog_url)
+  rlog_path = "%s/%s/rlog.bz2" % (route_name.replace("|", "/"), segment_num)
+
+  if rlog_dir is not None:
+    rlog_fn = os.path.join(rlog_dir, rlog_path)
+    return rlog_fn if os.path.isfile(rlog_fn) else None
+
+  r = requests.get(BASE_URL + rlog_path)
   if r.status_code != 200:
     return None
 
@@ -30,9 +45,73 @@ def get_segment(segment_name):
     f.write(r.content)
     return f.name
 
+def get_ref_log(segment, proc_name, ref_commit):
+  log_fn = os.path.join(process_replay_dir, "%s_%s_%s.bz2" % (segment, proc_name, ref_commit))
+  if os.path.isfile(log_fn):
+    return LogReader(log_fn)
+
+  req = requests.get(BASE_URL + os.path.basename(log_fn))
+  if req.status_code != 200:
+    return None
+
+  with tempfile.NamedTemporaryFile(suffix=".bz2") as f:
+    f.write(req.content)
+    f.flush()
+    f.seek(0)
+    return list(LogReader(f.name))
+
+def replay_segment_process(args):
+  """Replays one process over one segment with its own params dir, returns the diff
+  against the reference log or an error string."""
+  segment, proc_name, rlog_fn, ref_commit = args
+  cfg = next(cfg for cfg in CONFIGS if cfg.proc_name == proc_name)
+
+  params_dir = tempfile.mkdtemp(prefix="params_")
+  os.environ["PARAMS_PATH"] = params_dir
+  try:
+    log_msgs = replay_process(cfg, LogReader(rlog_fn))
+    cmp_log_msgs = get_ref_log(segment, proc_name, ref_commit)
+    if cmp_log_msgs is None:
+      return segment, proc_name, "failed to download comparison log"
+    return segment, proc_name, compare_logs(cmp_log_msgs, log_msgs, cfg.ignore)
+  finally:
+    shutil.rmtree(params_dir, ignore_errors=True)
+
+def run_tests(ref_commit, rlog_dir=None, jobs=None):
+  # download everything first, the replays don't share anything else
+  with ThreadPool(len(segments)) as pool:
+    rlogs = dict(zip(segments, pool.map(lambda s: get_segment(s, rlog_dir), segments)))
+
+  try:
+    for segment, rlog_fn in rlogs.items():
+      if rlog_fn is None:
+        print("failed to get segment %s" % segment)
+        sys.exit(1)
+
+    # every replay gets a fresh process, the daemons keep global state and never exit
+    work = [(segment, cfg.proc_name, rlogs[segment], ref_commit) for segment in segments for cfg in CONFIGS]
+    with Pool(jobs, maxtasksperchild=1) as pool:
+      results = {segment: {} for segment in segments}
+      for segment, proc_name, diff in pool.imap_unordered(replay_segment_process, work):
+        print("***** finished %s on segment %s *****" % (proc_name, segment))
+        results[segment][proc_name] = diff
+  finally:
+    if rlog_dir is None:
+      for rlog_fn in rlogs.values():
+        if rlog_fn is not None:
+          os.remove(rlog_fn)
+
+  # keep the report in the same order as a sequential run
+  return {segment: {cfg.proc_name: results[segment][cfg.proc_name] for cfg in CONFIGS} for segment in segments}
+
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Regression test for openpilot processes")
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of replays to run in parallel, defaults to the number of cores")
+  parser.add_argument("--rlog-dir", default=None,
+                      help="read rlogs from <dir>/<dongle id>/<route>/<segment number>/rlog.bz2 instead of downloading them")
+  args = parser.parse_args()
 
-  process_replay_dir = os.path.dirname(os.path.abspath(__file__))
   ref_commit_fn = os.path.join(process_replay_dir, "ref_commit")
 
   if not os.path.isfile(ref_commit_fn):
@@ -42,43 +121,7 @@ if __name__ == "__main__":
   ref_commit = open(ref_commit_fn).read().strip()
   print("***** testing against commit %s *****" % ref_commit)
 
-  results = {}
-  for segment in segments:
-    print("***** testing route segment %s *****\n" % segment)
-
-    results[segment] = {}
-
-    rlog_fn = get_segment(segment)
-
-    if rlog_fn is None:
-      print("failed to get segment %s" % segment)
-      sys.exit(1)
-
-    lr = LogReader(rlog_fn)
-
-    for cfg in CONFIGS:
-      log_msgs = replay_process(cfg, lr)
-
-      log_fn = os.path.join(process_replay_dir, "%s_%s_%s.bz2" % (segment, cfg.proc_name, ref_commit))
-
-      if not os.path.isfile(log_fn):
-        url = "https://commadataci.blob.core.windows.net/openpilotci/"
-        req = requests.get(url + os.path.basename(log_fn))
-        if req.status_code != 200:
-          results[segment][cfg.proc_name] = "failed to download comparison log"
-          continue
-
-        with tempfile.NamedTemporaryFile(suffix=".bz2") as f:
-          f.write(req.content)
-          f.flush()
-          f.seek(0)
-          cmp_log_msgs = list(LogReader(f.name))
-      else:
-        cmp_log_msgs = list(LogReader(log_fn))
-
-      diff = compare_logs(cmp_log_msgs, log_msgs, cfg.ignore)
-      results[segment][cfg.proc_name] = diff
-    os.remove(rlog_fn)
+  results = run_tests(ref_commit, args.rlog_dir, args.jobs)
 
   failed = False
   with open(os.path.join(process_replay_dir, "diff.txt"), "w") as f:
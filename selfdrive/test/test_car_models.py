@@ -1,17 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import shutil
-import time
+import tempfile
 import os
 import sys
-import signal
-import subprocess
 import requests
+from multiprocessing import Pool
 from cereal import car
 
-import selfdrive.manager as manager
-import cereal.messaging as messaging
 from common.params import Params
-from common.basedir import BASEDIR
 from selfdrive.car.fingerprints import all_known_cars
 from selfdrive.car.honda.values import CAR as HONDA
 from selfdrive.car.toyota.values import CAR as TOYOTA
@@ -22,41 +19,101 @@ from selfdrive.car.chrysler.values import CAR as CHRYSLER
 from selfdrive.car.subaru.values import CAR as SUBARU
 from selfdrive.car.volkswagen.values import CAR as VOLKSWAGEN
 from selfdrive.car.mock.values import CAR as MOCK
+from selfdrive.test.longitudinal_maneuvers.lockstep import Bus, LockstepStack, CONTROLSD_SUB, CONTROLSD_PUB, \
+                                                          RADARD_SUB, RADARD_PUB, PLANNERD_SUB, PLANNERD_PUB
+from tools.lib.logreader import LogReader
 
 
 os.environ['NOCRASH'] = '1'
 
+# services of the log fed to the daemons, what they publish themselves is left out
+REPLAY_SERVICES = set(CONTROLSD_SUB + RADARD_SUB + PLANNERD_SUB + ['can']) - set(CONTROLSD_PUB + RADARD_PUB + PLANNERD_PUB)
+# can packets queued before controlsd starts, the vin query and the fingerprinting read them
+FINGERPRINT_CAN_MSGS = 400
 
-def wait_for_socket(name, timeout=10.0):
-  socket = messaging.sub_sock(name)
-  cur_time = time.time()
 
-  r = None
-  while time.time() - cur_time < timeout:
-    print("waiting for %s" % name)
-    r = socket.receive(non_blocking=True)
-    if r is not None:
+def get_route_log(route_name, rlog_dir="/tmp", download=True):
+  log_path = os.path.join(rlog_dir, "%s--0--rlog.bz2" % route_name.replace("|", "_"))
+
+  if not os.path.isfile(log_path):
+    if not download:
+      return None
+
+    log_url = "https://commadataci.blob.core.windows.net/openpilotci/%s/0/rlog.bz2" % route_name.replace("|", "/")
+    r = requests.get(log_url)
+
+    if r.status_code == 200:
+      with open(log_path, "wb") as f:
+        f.write(r.content)
+    else:
+      print("failed to download test log %s" % route_name)
+      sys.exit(-1)
+  return log_path
+
+def replay_route(route, rlog_fn, passive):
+  """Feeds the log to controlsd, radard and plannerd running in this process until each
+  output was published once. Returns the failures and the CarParams controlsd wrote."""
+  params = Params()
+  params.manager_start()
+  params.put("Passive", "1" if passive else "0")
+
+  expected = ['controlsState', 'radarState', 'plan', 'carState']
+  if not passive:  # TODO The passive routes have very flaky models
+    expected.append('pathPlan')
+
+  bus = Bus()
+  stack = LockstepStack(bus, keep_going=True)
+  outputs = {s: bus.sub_sock(s, conflate=True) for s in expected}
+
+  msgs = (msg for msg in sorted(LogReader(rlog_fn), key=lambda m: m.logMonoTime) if msg.which() in REPLAY_SERVICES)
+  seen_health = False
+  for msg in msgs:
+    bus.time = msg.logMonoTime * 1e-9
+    bus.publish(msg.which(), msg.as_builder().to_bytes())
+    seen_health = seen_health or msg.which() == 'health'
+    if seen_health and len(stack.controlsd_can.q) >= FINGERPRINT_CAN_MSGS:
+      break
+  else:
+    return ['fingerprint'], None
+
+  try:
+    stack.start()
+  except Exception:
+    return ['controlsd'], None
+  car_params = car.CarParams.from_bytes(params.get("CarParams"))
+
+  for msg in msgs:
+    bus.publish(msg.which(), msg.as_builder().to_bytes())
+    stack.step(msg.logMonoTime * 1e-9)
+    if all(sock.q for sock in outputs.values()):
       break
-    time.sleep(0.5)
 
-  if r is None:
-    sys.exit(-1)
-  return r
+  failures = sorted(stack.crashed.keys())
+  failures += [s for s in expected if not outputs[s].q]
+  return failures, car_params
+
+def check_route(args):
+  """Tests one route with its own params dir, returns (route, passed, failures)"""
+  route, checks, rlog_fn = args
 
-def get_route_logs(route_name):
-  for log_f in ["rlog.bz2", "fcamera.hevc"]:
-    log_path = os.path.join("/tmp", "%s--0--%s" % (route_name.replace("|", "_"), log_f))
+  params_dir = tempfile.mkdtemp(prefix="params_")
+  os.environ["PARAMS_PATH"] = params_dir
+  try:
+    print("testing ", route, " ", checks['carFingerprint'])
+    failures, car_params = replay_route(route, rlog_fn, route in passive_routes)
 
-    if not os.path.isfile(log_path):
-      log_url = "https://commadataci.blob.core.windows.net/openpilotci/%s/0/%s" % (route_name.replace("|", "/"), log_f)
-      r = requests.get(log_url)
+    params_ok = car_params is not None
+    if car_params is not None:
+      for k, v in checks.items():
+        if not v == getattr(car_params, k):
+          params_ok = False
+          failures.append(k)
 
-      if r.status_code == 200:
-        with open(log_path, "wb") as f:
-          f.write(r.content)
-      else:
-        print("failed to download test log %s" % route_name)
-        sys.exit(-1)
+    passed = params_ok and len(failures) == 0
+    print("%s %s" % ("Success" if passed else "Failure", route))
+    return route, passed, failures
+  finally:
+    shutil.rmtree(params_dir, ignore_errors=True)
 
 routes = {
 
@@ -448,6 +505,12 @@ non_public_routes = [
 ]
 
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="check the CarParams and the daemons on a route of every car model")
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of routes to test in parallel, defaults to the number of cores")
+  parser.add_argument("--rlog-dir", default="/tmp",
+                      help="directory of the <route>--0--rlog.bz2 logs, non public routes are tested when they're found there")
+  args = parser.parse_args()
 
   # TODO: add routes for untested cars and fail test if we have an untested car
   tested_cars = [keys["carFingerprint"] for route, keys in routes.items()]
@@ -455,107 +518,18 @@ if __name__ == "__main__":
     if car_model not in tested_cars:
       print("***** WARNING: %s not tested *****" % car_model)
 
-  results = {}
+  work = []
   for route, checks in routes.items():
-    if route not in non_public_routes:
-      get_route_logs(route)
-    elif "UNLOGGER_PATH" not in os.environ:
-      continue
-
-    for _ in range(3):
-      shutil.rmtree('/data/params')
-      manager.gctx = {}
-      params = Params()
-      params.manager_start()
-      if route in passive_routes:
-        params.put("Passive", "1")
-      else:
-        params.put("Passive", "0")
-
-      print("testing ", route, " ", checks['carFingerprint'])
-      print("Preparing processes")
-      manager.prepare_managed_process("radard")
-      manager.prepare_managed_process("controlsd")
-      manager.prepare_managed_process("plannerd")
-      print("Starting processes")
-      manager.start_managed_process("radard")
-      manager.start_managed_process("controlsd")
-      manager.start_managed_process("plannerd")
-      time.sleep(2)
-
-      # Start unlogger
-      print("Start unlogger")
-      if route in non_public_routes:
-        unlogger_cmd = [os.path.join(BASEDIR, os.environ['UNLOGGER_PATH']), '%s' % route, '--disable', 'frame,plan,pathPlan,liveLongitudinalMpc,radarState,controlsState,liveTracks,liveMpc,sendcan,carState,carControl,carEvents,carParams', '--no-interactive']
-      else:
-        unlogger_cmd = [os.path.join(BASEDIR, 'tools/replay/unlogger.py'), '%s' % route, '/tmp', '--disable', 'frame,plan,pathPlan,liveLongitudinalMpc,radarState,controlsState,liveTracks,liveMpc,sendcan,carState,carControl,carEvents,carParams', '--no-interactive']
-      unlogger = subprocess.Popen(unlogger_cmd, preexec_fn=os.setsid)
-
-      print("Check sockets")
-      controls_state_result = wait_for_socket('controlsState', timeout=30)
-      radarstate_result = wait_for_socket('radarState', timeout=30)
-      plan_result = wait_for_socket('plan', timeout=30)
-
-      if route not in passive_routes:  # TODO The passive routes have very flaky models
-        path_plan_result = wait_for_socket('pathPlan', timeout=30)
-      else:
-        path_plan_result = True
-
-      carstate_result = wait_for_socket('carState', timeout=30)
-
-      print("Check if everything is running")
-      running = manager.get_running()
-      controlsd_running = running['controlsd'].is_alive()
-      radard_running = running['radard'].is_alive()
-      plannerd_running = running['plannerd'].is_alive()
-
-      manager.kill_managed_process("controlsd")
-      manager.kill_managed_process("radard")
-      manager.kill_managed_process("plannerd")
-      os.killpg(os.getpgid(unlogger.pid), signal.SIGTERM)
-
-      sockets_ok = all([
-        controls_state_result, radarstate_result, plan_result, path_plan_result, carstate_result,
-        controlsd_running, radard_running, plannerd_running
-      ])
-      params_ok = True
-      failures = []
-
-      if not controlsd_running:
-        failures.append('controlsd')
-      if not radard_running:
-        failures.append('radard')
-      if not radarstate_result:
-        failures.append('radarState')
-      if not controls_state_result:
-        failures.append('controlsState')
-      if not plan_result:
-        failures.append('plan')
-      if not path_plan_result:
-        failures.append('pathPlan')
-
-      try:
-        car_params = car.CarParams.from_bytes(params.get("CarParams"))
-        for k, v in checks.items():
-          if not v == getattr(car_params, k):
-            params_ok = False
-            failures.append(k)
-      except:
-        params_ok = False
-
-      if sockets_ok and params_ok:
-        print("Success")
-        results[route] = True, failures
-        break
-      else:
-        print("Failure")
-        results[route] = False, failures
+    rlog_fn = get_route_log(route, args.rlog_dir, download=route not in non_public_routes)
+    if rlog_fn is not None:
+      work.append((route, checks, rlog_fn))
 
-      time.sleep(2)
+  # every route gets a fresh process, the daemons keep global state
+  with Pool(args.jobs, maxtasksperchild=1) as pool:
+    results = {route: (passed, failures) for route, passed, failures in pool.imap_unordered(check_route, work)}
 
-  for route in results:
+  for route, _, _ in work:
     print(results[route])
-  Params().put("Passive", "0")   # put back not passive to not leave the params in an unintended state
   if not all(passed for passed, _ in results.values()):
     print("TEST FAILED")
     sys.exit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import os
+import signal
+import time
+import unittest
+from multiprocessing import Process
+
+from selfdrive.supervisor import Supervisor
+
+
+def slow_exit(delay):
+  def handler(signum, frame):
+    time.sleep(delay)
+    os._exit(0)
+  signal.signal(signal.SIGTERM, handler)
+  while True:
+    time.sleep(1)
+
+def ignore_sigterm():
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  while True:
+    time.sleep(1)
+
+def crash():
+  os._exit(3)
+
+
+class TestSupervisor(unittest.TestCase):
+  def setUp(self):
+    self.supervisor = Supervisor()
+
+  def tearDown(self):
+    names = list(self.supervisor.running)
+    self.supervisor.signal(names, signal.SIGKILL)
+    self.supervisor.wait(names, 5)
+
+  def test_parallel_stop(self):
+    names = ["p%d" % i for i in range(5)]
+    for name in names:
+      self.supervisor.start(name, Process(name=name, target=slow_exit, args=(0.5,)))
+    time.sleep(0.5)
+
+    t = time.monotonic()
+    self.supervisor.signal(names, signal.SIGTERM)
+    self.assertEqual(self.supervisor.wait(names, 5), [])
+    self.assertLess(time.monotonic() - t, 2)
+
+    for name in names:
+      self.assertEqual(self.supervisor.remove(name), 0)
+    self.assertEqual(self.supervisor.get_stats()["p0"], {"starts": 1, "stops": 1, "crashes": 0, "exitcode": 0})
+
+  def test_deadline(self):
+    self.supervisor.start("stuck", Process(name="stuck", target=ignore_sigterm))
+    self.supervisor.start("quick", Process(name="quick", target=slow_exit, args=(0,)))
+    time.sleep(0.5)
+
+    t = time.monotonic()
+    self.supervisor.signal(["stuck", "quick"], signal.SIGTERM)
+    self.assertEqual(self.supervisor.wait(["stuck", "quick"], 0.5), ["stuck"])
+    self.assertLess(time.monotonic() - t, 1)
+
+    self.supervisor.signal(["stuck"], signal.SIGKILL)
+    self.assertEqual(self.supervisor.wait(["stuck"], 5), [])
+    self.assertEqual(self.supervisor.remove("stuck"), -signal.SIGKILL)
+
+  def test_wait_without_deadline(self):
+    self.supervisor.start("slow", Process(name="slow", target=slow_exit, args=(1.,)))
+    time.sleep(0.5)
+
+    t = time.monotonic()
+    self.supervisor.signal(["slow"], signal.SIGTERM)
+    self.assertEqual(self.supervisor.wait(["slow"]), [])
+    self.assertGreaterEqual(time.monotonic() - t, 1.)
+    self.assertEqual(self.supervisor.remove("slow"), 0)
+
+  def test_crash(self):
+    self.supervisor.start("crash", Process(name="crash", target=crash))
+    self.supervisor.wait(["crash"], 5)
+    self.assertEqual(self.supervisor.check(), ["crash"])
+    self.assertEqual(self.supervisor.check(), [])
+    self.supervisor.remove("crash")
+
+    self.supervisor.start("crash", Process(name="crash", target=crash))
+    self.supervisor.wait(["crash"], 5)
+    self.supervisor.check()
+    self.supervisor.remove("crash")
+    self.assertEqual(self.supervisor.get_stats()["crash"], {"starts": 2, "stops": 0, "crashes": 2, "exitcode": 3})
+
+
+if __name__ == "__main__":
+  unittest.main()